@@ -0,0 +1,49 @@
+# Batch script - compiles many SPL files at once, on every core, e.g.
+#   python batch.py 'programs/**/*.spl' -o build --report build/report.json
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import spl
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='SPL Compiler - batch mode')
+    argument_parser.add_argument('sources', nargs='+',
+                                 help='SPL files or glob patterns (quoted, ** matches any depth of directories)')
+    argument_parser.add_argument('-o', '--output', metavar='DIR',
+                                 help='write the BASIC to DIR rather than beside each source')
+    argument_parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                                 help='number of worker processes - one per core by default')
+    argument_parser.add_argument('--cache', metavar='DIR',
+                                 help='reuse earlier compilations of the same source, kept in DIR')
+    argument_parser.add_argument('--report', metavar='PATH',
+                                 help='write the result for every file to PATH as JSON')
+    argument_parser.add_argument('-v', '--verbose', action='store_true', help='print every file compiled')
+    arguments = argument_parser.parse_args()
+    spl.configure_logging(logging.WARNING)
+
+    start = time.perf_counter()
+    results = []
+    try:
+        for result in spl.compile_batch(spl.batch_sources(arguments.sources), arguments.output, arguments.jobs,
+                                        arguments.cache):
+            results.append(result)
+            for message in result.errors:
+                print(message)
+            if arguments.verbose and not result.errors:
+                print(f'{result.filename} -> {result.output}')
+    except spl.CompilerError as error:
+        print(error)
+        sys.exit(1)
+    seconds = time.perf_counter() - start
+
+    failed = sum(1 for result in results if result.errors)
+    print(f'{len(results) - failed} compiled, {failed} failed, in {seconds:.2f} seconds')
+    if arguments.report:
+        with open(arguments.report, 'w') as report_file:
+            json.dump({'compiled': len(results) - failed, 'failed': failed, 'seconds': seconds,
+                       'files': [vars(result) for result in results]}, report_file, indent=2)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,28 @@
+# Parser benchmark - checks that parse time grows linearly with the number of procedure definitions. The table is
+# for reading; test_spl.test_parse_time_grows_linearly fails if the growth is no longer linear
+
+import time
+
+import spl
+
+PROC_COUNTS = [100, 200, 400, 800, 3200]
+
+
+def make_program(proc_count):
+    procs = ''.join(f'proc p{index} {{ return ; }} , ' for index in range(proc_count))
+    return procs + 'main { halt ; }'
+
+
+def time_parse(proc_count):
+    # Lexing happens up front, so only parsing is timed
+    tokens = spl.Lexer(make_program(proc_count)).run_lexer()
+    start = time.perf_counter()
+    spl.Parser(tokens).run_parser()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    print('procs    seconds    microseconds per proc')
+    for proc_count in PROC_COUNTS:
+        seconds = min(time_parse(proc_count) for _ in range(3))
+        print(f'{proc_count:5}    {seconds:7.4f}    {seconds / proc_count * 1e6:8.1f}')
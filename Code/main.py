@@ -1,40 +1,121 @@
 # Main script
 
+import argparse
+import concurrent.futures
+import logging
+import os
+import sys
+
 import spl
 
-lexer = None
-parser = None
-filereader = None
+compilation = None
+log = logging.getLogger('spl.main')
+
+# -v prints stage banners and results, -vv prints every token and parser production as well
+VERBOSITY_LEVELS = [logging.WARNING, logging.INFO, logging.DEBUG]
+
+
+def report_errors(error):
+    # Prints each error with its file, line and column where known, then quits
+    if compilation is not None:
+        for message in compilation.error_messages(error):
+            print(message)
+    else:
+        print(error)
+    sys.exit(1)
+
+
+def check(compilation, jobs=None):
+    # Lexes, parses and checks the program - with the procs on jobs worker processes, if more than one
+    if jobs and jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            compilation.run_parallel(executor)
+        log.info('\nCOMPILED ON %d WORKERS\n', jobs)
+        return
+
+    compilation.run_lexer()
+    log.info('\nLEXER COMPLETED - OUTPUT ABOVE\n')
+
+    compilation.run_parser()
+    log.info('\nPARSER COMPLETED - OUTPUT ABOVE\n')
+
+    log.info('End of Practical A scope!')
+
+    compilation.run_analyst()
+
 
 if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='SPL Compiler')
+    argument_parser.add_argument('filename', nargs='?', help='SPL file to compile - asked for if not given')
+    argument_parser.add_argument('-v', '--verbose', action='count', default=0,
+                                 help='print stage output (-v) or full token and parser output (-vv)')
+    argument_parser.add_argument('--trace', metavar='PATH',
+                                 help='write every compiler event to PATH as JSON lines')
+    argument_parser.add_argument('--cache', metavar='DIR',
+                                 help='reuse earlier compilations of the same source, kept in DIR')
+    argument_parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                                 help='check the procs on N worker processes rather than one by one')
+    argument_parser.add_argument('-o', '--output', metavar='PATH', default=spl.DEFAULT_OUTPUT_PATH,
+                                 help=f'write the BASIC to PATH (default {spl.DEFAULT_OUTPUT_PATH})')
+    argument_parser.add_argument('-O', '--optimise', action='store_true',
+                                 help='simplify the program (fold constants and identities, strip dead code) before '
+                                      'generating code')
+    argument_parser.add_argument('--run', action='store_true',
+                                 help='run the program here, on the bytecode VM, rather than generating BASIC')
+    argument_parser.add_argument('--python', action='store_true',
+                                 help='with --run, run the program compiled to Python code instead')
+    argument_parser.add_argument('--ir', action='store_true',
+                                 help='print the three-address code the BASIC is generated from')
+    argument_parser.add_argument('--open', action='store_true',
+                                 help='open the BASIC in its default program afterwards (Windows only)')
+    arguments = argument_parser.parse_args()
+    spl.configure_logging(VERBOSITY_LEVELS[min(arguments.verbose, 2)], arguments.trace)
+
     print('SPL Compiler - David Walker - COS341 2022')
-    filename = input('Please input the name of the file you wish to examine:')
+    filename = arguments.filename or input('Please input the name of the file you wish to examine:')
 
-    filereader = spl.FileReader(filename)
-    file_text = filereader.get_all_text()
+    try:
+        filereader = spl.FileReader(filename)
+        file_text = filereader.get_all_text()
+        compilation = spl.Compilation(file_text, filename)
+        if arguments.cache:
+            # The checked program and its BASIC, from the cache or else made and stored there
+            checked = spl.CompilationCache(arguments.cache).compile(file_text, filename, compilation,
+                                                                    lambda each: check(each, arguments.jobs))
+            if checked is not compilation:
+                log.info('\nUSING CACHED COMPILATION\n')
+            compilation = checked
+        else:
+            check(compilation, arguments.jobs)
+    except spl.CompilerError as error:
+        report_errors(error)
 
-    lexer = spl.Lexer(file_text)
-    token_list = lexer.run_lexer()
-    print('\nLEXER COMPLETED - OUTPUT ABOVE\n')
+    if log.isEnabledFor(logging.INFO):
+        # Cached compilations come without a scope table
+        log.info('%s', compilation.scope_table or spl.Analyst(compilation.program_node).analyse_scope())
+    log.info('\nSCOPE CHECK COMPLETE - OUTPUT ABOVE\n')
 
-    parser = spl.Parser(token_list)
-    program_node = parser.run_parser()
-    print('\nPARSER COMPLETED - OUTPUT ABOVE\n')
+    log.info('End of Practical B scope!')
 
-    print('End of Practical A scope!')
+    if arguments.optimise:
+        log.info('\nOPTIMISER MADE %d CHANGES\n', compilation.run_optimiser())
 
-    analyst = spl.Analyst(program_node, token_list)
-    types_list = analyst.check_types()
-    scope_table = analyst.analyse_scope()
-    print('\nSCOPE CHECK COMPLETE - OUTPUT ABOVE\n')
+    if arguments.run:
+        try:
+            compilation.execute(python=arguments.python)
+        except spl.CompilerError as error:
+            report_errors(error)
+        sys.exit(0)
 
-    print('End of Practical B scope!')
+    if arguments.ir:
+        print(compilation.run_ir())
 
-    ast_generator = spl.AstIntermediateGenerator()
-    ast_generator.parent_node = program_node
-    ast_generator.generate_vtable()
-    ast_generator.generate_ftable()
-    ast_generator.generate_code()
+    # Unless the optimiser has changed the program, a cached compilation comes with its BASIC
+    if compilation.code is None:
+        compilation.run_generator()
+    with open(arguments.output, 'w') as output_file:
+        output_file.write(compilation.code)
+    if arguments.open and hasattr(os, 'startfile'):
+        os.startfile(arguments.output)
 
     print('Done!')
-
@@ -1,35 +1,177 @@
 # Imports
+import ast
+import operator
 import os
 import sys
 import re
-import copy
-
-# Token type constants
-TT_NUMBER = 'NUMBER'
-TT_USERDEFINEDNAME = 'USERDEFINEDNAME'
-TT_SHORTSTRING = 'SHORTSTRING'
-TT_LSQUAREBRACKET = 'LSQUAREBRACKET'
-TT_RSQUAREBRACKET = 'RSQUAREBRACKET'
-TT_LBRACE = 'LBRACE'
-TT_RBRACE = 'RBRACE'
-TT_LBRACKET = 'LBRACKET'
-TT_RBRACKET = 'RBRACKET'
-TT_COMMA = 'COMMA'
-TT_SEMICOLON = 'SEMICOLON'
-TT_KEYWORD = 'KEYWORD'
-TT_ASSIGNMENTOPERATOR = 'ASSIGNMENT_OPERATOR'
+import glob
+import time
+import json
+import hashlib
+import logging
+import pickle
+import tempfile
+import threading
+from abc import ABCMeta, abstractmethod
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count, islice, repeat
+
+# Loggers - one per compiler stage. Nothing is emitted until configure_logging is called, and each logging call
+# checks the level before building its message, so the silent default costs next to nothing
+lexer_log = logging.getLogger('spl.lexer')
+parser_log = logging.getLogger('spl.parser')
+analyst_log = logging.getLogger('spl.analyst')
+generator_log = logging.getLogger('spl.generator')
+runner_log = logging.getLogger('spl.runner')
+logging.getLogger('spl').addHandler(logging.NullHandler())
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # Formats each record as one JSON object per line for trace files, keeping the message arguments as fields
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'stage': record.name.rpartition('.')[2],
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if isinstance(record.args, tuple) and record.args:
+            entry['args'] = list(record.args)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=logging.WARNING, trace_path=None):
+    # Sets what the compiler reports:
+    # - level - messages at or above it are printed to stdout (logging.INFO for stage banners and results,
+    #   logging.DEBUG for every token and production as well). The default prints nothing.
+    # - trace_path - if given, every record down to DEBUG is also written to this file as JSON lines
+    # Calling this again replaces the previous configuration.
+    spl_log = logging.getLogger('spl')
+    for handler in list(spl_log.handlers):
+        spl_log.removeHandler(handler)
+        handler.close()
+    spl_log.propagate = False
+    spl_log.setLevel(level)
+    if level < logging.WARNING:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(level)
+        console_handler.setFormatter(logging.Formatter('%(message)s'))
+        spl_log.addHandler(console_handler)
+    if trace_path is not None:
+        trace_handler = logging.FileHandler(trace_path, 'w')
+        trace_handler.setLevel(logging.DEBUG)
+        trace_handler.setFormatter(JsonLinesFormatter())
+        spl_log.addHandler(trace_handler)
+        spl_log.setLevel(logging.DEBUG)
+    if not spl_log.handlers:
+        spl_log.addHandler(logging.NullHandler())
+
+# Compiler errors
+class CompilerError(Exception):
+    # Base class for every error the compiler reports. Errors are raised rather than quitting, so the compiler can
+    # be used from a long-lived process. position is the source offset the error refers to, if known
+    position = None
+
+
+class LexerError(CompilerError):
+    # position is the character offset of the unrecognised text in the source
+    def __init__(self, message, position):
+        super().__init__(message)
+        self.position = position
+
+
+class ParserError(CompilerError):
+    # token identifies where parsing failed, node_class (if known) what was being parsed. The token index and
+    # position are read from the token, so they stay right when IncrementalCompiler moves the token
+    def __init__(self, message, token, node_class=None):
+        super().__init__(message)
+        self.token = token
+        self.node_class = node_class
+
+    @property
+    def token_index(self):
+        return self.token.id if self.token is not None else 0
+
+    @property
+    def position(self):
+        return self.token.start if self.token is not None else None
+
+
+class SemanticError(CompilerError):
+    # token (if known) is the name the error refers to
+    def __init__(self, message, token=None):
+        super().__init__(message)
+        self.token = token
+
+    @property
+    def position(self):
+        return self.token.start if self.token is not None else None
+
+
+class CompilationErrors(CompilerError):
+    # Raised at the end of a stage that carried on past its errors, listing all of them
+    def __init__(self, errors):
+        super().__init__('\n'.join(str(error) for error in errors))
+        self.errors = errors
+
+
+# Token type constants - small ints so that type checks are cheap, with TOKEN_TYPE_NAMES for display
+TT_NUMBER = 0
+TT_USERDEFINEDNAME = 1
+TT_SHORTSTRING = 2
+TT_LSQUAREBRACKET = 3
+TT_RSQUAREBRACKET = 4
+TT_LBRACE = 5
+TT_RBRACE = 6
+TT_LBRACKET = 7
+TT_RBRACKET = 8
+TT_COMMA = 9
+TT_SEMICOLON = 10
+TT_KEYWORD = 11
+TT_ASSIGNMENTOPERATOR = 12
+TOKEN_TYPE_NAMES = ('NUMBER', 'USERDEFINEDNAME', 'SHORTSTRING', 'LSQUAREBRACKET', 'RSQUAREBRACKET', 'LBRACE',
+                    'RBRACE', 'LBRACKET', 'RBRACKET', 'COMMA', 'SEMICOLON', 'KEYWORD', 'ASSIGNMENT_OPERATOR')
 
 # Token convenience constants
 WHITESPACES = ' \t\n'
 KEYWORDS = ['arr', 'sub', 'mult', 'add', 'larger', 'eq', 'or', 'and', 'not',
             'input', 'true', 'false', 'if', 'then', 'else', 'proc', 'main',
-            'return', 'halt', 'num', 'bool', 'string']
-BRACKETED_WORDS = ['and(', 'or(', 'eq(', 'larger(', 'add(', 'sub(', 'mult(', 'input(', 'not(']
-NUMBER_REGEX = '^[0-9]*[.,]{0,1}[0-9]*$'
-SHORT_STRING_REGEX = '^([A-Z][ ][0-9]){0,15}$'
-USER_DEFINED_NAME_REGEX = '[a-z].([a-z] | [0-9])*'
+            'return', 'halt', 'num', 'bool', 'string', 'call', 'output',
+            'do', 'while', 'until']
 BOOLEAN_WORDS = ['true', 'false']
 
+# Single-character tokens, looked up directly by the scanner
+PUNCTUATION_TYPES = {
+    ',': TT_COMMA,
+    ';': TT_SEMICOLON,
+    '(': TT_LBRACKET,
+    ')': TT_RBRACKET,
+    '{': TT_LBRACE,
+    '}': TT_RBRACE,
+    '[': TT_LSQUAREBRACKET,
+    ']': TT_RSQUAREBRACKET,
+}
+
+# Master scanner regex - one alternative per lexical class, tried left to right at each position.
+# Words are split into keywords and user-defined names afterwards with a set lookup.
+TOKEN_REGEX = re.compile(r'''
+    (?P<WHITESPACE>\s+)
+  | (?P<SHORTSTRING>"[A-Z0-9 ]{0,15}")
+  | (?P<NUMBER>-?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))
+  | (?P<WORD>[a-z][a-z0-9]*)
+  | (?P<ASSIGNMENT_OPERATOR>:=)
+  | (?P<PUNCTUATION>[,;(){}\[\]])
+  | (?P<ERROR>.)
+''', re.VERBOSE)
+KEYWORD_SET = frozenset(KEYWORDS)
+# Tokens starting this close to the end of a chunk are held back until the next chunk arrives - long enough for the
+# longest fixed-length token (a 15 character short string plus its quotes)
+MAX_TOKEN_LOOKBACK = 17
+
 
 class Token:
 
@@ -37,16 +179,40 @@ class Token:
     # 1 - the type of token
     # 2 - the contents of the token (i.e., the actual word)
     # 3 - the ID of the token for unique identification purposes
+    # Its source offset is kept in the lexer's token_starts array (indexed by ID), which the token points to, so no
+    # int object is stored per token - the end offset follows from the contents, and Lexer.line_column turns either
+    # into a line and column
+    # Slots keep each token to these fields with no per-instance dict
 
-    def __init__(self, token_type, token_id, contents):
+    __slots__ = ('type', 'contents', 'id', 'starts')
+
+    def __init__(self, token_type, token_id, contents, starts=None):
         self.type = token_type
         self.contents = contents
         self.id = token_id
+        self.starts = starts
+
+    @property
+    def start(self):
+        # Source offset of the first character of the token, or None for tokens made outside the lexer
+        if self.starts is None:
+            return None
+        return self.starts[self.id]
+
+    @property
+    def end(self):
+        if self.starts is None:
+            return None
+        return self.starts[self.id] + len(self.contents)
+
+    def __reduce__(self):
+        # Pickled as a plain constructor call, which is smaller and quicker to load than slot state
+        return Token, (self.type, self.id, self.contents, self.starts)
 
     def __repr__(self):
         if self.contents:
-            return f'{self.type}: {self.contents}, ID: {self.id}'
-        return f'{self.type}'
+            return f'{TOKEN_TYPE_NAMES[self.type]}: {self.contents}, ID: {self.id}'
+        return f'{TOKEN_TYPE_NAMES[self.type]}'
 
 
 # Lexer
@@ -54,177 +220,155 @@ class Lexer:
     def __init__(self, text: str):
         self.text = text
         self.tokens = []
-
-    def break_up_and_split(self, full_text: str):
-        split = full_text.split()
-
-        for full_word in split:
-            if full_word in KEYWORDS:
-                self.tokens.append(Token(TT_KEYWORD, len(self.tokens), full_word))
-                print('Added token ' + full_word + ' of type ' + TT_KEYWORD)
-            elif full_word == ',':
-                self.tokens.append(Token(TT_COMMA, len(self.tokens), ','))
-                print('Added token ' + full_word + ' of type ' + TT_COMMA)
-            elif full_word == ';':
-                self.tokens.append(Token(TT_SEMICOLON, len(self.tokens), ';'))
-                print('Added token ' + full_word + ' of type ' + TT_SEMICOLON)
-            elif full_word == '(':
-                self.tokens.append(Token(TT_LBRACKET, len(self.tokens), '('))
-                print('Added token ' + full_word + ' of type ' + TT_LBRACKET)
-            elif full_word == ')':
-                self.tokens.append(Token(TT_RBRACKET, len(self.tokens), ')'))
-                print('Added token ' + full_word + ' of type ' + TT_RBRACKET)
-            elif full_word == '{':
-                self.tokens.append(Token(TT_LBRACE, len(self.tokens), '{'))
-                print('Added token ' + full_word + ' of type ' + TT_LBRACE)
-            elif full_word == '}':
-                self.tokens.append(Token(TT_RBRACE, len(self.tokens), '}'))
-                print('Added token ' + full_word + ' of type ' + TT_RBRACE)
-            elif full_word == '[':
-                self.tokens.append(Token(TT_LSQUAREBRACKET, len(self.tokens), '['))
-                print('Added token ' + full_word + ' of type ' + TT_LSQUAREBRACKET)
-            elif full_word == ']':
-                self.tokens.append(Token(TT_RSQUAREBRACKET, len(self.tokens), ']'))
-                print('Added token ' + full_word + ' of type ' + TT_RSQUAREBRACKET)
-            elif full_word == ':=':
-                self.tokens.append(Token(TT_ASSIGNMENTOPERATOR, len(self.tokens), ':='))
-                print('Added token ' + full_word + ' of type ' + TT_ASSIGNMENTOPERATOR)
-            elif re.search(NUMBER_REGEX, full_word) is not None:
-                self.tokens.append(Token(TT_NUMBER, len(self.tokens), full_word))
-                print('Added token ' + full_word + ' of type ' + TT_NUMBER)
-            elif re.search(SHORT_STRING_REGEX, full_word) is not None:
-                self.tokens.append(Token(TT_SHORTSTRING, len(self.tokens), full_word))
-                print('Added token ' + full_word + ' of type ' + TT_SHORTSTRING)
-            elif re.search(USER_DEFINED_NAME_REGEX, full_word) is not None:
-                self.tokens.append(Token(TT_USERDEFINEDNAME, len(self.tokens), full_word))
-                print('Added token ' + full_word + ' of type ' + TT_USERDEFINEDNAME)
+        self.num_tokens = 0
+        self.buffer_offset = 0
+        self.errors = []
+        # Source offset just past the last run of unrecognised text, and the errors whose words reached the end of
+        # the last buffer, and the offset of that end - kept here, as runs and words can go on into the next buffer
+        self.error_end = -1
+        self.open_errors = []
+        self.open_errors_end = 0
+        # Offsets at which each line of the source and each token start, filled in while scanning
+        self.line_starts = array('l', [0])
+        self.token_starts = array('l')
+
+    def scan(self, full_text: str):
+        # Single pass over the text using the precompiled master regex - every character is looked at once
+        # and no intermediate list of words is built. Yields tokens in order.
+        yield from self.scan_buffer(full_text, True)
+        self.check_errors()
+
+    def scan_chunks(self, chunks):
+        # Streaming version of scan - takes any iterable of text chunks (e.g. FileReader.get_chunks) and yields
+        # tokens as soon as they are complete, so only the current chunk is ever held in memory
+        pending = ''
+        for chunk in chunks:
+            pending = yield from self.scan_buffer(pending + chunk, False)
+        yield from self.scan_buffer(pending, True)
+        self.check_errors()
+
+    def scan_buffer(self, buffer: str, at_end: bool):
+        # Scans one buffer of text, yielding its tokens. Unless this is the end of the input, a token touching the
+        # end of the buffer might continue in the next chunk, so scanning stops there and the unconsumed tail is
+        # returned for the caller to prepend to the next chunk
+        safe_end = len(buffer) - MAX_TOKEN_LOOKBACK
+        trace = lexer_log.isEnabledFor(logging.DEBUG)
+        if self.open_errors:
+            rest = buffer[self.open_errors_end - self.buffer_offset:]
+            more = rest.split(None, 1)[0] if rest[:1] and not rest[:1].isspace() else ''
+            for error in self.open_errors:
+                error.args = (error.args[0] + more,)
+            if more and more == rest:
+                self.open_errors_end = self.buffer_offset + len(buffer)
             else:
-                self.subdivide(full_word)
-
-    def subdivide(self, full_word):
-        if full_word in BRACKETED_WORDS:
-            fixed_word = full_word[:-1]
-            self.tokens.append(Token(TT_KEYWORD, len(self.tokens), fixed_word))
-            print('Added token ' + fixed_word + ' of type ' + TT_KEYWORD)
-            self.tokens.append(Token(TT_LBRACKET, len(self.tokens), '('))
-        else:
-            self.advanced_subdivide(full_word)
-
-    def advanced_subdivide(self, full_word):
-        word_list = []
-        partial_list = full_word.split('(')
-        for part_word in partial_list:
-            if part_word.contains(')'):
-                partial_list.append(part_word.split(')'))
-                partial_list.remove(part_word)
-        word_list = partial_list
-        if word_list[0] in BINOP_WORDS:
-            self.tokens.append(Token(TT_KEYWORD, len(self.tokens), word_list[0]))
-        elif word_list[0] in ('input', 'not'):
-            self.tokens.append(Token(TT_KEYWORD, len(self.tokens), word_list[0]))
-        if word_list[1] == '(':
-            self.tokens.append(Token(TT_LBRACKET, len(self.tokens), word_list[1]))
-        self.tokens.append(Token(TT_KEYWORD, len(self.tokens), word_list[2]))
-        if word_list[3] == ',':
-            self.tokens.append(Token(TT_COMMA, len(self.tokens), word_list[3]))
-            self.tokens.append(Token(TT_KEYWORD, len(self.tokens), word_list[4]))
-            self.tokens.append(Token(TT_RBRACKET, len(self.tokens), word_list[5]))
-        elif word_list[3] == ')':
-            self.tokens.append(Token(TT_RBRACKET, len(self.tokens), word_list[3]))
-
-
-
-    def break_up(self, full_word):
-        if re.search(NUMBER_REGEX, full_word) is not None:
-            self.tokens.append(Token(TT_NUMBER, len(self.tokens), full_word))
-        elif re.search(SHORT_STRING_REGEX, full_word) is not None:
-            self.tokens.append(Token(TT_SHORTSTRING, len(self.tokens), full_word))
-        elif re.search(USER_DEFINED_NAME_REGEX, full_word) is not None:
-            self.tokens.append(Token(TT_USERDEFINEDNAME, len(self.tokens), full_word))
-        elif full_word in KEYWORDS:
-            self.tokens.append(Token(TT_KEYWORD, len(self.tokens), full_word))
-            exit()
-
-        constructed_word = ''
-        print(full_word)
-        for x in range(0, len(full_word)):
-            print(x)
-            current_char = full_word[x]
-            if constructed_word in KEYWORDS:
-                self.tokens.append(Token(TT_KEYWORD, len(self.tokens), constructed_word))
-                constructed_word = ''
-            elif current_char == ',':
-                self.tokens.append(Token(TT_COMMA, len(self.tokens), ','))
-            elif current_char == ';':
-                self.tokens.append(Token(TT_SEMICOLON, len(self.tokens), ';'))
-            elif current_char == '(':
-                self.tokens.append(Token(TT_LBRACKET, len(self.tokens), '('))
-            elif current_char == ')':
-                self.tokens.append(Token(TT_RBRACKET, len(self.tokens), ')'))
-            elif current_char == '{':
-                self.tokens.append(Token(TT_LBRACE, len(self.tokens), '{'))
-            elif current_char == '}':
-                self.tokens.append(Token(TT_RBRACE, len(self.tokens), '}'))
-            elif current_char == '[':
-                self.tokens.append(Token(TT_LSQUAREBRACKET, len(self.tokens), '['))
-            elif current_char == ']':
-                self.tokens.append(Token(TT_RSQUAREBRACKET, len(self.tokens), ']'))
-            elif current_char == ':' and full_word[x + 1] == '=':
-                self.tokens.append(Token(TT_ASSIGNMENTOPERATOR, len(self.tokens), ':='))
-            elif full_word in KEYWORDS:
-                self.tokens.append(Token(TT_KEYWORD, len(self.tokens), full_word))
-            # Assume there's more word to add and check
-            elif x != len(full_word):
-                constructed_word = constructed_word.join(constructed_word, current_char)
-                print('lexer iteration of x is at: ' + str(x))
-            # Assume there is nothing left to add and check in constructed word - must be complete item
-            elif x == len(full_word):
-                if re.search(NUMBER_REGEX, constructed_word) is not None:
-                    self.tokens.append(Token(TT_NUMBER, len(self.tokens), constructed_word))
-                elif re.search(SHORT_STRING_REGEX, constructed_word) is not None:
-                    self.tokens.append(Token(TT_SHORTSTRING, len(self.tokens), constructed_word))
-                elif re.search(USER_DEFINED_NAME_REGEX, constructed_word) is not None:
-                    self.tokens.append(Token(TT_USERDEFINEDNAME, len(self.tokens), constructed_word))
+                self.open_errors = []
+        for match in TOKEN_REGEX.finditer(buffer):
+            if not at_end and (match.start() >= safe_end or match.end() == len(buffer)):
+                self.buffer_offset += match.start()
+                return buffer[match.start():]
+            kind = match.lastgroup
+            word = match.group()
+            if kind == 'WHITESPACE':
+                newline = word.find('\n')
+                while newline != -1:
+                    self.line_starts.append(self.buffer_offset + match.start() + newline + 1)
+                    newline = word.find('\n', newline + 1)
+                continue
+            elif kind == 'WORD':
+                # Names repeat throughout a program, so all tokens share one string per distinct word
+                word = sys.intern(word)
+                token_type = TT_KEYWORD if word in KEYWORD_SET else TT_USERDEFINEDNAME
+            elif kind == 'PUNCTUATION':
+                word = sys.intern(word)
+                token_type = PUNCTUATION_TYPES[word]
+            elif kind == 'NUMBER':
+                token_type = TT_NUMBER
+            elif kind == 'SHORTSTRING':
+                token_type = TT_SHORTSTRING
+            elif kind == 'ASSIGNMENT_OPERATOR':
+                token_type = TT_ASSIGNMENTOPERATOR
             else:
-                print('Lexer error!')
-                print('UNRECOGNISED WORD: ' + full_word)
-                quit()
+                # Unrecognised text is reported once per run of bad characters and skipped
+                if self.buffer_offset + match.start() != self.error_end:
+                    self.lexer_error(buffer, match.start())
+                self.error_end = self.buffer_offset + match.end()
+                continue
+            if trace:
+                lexer_log.debug('Added token %s of type %s', word, TOKEN_TYPE_NAMES[token_type])
+            self.token_starts.append(self.buffer_offset + match.start())
+            yield Token(token_type, self.num_tokens, word, self.token_starts)
+            self.num_tokens += 1
+        self.buffer_offset += len(buffer)
+        return ''
+
+    def lexer_error(self, full_text, position):
+        word = full_text[position:].split(None, 1)[0]
+        message = 'Lexer error! UNRECOGNISED WORD: ' + word
+        lexer_log.debug(message)
+        self.errors.append(LexerError(message, self.buffer_offset + position))
+        if position + len(word) == len(full_text):
+            self.open_errors.append(self.errors[-1])
+            self.open_errors_end = self.buffer_offset + len(full_text)
+
+    def line_column(self, offset):
+        # Converts a source offset (e.g. Token.start or Node.start) to a 1-based (line, column) pair
+        line = bisect_right(self.line_starts, offset)
+        return line, offset - self.line_starts[line - 1] + 1
+
+    def check_errors(self):
+        # Lexing carries on past unrecognised text, so that every bad word is reported in one go at the end
+        if self.errors:
+            raise CompilationErrors(self.errors)
 
     def run_lexer(self):
-        self.break_up_and_split(self.text)
-        print('\nLEXER OUTPUT:')
-        for token in self.tokens:
-            print(token)
+        self.tokens.extend(self.scan(self.text))
+        if lexer_log.isEnabledFor(logging.INFO):
+            lexer_log.info('\nLEXER OUTPUT:')
+            for token in self.tokens:
+                lexer_log.info('%s', token)
         return self.tokens
 
-
-# Node type constants
-NT_SPLPROGRAM = 'SPLProgram'
-NT_PROCDEFS = 'ProcedureDefinitions'
-NT_ALGORITHM = 'Algorithm'
-NT_ALTERNAT = 'Alternat'
-NT_TYP = 'TYP'
-NT_VAR = 'Var'
-NT_CONST = 'Const'
-NT_LHS = 'LHS'
-NT_LOOP = 'Loop'
-NT_EXPR = 'Expr'
-NT_PCALL = 'PCall'
-NT_FIELD = 'Field'
-NT_UNOP = 'UnOp'
-NT_BINOP = 'BinOp'
-NT_DEC = 'Dec'
-NT_VARDECL = 'VarDecl'
-NT_KEYWORD = 'Keyword'
-NT_USERDEFINEDNAME = 'UserDefinedName'
-NT_PD = 'PD'
-NT_INSTR = 'Instruction'
-NT_ASSIGN = 'Assignment'
-NT_BRANCH = 'Branch'
+    def stream_lexer(self, chunks):
+        # Returns a lazy token iterator over the given text chunks for Parser to pull from - self.tokens is not
+        # filled in, so neither the full text nor the full token list is ever held
+        return self.scan_chunks(chunks)
+
+
+# Node type constants - small ints like the token types, with NODE_CLASS_NAMES for display
+NT_SPLPROGRAM = 0
+NT_PROCDEFS = 1
+NT_ALGORITHM = 2
+NT_ALTERNAT = 3
+NT_TYP = 4
+NT_VAR = 5
+NT_CONST = 6
+NT_LHS = 7
+NT_LOOP = 8
+NT_EXPR = 9
+NT_PCALL = 10
+NT_FIELD = 11
+NT_UNOP = 12
+NT_BINOP = 13
+NT_DEC = 14
+NT_VARDECL = 15
+NT_KEYWORD = 16
+NT_USERDEFINEDNAME = 17
+NT_PD = 18
+NT_INSTR = 19
+NT_ASSIGN = 20
+NT_BRANCH = 21
+NODE_CLASS_NAMES = ('SPLProgram', 'ProcedureDefinitions', 'Algorithm', 'Alternat', 'TYP', 'Var', 'Const', 'LHS',
+                    'Loop', 'Expr', 'PCall', 'Field', 'UnOp', 'BinOp', 'Dec', 'VarDecl', 'Keyword', 'UserDefinedName',
+                    'PD', 'Instruction', 'Assignment', 'Branch')
 
 # Node convenience constants
 TYP_WORDS = ['num', 'bool', 'string']
 BINOP_WORDS = ['and', 'or', 'eq', 'larger', 'add', 'sub', 'mult']
+UNOP_WORDS = ['input', 'not']
+DEC_START_WORDS = TYP_WORDS + ['arr']
+INSTR_START_WORDS = ['output', 'if', 'do', 'while', 'call']
+# Classes of the leaf nodes - made from a single token, never with children
+LEAF_NODE_CLASSES = frozenset([NT_KEYWORD, NT_USERDEFINEDNAME, NT_TYP, NT_VAR, NT_CONST])
 
 
 class Node:
@@ -232,82 +376,173 @@ class Node:
     # - ID (number, incremented for each node added)
     # - Node class (String, descriptor of node type)
     # - Node contents (Array of sub-nodes if parent node, or pointer to token if leaf)
-    def __init__(self, node_id, node_class, node_contents):
+    # - First and last tokens of the source the node covers, giving its span without storing any offsets. These
+    #   come from the contents, unless the parser passes them in - the last token when the node ends on punctuation
+    #   that isn't a child (e.g. the ) of a BinOp), the first when error recovery dropped the leading children
+    __slots__ = ('node_id', 'node_class', 'node_contents', 'first_token', 'last_token')
+
+    def __init__(self, node_id, node_class, node_contents, last_token=None, first_token=None):
         self.node_id = node_id
         self.node_class = node_class
         self.node_contents = node_contents
+        self.first_token = first_token
+        self.last_token = last_token
+        if first_token is not None and last_token is not None:
+            return
+        if isinstance(node_contents, Token):
+            self.first_token = self.first_token or node_contents
+            self.last_token = self.last_token or node_contents
+        elif isinstance(node_contents, list):
+            children = [child for child in node_contents if child is not None]
+            if children:
+                self.first_token = self.first_token or children[0].first_token
+                self.last_token = self.last_token or children[-1].last_token
 
     def __repr__(self):
-        return f'\n{self.node_id}:{self.node_class}:{self.node_contents}'
+        # Same text as formatting each node as f'\n{node_id}:{class}:{node_contents}', but built with an explicit
+        # stack rather than by recursing through the children's reprs, so that deep trees can be printed
+        parts = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+            elif isinstance(item, Node) and item.has_children():
+                parts.append(f'\n{item.node_id}:{NODE_CLASS_NAMES[item.node_class]}:[')
+                stack.append(']')
+                for index in range(len(item.node_contents) - 1, -1, -1):
+                    stack.append(item.node_contents[index])
+                    if index:
+                        stack.append(', ')
+            elif isinstance(item, Node):
+                parts.append(f'\n{item.node_id}:{NODE_CLASS_NAMES[item.node_class]}:{item.node_contents}')
+            else:
+                parts.append(repr(item))
+        return ''.join(parts)
 
     def has_children(self):
         return isinstance(self.node_contents, list)
 
+    def __reduce__(self):
+        # Pickled as a plain constructor call, like Token
+        return Node, (self.node_id, self.node_class, self.node_contents, self.last_token, self.first_token)
+
+    @property
+    def start(self):
+        # Source offset of the first character of the node, or None for nodes made outside the parser
+        return self.first_token.start if self.first_token is not None else None
+
+    @property
+    def end(self):
+        # Source offset just after the last character of the node
+        return self.last_token.end if self.last_token is not None else None
+
 
 class Parser:
-    def __init__(self, tokens: list):
-        self.tokens = tokens
-        self.token_index = -1
+    def __init__(self, tokens, first_index=0):
+        # tokens can be a full list from Lexer.run_lexer, or a lazy iterator from Lexer.stream_lexer - either way
+        # tokens are pulled one at a time, and only the small lookahead window below is buffered
+        # first_index is the index of the first token, when parsing starts partway through a program
+        self.tokens = tokens if isinstance(tokens, list) else None
+        self.token_source = iter(tokens)
+        self.lookahead = deque()
+        self.token_index = first_index - 1
         self.current_token = None
+        self.previous_token = None
+        self.at_end = False
+        self.errors = []
+        self.program_node = None
+        # PDs already parsed elsewhere, as encode_procedure lists by the index of their first token, which PD adopts
+        # rather than parsing their tokens again (see Compilation.run_parallel). Once adopted, a PD's list is
+        # replaced by its nodes in preorder
+        self.procedures = None
         self.advance()
         self.num_nodes = 0
 
     def advance(self):
         # print('Advancing through tokens list...')
         self.token_index += 1
-        if self.token_index < len(self.tokens):
-            self.current_token = self.tokens[self.token_index]
+        self.previous_token = self.current_token
+        if self.lookahead:
+            self.current_token = self.lookahead.popleft()
+        else:
+            # At the end of the tokens the last token is kept as the current one
+            token = next(self.token_source, None)
+            if token is None:
+                self.at_end = True
+            else:
+                self.current_token = token
+
+    def peek_token(self, offset=1):
+        # Returns the token offset places after the current one (0 being the current token itself) without consuming
+        # or copying anything, or None past the end of the tokens
+        if offset == 0:
+            return None if self.at_end else self.current_token
+        while len(self.lookahead) < offset:
+            token = next(self.token_source, None)
+            if token is None:
+                return None
+            self.lookahead.append(token)
+        return self.lookahead[offset - 1]
+
+    def check_token(self, token_type, contents=None, offset=0):
+        # Lookahead test for choosing between productions, e.g. check_token(TT_KEYWORD, 'proc') - contents is only
+        # compared when given
+        token = self.peek_token(offset)
+        return token is not None and token.type == token_type and (contents is None or token.contents == contents)
 
     def Keyword(self):
-        print('Adding Keyword: ' + self.current_token.contents)
+        parser_log.debug('Adding Keyword: %s', self.current_token.contents)
         # Leaf node
         token = self.current_token
-        if token.type == TT_KEYWORD:
+        if self.check_token(TT_KEYWORD):
             self.advance()
             self.num_nodes += 1
-            return Node(self.num_nodes, NT_KEYWORD, token)
+            return Node(self.num_nodes, NT_KEYWORD, token, self.previous_token)
         else:
-            self.parser_error()
+            self.parser_error(NT_KEYWORD)
 
     def UserDefinedName(self):
-        print('Adding UserDefinedName')
+        parser_log.debug('Adding UserDefinedName')
         # Leaf node
         token = self.current_token
-        if token.type == TT_USERDEFINEDNAME:
+        if self.check_token(TT_USERDEFINEDNAME):
             self.advance()
             self.num_nodes += 1
-            return Node(self.num_nodes, NT_USERDEFINEDNAME, token)
+            return Node(self.num_nodes, NT_USERDEFINEDNAME, token, self.previous_token)
 
     def TYP(self):
-        print('Adding TYP')
+        parser_log.debug('Adding TYP')
         # Leaf node
         token = self.current_token
-        if token.type == TT_KEYWORD and token.contents in TYP_WORDS:
+        if self.check_token(TT_KEYWORD) and token.contents in TYP_WORDS:
             self.advance()
             self.num_nodes += 1
-            return Node(self.num_nodes, NT_TYP, token)
+            return Node(self.num_nodes, NT_TYP, token, self.previous_token)
 
     def Var(self):
-        print('Adding Var')
+        parser_log.debug('Adding Var')
         # Leaf node
         token = self.current_token
-        if token.type == TT_USERDEFINEDNAME:
+        if self.check_token(TT_USERDEFINEDNAME):
             self.advance()
             self.num_nodes += 1
-            new_node = Node(self.num_nodes, NT_VAR, token)
+            new_node = Node(self.num_nodes, NT_VAR, token, self.previous_token)
             return new_node
 
     def Const(self):
-        print('Adding Const')
+        parser_log.debug('Adding Const')
         # Leaf node
         token = self.current_token
+        if self.at_end:
+            return None
         if token.type in (TT_NUMBER, TT_SHORTSTRING) or (token.type == TT_KEYWORD and token.contents in BOOLEAN_WORDS):
             self.advance()
             self.num_nodes += 1
-            return Node(self.num_nodes, NT_TYP, token)
+            return Node(self.num_nodes, NT_CONST, token, self.previous_token)
 
     def Dec(self):
-        print('Adding Dec')
+        parser_log.debug('Adding Dec')
         # Compound node
 
         # Branching based on two possible Dec types:
@@ -319,36 +554,35 @@ class Parser:
         # 2 - TYP Var
 
         children = []
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'arr':
-            print('Adding array')
+        if self.check_token(TT_KEYWORD, 'arr'):
+            parser_log.debug('Adding array')
             children.append(self.Keyword())
             children.append(self.TYP())
-            if self.current_token.type == TT_LSQUAREBRACKET:
+            if children[-1] is not None and self.check_token(TT_LSQUAREBRACKET):
                 self.advance()
                 children.append(self.Const())
-                if self.current_token.type == TT_RSQUAREBRACKET:
+                if children[-1] is not None and self.check_token(TT_RSQUAREBRACKET):
                     self.advance()
                     children.append(self.Var())
-                    self.num_nodes += 1
-                    return Node(self.num_nodes, NT_DEC, children)
-        elif self.current_token.type == TT_KEYWORD and self.current_token.contents in TYP_WORDS:
+                    if children[-1] is not None:
+                        self.num_nodes += 1
+                        return Node(self.num_nodes, NT_DEC, children, self.previous_token)
+        elif self.check_token(TT_KEYWORD) and self.current_token.contents in TYP_WORDS:
             # print('Adding normal TYP VAR')
             children.append(self.TYP())
             # print('Added TYP in Dec')
             children.append(self.Var())
             # print('Added Var in Dec')
-            self.num_nodes += 1
-            print('Exiting Dec')
-            return Node(self.num_nodes, NT_DEC, children)
+            if children[-1] is not None:
+                self.num_nodes += 1
+                parser_log.debug('Exiting Dec')
+                return Node(self.num_nodes, NT_DEC, children, self.previous_token)
         else:
-            print('No type entered!')
-            self.parser_error()
-
-    vardec_recursion_layer = -1
+            parser_log.debug('No type entered!')
+        self.parser_error(NT_DEC)
 
     def VarDecl(self):
-        self.vardec_recursion_layer += 1
-        # print('Adding VarDecl - current recursion layer = ' + self.vardec_recursion_layer.__str__())
+        parser_log.debug('Adding VarDecl')
         # Compound node
 
         # Branching because nullable
@@ -356,29 +590,35 @@ class Parser:
         # 2 - nothing
 
         # Children structure:
-        # [1] - Declaration
-        # [2] - Variable Declaration
+        # Every declaration in order - the grammar's right-recursive chain is kept flat, and read in a loop, so that
+        # long programs aren't limited by Python's recursion limit and passes can loop over the declarations
 
-        children = []
-        if self.current_token.contents not in TYP_WORDS:
+        if not self.check_token(TT_KEYWORD) or self.current_token.contents not in DEC_START_WORDS:
             return None
 
-        dec = self.Dec()
-        if dec is not None:
-            # print('Appending Dec to VarDecl children')
-            children.append(dec)
-            # print('Present token: ' + self.current_token.type + ': ' + self.current_token.contents)
-            if self.current_token.type == TT_KEYWORD and self.current_token.contents in TYP_WORDS:
-                print('Recursively adding more variable declarations...')
-                if self.current_token.contents in TYP_WORDS:
-                    children.append(self.VarDecl())
-                self.num_nodes += 1
-                # print('Exiting VarDecl via return of Node - exiting layer: ' + self.vardec_recursion_layer.__str__())
-                self.vardec_recursion_layer -= 1
-                return Node(self.num_nodes, NT_VARDECL, children)
+        children = []
+        first_token = self.current_token
+        while self.check_token(TT_KEYWORD) and self.current_token.contents in DEC_START_WORDS:
+            # Error recovery - a bad declaration is skipped up to the next ; and parsing carries on from there
+            try:
+                dec = self.Dec()
+                if not self.check_token(TT_SEMICOLON):
+                    self.parser_error(NT_VARDECL)
+            except ParserError as error:
+                if not self.recover(error):
+                    break
+                dec = None
+            self.advance()
+            if dec is not None:
+                children.append(dec)
+
+        if not children:
+            return None
+        self.num_nodes += 1
+        return Node(self.num_nodes, NT_VARDECL, children, self.previous_token, first_token)
 
     def BinOp(self):
-        print('Adding BinOp')
+        parser_log.debug('Adding BinOp')
         # Compound node
 
         # No branching
@@ -389,23 +629,24 @@ class Parser:
         # Expression child node for second argument
 
         children = []
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents in BINOP_WORDS:
+        if self.check_token(TT_KEYWORD) and self.current_token.contents in BINOP_WORDS:
             children.append(self.Keyword())
-            if self.current_token.type == TT_LBRACKET:
+            if self.check_token(TT_LBRACKET):
                 self.advance()
                 children.append(self.Expr())
-                if self.current_token.type == TT_COMMA:
+                if self.check_token(TT_COMMA):
                     self.advance()
                     children.append(self.Expr())
-                    if self.current_token.type == TT_RSQUAREBRACKET:
+                    if self.check_token(TT_RBRACKET):
+                        self.advance()
                         self.num_nodes += 1
-                        return Node(self.num_nodes, NT_BINOP, children)
+                        return Node(self.num_nodes, NT_BINOP, children, self.previous_token)
 
-        self.parser_error()
+        self.parser_error(NT_BINOP)
         return None
 
     def UnOp(self):
-        print('Adding UnOp')
+        parser_log.debug('Adding UnOp')
         # Compound node
 
         # Branching based on which operator
@@ -418,26 +659,26 @@ class Parser:
         # Expr child node if branch 2
 
         children = []
-        if self.current_token.type == TT_KEYWORD:
+        if self.check_token(TT_KEYWORD) and self.current_token.contents in UNOP_WORDS:
             # Save the operator for branching
             operator = self.current_token.contents
             children.append(self.Keyword())
-            if self.current_token.type == TT_LBRACKET:
+            if self.check_token(TT_LBRACKET):
                 self.advance()
                 if operator == 'input':  # Branch 1
                     children.append(self.Var())
                 elif operator == 'not':  # Branch 2
                     children.append(self.Expr())
-                self.num_nodes += 1
-                return Node(self.num_nodes, NT_UNOP, children)
-            else:
-                self.parser_error()
-        else:
-            self.parser_error()
-            return None
+                if children[-1] is not None and self.check_token(TT_RBRACKET):
+                    self.advance()
+                    self.num_nodes += 1
+                    return Node(self.num_nodes, NT_UNOP, children, self.previous_token)
+
+        self.parser_error(NT_UNOP)
+        return None
 
     def Field(self):
-        print('Adding Field')
+        parser_log.debug('Adding Field')
         # Compound node
 
         # Branching based on Variable or Constant or just name
@@ -450,27 +691,24 @@ class Parser:
         # Const child node if branch 2
 
         children = []
-        if self.current_token.type == TT_USERDEFINEDNAME:
-            self.num_nodes += 1
+        if self.check_token(TT_USERDEFINEDNAME):
             children.append(self.UserDefinedName())
-            self.advance()
-            if self.current_token.type == TT_LSQUAREBRACKET:
-                children.append(self.Var())
-                if self.current_token.type == TT_RSQUAREBRACKET:
-                    self.num_nodes += 1
-                    return Node(self.num_nodes, NT_FIELD, children)
+            if self.check_token(TT_LSQUAREBRACKET):
+                self.advance()
+                if self.check_token(TT_USERDEFINEDNAME):
+                    children.append(self.Var())
                 else:
-                    self.parser_error()
-                    return None
-            else:
-                self.parser_error()
-                return None
-        else:
-            self.parser_error()
-            return None
+                    children.append(self.Const())
+                if children[-1] is not None and self.check_token(TT_RSQUAREBRACKET):
+                    self.advance()
+                    self.num_nodes += 1
+                    return Node(self.num_nodes, NT_FIELD, children, self.previous_token)
+
+        self.parser_error(NT_FIELD)
+        return None
 
     def PCall(self):
-        print('Adding PCall')
+        parser_log.debug('Adding PCall')
         # Compound node
 
         # No branching
@@ -481,28 +719,24 @@ class Parser:
 
         children = []
 
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'call':
+        if self.check_token(TT_KEYWORD, 'call'):
             children.append(self.Keyword())
-            self.advance()
-            if self.current_token.type == TT_USERDEFINEDNAME:
+            if self.check_token(TT_USERDEFINEDNAME):
                 children.append(self.Var())
                 self.num_nodes += 1
-                return Node(self.num_nodes, NT_PCALL, children)
-            else:
-                self.parser_error()
-                return None
-        else:
-            self.parser_error()
-            return None
+                return Node(self.num_nodes, NT_PCALL, children, self.previous_token)
+
+        self.parser_error(NT_PCALL)
+        return None
 
     def Expr(self):
-        print('Adding Expr')
+        parser_log.debug('Adding Expr')
         # Compound node
 
-        # Branching based on which node type the expression consists of
+        # Branching based on which node type the expression consists of, decided by the current token
         # 1 - Const
         # 2 - Var
-        # 3 - Field
+        # 3 - Field (a name followed by [)
         # 4 - UnOp
         # 5 - BinOp
 
@@ -511,41 +745,26 @@ class Parser:
 
         children = []
 
-        const = self.Const()
-        if const is not None:
-            children.append(const)
-            self.num_nodes += 1
-            return Node(self.num_nodes, NT_EXPR, children)
-        else:
-            var = self.Var()
-            if var is not None:
-                children.append(var)
-                self.num_nodes += 1
-                return Node(self.num_nodes, NT_EXPR, children)
+        if self.check_token(TT_USERDEFINEDNAME):
+            if self.check_token(TT_LSQUAREBRACKET, offset=1):
+                children.append(self.Field())
             else:
-                field = self.Field()
-                if field is not None:
-                    children.append(field)
-                    self.num_nodes += 1
-                    return Node(self.num_nodes, NT_EXPR, children)
-                else:
-                    unop = self.UnOp()
-                    if unop is not None:
-                        children.append(unop)
-                        self.num_nodes += 1
-                        return Node(self.num_nodes, NT_EXPR, children)
-                    else:
-                        binop = self.BinOp()
-                        if binop is not None:
-                            children.append(binop)
-                            self.num_nodes += 1
-                            return Node(self.num_nodes, NT_EXPR, children)
-                        else:
-                            self.parser_error()
-                            return None
+                children.append(self.Var())
+        elif self.check_token(TT_KEYWORD) and self.current_token.contents in UNOP_WORDS:
+            children.append(self.UnOp())
+        elif self.check_token(TT_KEYWORD) and self.current_token.contents in BINOP_WORDS:
+            children.append(self.BinOp())
+        else:
+            const = self.Const()
+            if const is None:
+                self.parser_error(NT_EXPR)
+            children.append(const)
+
+        self.num_nodes += 1
+        return Node(self.num_nodes, NT_EXPR, children, self.previous_token)
 
     def LHS(self):
-        print('Adding LHS')
+        parser_log.debug('Adding LHS')
         # Compound node
 
         # Branching based on types
@@ -560,23 +779,23 @@ class Parser:
 
         token = self.current_token
         children = []
-        if token.type == TT_KEYWORD and token.contents == 'output':
+        if self.check_token(TT_KEYWORD, 'output'):
             self.num_nodes += 1
             self.advance()
-            return Node(self.num_nodes, NT_LHS, token)
-        elif token.type == TT_USERDEFINEDNAME:
-            if self.tokens[self.token_index + 1].type == TT_LSQUAREBRACKET:
+            return Node(self.num_nodes, NT_LHS, token, self.previous_token)
+        elif self.check_token(TT_USERDEFINEDNAME):
+            if self.check_token(TT_LSQUAREBRACKET, offset=1):
                 children.append(self.Field())
             else:
                 children.append(self.Var())
             self.num_nodes += 1
-            return Node(self.num_nodes, NT_LHS, children)
+            return Node(self.num_nodes, NT_LHS, children, self.previous_token)
         else:
-            self.parser_error()
+            self.parser_error(NT_LHS)
             return None
 
     def Loop(self):
-        print('Adding loop')
+        parser_log.debug('Adding loop')
         # Compound node
 
         # Branching:
@@ -592,46 +811,48 @@ class Parser:
         children = []
 
         # Branch 1
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'do':
+        if self.check_token(TT_KEYWORD, 'do'):
             children.append(self.Keyword())
-            if self.current_token.type == TT_LBRACE:
+            if self.check_token(TT_LBRACE):
                 self.advance()
                 children.append(self.Algorithm())
-                if self.current_token.type == TT_RBRACE:
+                if self.check_token(TT_RBRACE):
                     self.advance()
-                    if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'until':
+                    if self.check_token(TT_KEYWORD, 'until'):
                         children.append(self.Keyword())
-                        if self.current_token.type == TT_RBRACKET:
+                        if self.check_token(TT_LBRACKET):
                             self.advance()
                             children.append(self.Expr())
-                            if self.current_token.type == TT_LBRACKET:
+                            if self.check_token(TT_RBRACKET):
+                                self.advance()
                                 self.num_nodes += 1
-                                return Node(self.num_nodes, NT_LOOP, children)
-        elif True:
-            if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'while':
-                children.append(self.Keyword())
-                if self.current_token.type == TT_LBRACKET:
+                                return Node(self.num_nodes, NT_LOOP, children, self.previous_token)
+        # Branch 2
+        elif self.check_token(TT_KEYWORD, 'while'):
+            children.append(self.Keyword())
+            if self.check_token(TT_LBRACKET):
+                self.advance()
+                children.append(self.Expr())
+                if self.check_token(TT_RBRACKET):
                     self.advance()
-                    children.append(self.Expr())
-                    if self.current_token.type == TT_RBRACKET:
-                        self.advance()
-                        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'do':
-                            children.append(self.Keyword())
-                            if self.current_token.type == TT_LBRACE:
+                    if self.check_token(TT_KEYWORD, 'do'):
+                        children.append(self.Keyword())
+                        if self.check_token(TT_LBRACE):
+                            self.advance()
+                            children.append(self.Algorithm())
+                            if self.check_token(TT_RBRACE):
                                 self.advance()
-                                children.append(self.Algorithm())
-                                if self.current_token.type == TT_RBRACE:
-                                    self.num_nodes += 1
-                                    return Node(self.num_nodes, NT_LOOP, children)
+                                self.num_nodes += 1
+                                return Node(self.num_nodes, NT_LOOP, children, self.previous_token)
 
         # lazy approach to error handling is okay here - if not returning, will throw error,
         # i.e. will reach this parser_error() at the bottom
 
-        self.parser_error()
+        self.parser_error(NT_LOOP)
         return None
 
     def Alternat(self):
-        print('Adding alternat')
+        parser_log.debug('Adding alternat')
         # Compound node
 
         # Branch on nullable
@@ -641,20 +862,21 @@ class Parser:
 
         children = []
 
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'else':
+        if self.check_token(TT_KEYWORD, 'else'):
             children.append(self.Keyword())
-            if self.current_token.type == TT_LBRACE:
+            if self.check_token(TT_LBRACE):
                 self.advance()
-                children.append(self.Algorithm())  # lazy!! don't be like this! do error checking!
-                if self.current_token.type == TT_RBRACE:
+                children.append(self.Algorithm())
+                if self.check_token(TT_RBRACE):
+                    self.advance()
                     self.num_nodes += 1
-                    return Node(self.num_nodes, NT_ALTERNAT, children)
-            self.parser_error()
+                    return Node(self.num_nodes, NT_ALTERNAT, children, self.previous_token)
+            self.parser_error(NT_ALTERNAT)
         else:
-            pass
+            return None
 
     def Branch(self):
-        print('Adding branch')
+        parser_log.debug('Adding branch')
         # Compound node
 
         # No branching
@@ -664,25 +886,28 @@ class Parser:
 
         children = []
 
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'if':
+        if self.check_token(TT_KEYWORD, 'if'):
             children.append(self.Keyword())
-            if self.current_token.type == TT_LBRACKET:
+            if self.check_token(TT_LBRACKET):
                 self.advance()
-                if self.current_token.type == TT_RBRACKET:
+                children.append(self.Expr())
+                if self.check_token(TT_RBRACKET):
                     self.advance()
-                    if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'then':
+                    if self.check_token(TT_KEYWORD, 'then'):
                         children.append(self.Keyword())
-                        if self.current_token.type == TT_LBRACE:
+                        if self.check_token(TT_LBRACE):
                             self.advance()
                             children.append(self.Algorithm())
-                            if self.current_token.type == TT_RBRACE:
+                            if self.check_token(TT_RBRACE):
                                 self.advance()
                                 children.append(self.Alternat())
+                                self.num_nodes += 1
+                                return Node(self.num_nodes, NT_BRANCH, children, self.previous_token)
 
-        self.parser_error()
+        self.parser_error(NT_BRANCH)
 
     def Assign(self):
-        print('Adding assignment')
+        parser_log.debug('Adding assignment')
 
         # Compound node
 
@@ -694,16 +919,16 @@ class Parser:
         children = []
 
         children.append(self.LHS())
-        if self.current_token.type == TT_ASSIGNMENTOPERATOR:
+        if self.check_token(TT_ASSIGNMENTOPERATOR):
             self.advance()
             children.append(self.Expr())
             self.num_nodes += 1
-            return Node(self.num_nodes, NT_ASSIGN, children)
-        self.parser_error()
+            return Node(self.num_nodes, NT_ASSIGN, children, self.previous_token)
+        self.parser_error(NT_ASSIGN)
         return None
 
     def Instr(self):
-        print('Adding Instruction')
+        parser_log.debug('Adding Instruction')
         # Compound node
 
         # Branching:
@@ -714,76 +939,65 @@ class Parser:
 
         # Children:
         # Whichever branch is taken is the only child
-        # Can return None for ease of working Algorithm
 
         children = []
 
-        if self.current_token.type == TT_USERDEFINEDNAME or (
-                self.current_token.type == TT_KEYWORD and self.current_token.contents == 'output'):
+        if self.check_token(TT_USERDEFINEDNAME) or self.check_token(TT_KEYWORD, 'output'):
             children.append(self.Assign())
-            self.num_nodes += 1
-            print('Exiting instruction')
-            return Node(self.num_nodes, NT_INSTR, children)
-        elif self.current_token.type == TT_KEYWORD and self.current_token.contents == 'if':
+        elif self.check_token(TT_KEYWORD, 'if'):
             children.append(self.Branch())
-            self.num_nodes += 1
-            print('Exiting instruction')
-            return Node(self.num_nodes, NT_INSTR, children)
-        elif self.current_token.type == TT_KEYWORD and self.current_token.contents in ('do', 'loop'):
+        elif self.check_token(TT_KEYWORD, 'do') or self.check_token(TT_KEYWORD, 'while'):
             children.append(self.Loop())
-            self.num_nodes += 1
-            print('Exiting instruction')
-            return Node(self.num_nodes, NT_INSTR, children)
-        elif self.current_token.type == TT_KEYWORD and self.current_token.contents == 'call':
+        elif self.check_token(TT_KEYWORD, 'call'):
             children.append(self.PCall())
-            self.num_nodes += 1
-            print('Exiting instruction')
-            return Node(self.num_nodes, NT_INSTR, children)
+        else:
+            self.parser_error(NT_INSTR)
 
-        self.parser_error()
+        self.num_nodes += 1
+        parser_log.debug('Exiting instruction')
+        return Node(self.num_nodes, NT_INSTR, children, self.previous_token)
 
     def Algorithm(self):
-        print('Adding Algorithm')
+        parser_log.debug('Adding Algorithm')
         # Compound
 
         # Branching based on nullable
 
         # Children:
-        # Instr Algorithm
+        # Every instruction in order, kept flat like VarDecl
 
-        children = []
+        # So if there is likely to be an instruction type
+        if not self.check_token(TT_USERDEFINEDNAME) and not (
+                self.check_token(TT_KEYWORD) and self.current_token.contents in INSTR_START_WORDS):
+            parser_log.debug('Algorithm null')
+            return None
 
-        if self.current_token.type == TT_KEYWORD:
-            # So if there is likely to be an instruction type
-            if self.current_token.contents in ('do', 'loop', 'call', 'if'):
-
-                if self.current_token.contents == 'do':
-                    children.append(Node(0, NT_LOOP), None)
-                elif self.current_token.contents == 'loop':
-                    children.append(Node(0, NT_LOOP), None)
-                elif self.current_token.contents == 'call':
-                    children.append(Node(0, NT_PCALL), None)
-                elif self.current_token.contents == 'if':
-                    children.append(Node(0, NT_BRANCH), None)
-
-                children.append(self.Instr())
-                if self.current_token.type == TT_SEMICOLON:
-                    self.advance()
-                    children.append(self.Algorithm())
-                    self.num_nodes += 1
-                    return Node(self.num_nodes, NT_ALGORITHM, children)
-        else:
-            print('Algorithm is assignment operation')
-            children.append(self.Assign())
-            self.num_nodes += 1
-            print('Exiting algorithm')
-            return Node(self.num_nodes, NT_ALGORITHM, children)
+        children = []
+        first_token = self.current_token
+        while self.check_token(TT_USERDEFINEDNAME) or (
+                self.check_token(TT_KEYWORD) and self.current_token.contents in INSTR_START_WORDS):
+            # Error recovery - a bad instruction is skipped up to the next ; and parsing carries on from there
+            try:
+                instr = self.Instr()
+                if not self.check_token(TT_SEMICOLON):
+                    self.parser_error(NT_ALGORITHM)
+            except ParserError as error:
+                if not self.recover(error):
+                    break
+                instr = None
+            self.advance()
+            if instr is not None:
+                children.append(instr)
 
-        print('Algorithm null')
+        if not children:
+            return None
+        self.num_nodes += 1
+        parser_log.debug('Exiting algorithm')
+        return Node(self.num_nodes, NT_ALGORITHM, children, self.previous_token, first_token)
 
     def PD(self):
-        print('Adding PD')
-        print('Current token: ' + self.current_token.type + ':' + self.current_token.contents)
+        parser_log.debug('Adding PD')
+        parser_log.debug('Current token: %s:%s', TOKEN_TYPE_NAMES[self.current_token.type], self.current_token.contents)
         # Compound
 
         # No branching - just:
@@ -792,65 +1006,121 @@ class Parser:
         # Children:
         # Keyword Var ProcDefs Algorithm Keyword VarDecl
 
+        if self.procedures is not None and self.token_index in self.procedures:
+            return self.adopt(self.procedures[self.token_index])
+
         children = []
 
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'proc':
+        if self.check_token(TT_KEYWORD, 'proc'):
             children.append(self.Keyword())
-            if self.current_token.type == TT_USERDEFINEDNAME:
+            if self.check_token(TT_USERDEFINEDNAME):
                 children.append(self.Var())
-                if self.current_token.type == TT_LBRACE:
+                if self.check_token(TT_LBRACE):
                     self.advance()
                     # print('PD adding own ProcDefs now')
                     children.append(self.ProcDefs())
                     # print('PD ProcDefs done! Entering PD Algorithm')
                     children.append(self.Algorithm())
                     # print('ProcDefs and Algorithm done in PD... moving on to return value!')
-                    if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'return':
+                    if self.check_token(TT_KEYWORD, 'return'):
                         children.append(self.Keyword())
-                        if self.current_token.type == TT_SEMICOLON:
+                        if self.check_token(TT_SEMICOLON):
                             self.advance()
                             children.append(self.VarDecl())
                             # print('PD done with variable declarations')
                             # print('Current token type: ' + self.current_token.type)
-                            if self.current_token.type == TT_RBRACE:
+                            if self.check_token(TT_RBRACE):
                                 self.advance()
                                 self.num_nodes += 1
-                                print('Exiting PD')
-                                return Node(self.num_nodes, NT_PD, children)
+                                parser_log.debug('Exiting PD')
+                                return Node(self.num_nodes, NT_PD, children, self.previous_token)
         else:
             # print('PROCDEFS PASS')
             pass
-        self.parser_error()
+        self.parser_error(NT_PD)
+
+    def adopt(self, encoded_procedure):
+        # Builds the PD that encode_procedure encoded, from this parser's tokens starting with the current one and
+        # with its nodes numbered on from this parser's count, so the tree is the same as if PD had parsed it here
+        tokens = self.tokens
+        base = self.token_index
+        node_offset = self.num_nodes
+        nodes = []
+        # [node, children still to come] for each node whose children are being built, innermost last
+        open_nodes = []
+        for entry in encoded_procedure:
+            if entry is None:
+                node = None
+            elif len(entry) == 3:
+                token = tokens[base + entry[2]]
+                node = Node(entry[1] + node_offset, entry[0], token, token, token)
+            else:
+                node_class, node_id, child_count, first_index, last_index = entry
+                node = Node(node_id + node_offset, node_class, [], tokens[base + last_index],
+                            None if first_index is None else tokens[base + first_index])
+            if open_nodes:
+                parent = open_nodes[-1]
+                parent[0].node_contents.append(node)
+                parent[1] -= 1
+                if not parent[1]:
+                    open_nodes.pop()
+            if node is not None:
+                nodes.append(node)
+                if isinstance(node.node_contents, list) and child_count:
+                    open_nodes.append([node, child_count])
+        pd_node = nodes[0]
+        self.procedures[base] = nodes
+        self.num_nodes = pd_node.node_id
+
+        # On to the token after the PD, without advancing through it token by token
+        index = pd_node.last_token.id + 1
+        self.lookahead.clear()
+        self.token_source = map(tokens.__getitem__, range(index, len(tokens)))
+        self.token_index = index - 1
+        self.current_token = pd_node.last_token
+        self.advance()
+        return pd_node
 
     def ProcDefs(self):
-        print('Adding ProcDefs')
+        parser_log.debug('Adding ProcDefs')
         # Compound
 
         # Branching on nullable
 
         # Children:
-        # PD ProcDefs
+        # Every PD in order, kept flat like VarDecl
 
-        tokens_copy = self.get_fresh_token_list_copy()
-        current_token_copy = tokens_copy[self.token_index]
-        if current_token_copy.type != TT_KEYWORD or current_token_copy.contents != 'proc':
-            print('ProcDefs null')
+        if not self.check_token(TT_KEYWORD, 'proc'):
+            parser_log.debug('ProcDefs null')
             return None
 
         children = []
+        first_token = self.current_token
+        while self.check_token(TT_KEYWORD, 'proc'):
+            # Error recovery - a bad procedure is skipped up to the , after it (or its closing })
+            try:
+                pd = self.PD()
+            except ParserError as error:
+                self.errors.append(error)
+                self.synchronise((TT_COMMA,))
+                if self.check_token(TT_RBRACE):
+                    self.advance()
+                pd = None
+            if pd is not None:
+                children.append(pd)
 
-        children.append(self.PD())
-        if self.current_token.type == TT_COMMA:
+            if not self.check_token(TT_COMMA):
+                break
             self.advance()
-            children.append(self.ProcDefs())
-            self.num_nodes += 1
-            print('Exiting ProcDefs')
-            return Node(self.num_nodes, NT_PROCDEFS, children)
-        else:
-            return Node(self.num_nodes, NT_PROCDEFS, children)
+
+        if not children:
+            return None
+        self.num_nodes += 1
+        parser_log.debug('Exiting ProcDefs')
+        return Node(self.num_nodes, NT_PROCDEFS, children, self.previous_token, first_token)
 
     def SPLProgr(self):
-        print('Adding SPL program')
+        parser_log.debug('Adding SPL program')
         # Compound
 
         # No branching - only:
@@ -862,59 +1132,989 @@ class Parser:
         children = []
 
         children.append(self.ProcDefs())
-        print('Current token: ' + self.current_token.contents)
-        if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'main':
+        parser_log.debug('Current token: %s', self.current_token.contents)
+        if self.check_token(TT_KEYWORD, 'main'):
             children.append(self.Keyword())
-            if self.current_token.type == TT_LBRACE:
+            if self.check_token(TT_LBRACE):
                 self.advance()
                 children.append(self.Algorithm())
-                if self.current_token.type == TT_KEYWORD and self.current_token.contents == 'halt':
+                if self.check_token(TT_KEYWORD, 'halt'):
                     children.append(self.Keyword())
-                    if self.current_token.type == TT_SEMICOLON:
+                    if self.check_token(TT_SEMICOLON):
                         self.advance()
                         children.append(self.VarDecl())
-                        print('Program variable declarations complete!')
-                        if self.current_token.type == TT_RBRACE:
+                        parser_log.debug('Program variable declarations complete!')
+                        if self.check_token(TT_RBRACE):
                             self.num_nodes += 1
-                            return Node(self.num_nodes, NT_SPLPROGRAM, children)
+                            return Node(self.num_nodes, NT_SPLPROGRAM, children, self.current_token)
 
-        self.parser_error()
+        self.parser_error(NT_SPLPROGRAM)
 
     def run_parser(self):
         # Runs recursive descent parser
 
         # Gets Node object of program and recursively steps down through each child node
 
-        # Returns program's Node object
+        # Returns program's Node object, or raises CompilationErrors listing every syntax error found
 
-        program_node = self.SPLProgr()
+        program_node = None
+        if self.current_token is None:
+            self.errors.append(ParserError('Parser Error! The program is empty', None))
+        else:
+            try:
+                program_node = self.SPLProgr()
+            except ParserError as error:
+                self.errors.append(error)
 
-        print(program_node)
+        # Kept even when there are errors, as error recovery still produces a tree
+        self.program_node = program_node
+        if self.errors:
+            raise CompilationErrors(self.errors)
+
+        parser_log.info('%s', program_node)
 
         return program_node
 
     def parser_error(self, node_type=None):
+        # Raises a ParserError for the current token - caught by the nearest list production (Algorithm, VarDecl,
+        # ProcDefs) which records it and recovers, so that parsing continues and later errors are found too
         error_token = self.current_token
-        error_token_index = self.token_index
-
-        print('Parser Error!')
-        print('Error occurred at ' + self.current_token.contents)
 
-        # print('Error occurred at token number ' + error_token_index + '), type ' + error_token.type)
+        if self.at_end:
+            message = 'Parser Error! Unexpected end of input after ' + error_token.contents
+        else:
+            message = 'Parser Error! Error occurred at ' + error_token.contents + \
+                      ' (type ' + TOKEN_TYPE_NAMES[error_token.type] + ')'
 
         if node_type is not None:
-            print('Error occurred while trying to parse a node of type ' + node_type +
-                  ' and running into an unexpected token: ' + error_token)
+            message += ' while trying to parse a node of type ' + NODE_CLASS_NAMES[node_type]
+
+        parser_log.debug(message)
+        raise ParserError(message, error_token, node_type)
+
+    def recover(self, error):
+        # Records the error and skips ahead to the next ; - returns True if one was found (and is now the current
+        # token), or False if the enclosing block or the input ended first
+        self.errors.append(error)
+        self.synchronise((TT_SEMICOLON,))
+        return self.check_token(TT_SEMICOLON)
+
+    def synchronise(self, stop_types):
+        # Panic-mode recovery - skips tokens until one of stop_types is reached, stepping over nested brackets and
+        # braces, and stopping early at a } that closes the enclosing block or at the end of the input
+        depth = 0
+        while not self.at_end:
+            token_type = self.current_token.type
+            if depth == 0 and token_type in stop_types:
+                return
+            if token_type in (TT_LBRACE, TT_LBRACKET):
+                depth += 1
+            elif token_type in (TT_RBRACE, TT_RBRACKET):
+                if depth == 0 and token_type == TT_RBRACE:
+                    return
+                depth = max(depth - 1, 0)
+            self.advance()
+
+
+# Tree walking
+# Passes over the parse tree are written as NodeVisitor subclasses, with enter_<class> and leave_<class> methods
+# named after NODE_CLASS_NAMES (e.g. enter_PD, leave_Algorithm), and enter_node / leave_node for any class without
+# its own method. walk runs any number of visitors together in one traversal of the tree.
 
-        quit()
+# Returned by an enter method to stop its visitor descending into the node's children - other visitors still do
+SKIP_CHILDREN = 'skip children'
+# Returned by the first visitor's enter method when it has dealt with the node and everything under it itself - no
+# other visitor sees the node or its children
+SKIP_NODE = 'skip node'
 
-    def get_fresh_token_list_copy(self):
-        deep_copy = copy.deepcopy(self.tokens)
-        return deep_copy
+
+class NodeVisitor:
+    def __init__(self):
+        # Dispatch tables indexed by node class, so finding the handler for a node is one tuple lookup
+        generic_enter = getattr(self, 'enter_node', None)
+        generic_leave = getattr(self, 'leave_node', None)
+        self.enter_handlers = tuple(getattr(self, 'enter_' + name, generic_enter) for name in NODE_CLASS_NAMES)
+        self.leave_handlers = tuple(getattr(self, 'leave_' + name, generic_leave) for name in NODE_CLASS_NAMES)
+
+
+def walk(root_node, *visitors):
+    # Depth-first traversal calling each visitor's enter method for a node before its children and leave method
+    # after them. Uses an explicit stack, so tree size isn't limited by Python's recursion limit
+    plans = {}
+    stack = [(root_node, visitors, False)]
+    while stack:
+        node, active, leaving = stack.pop()
+        plan = plans.get(active)
+        if plan is None:
+            plan = plans[active] = dispatch_plan(active)
+        if not leaving:
+            descending = active
+            skip_node = False
+            for visitor, handler in plan[0][node.node_class]:
+                result = handler(node)
+                if result is SKIP_CHILDREN:
+                    descending = tuple(each for each in descending if each is not visitor)
+                elif result is SKIP_NODE:
+                    skip_node = True
+                    break
+            if skip_node:
+                continue
+            if descending and isinstance(node.node_contents, list):
+                # Come back to leave the node once its children are done
+                stack.append((node, active, True))
+                for child in reversed(node.node_contents):
+                    if child is not None:
+                        stack.append((child, descending, False))
+                continue
+        for handler in plan[1][node.node_class]:
+            handler(node)
+
+
+def dispatch_plan(visitors):
+    # For each node class, the (visitor, enter method) pairs and the leave methods of those visitors that have one,
+    # so that walk only calls the visitors interested in each node. Leave methods run in reverse order, so that the
+    # visitors nest like the nodes do
+    enter_plan = tuple(tuple((visitor, visitor.enter_handlers[node_class]) for visitor in visitors
+                             if visitor.enter_handlers[node_class] is not None)
+                       for node_class in range(len(NODE_CLASS_NAMES)))
+    leave_plan = tuple(tuple(visitor.leave_handlers[node_class] for visitor in reversed(visitors)
+                             if visitor.leave_handlers[node_class] is not None)
+                       for node_class in range(len(NODE_CLASS_NAMES)))
+    return enter_plan, leave_plan
+
+
+def preorder(root_node):
+    # Yields every node in the tree, each before its children
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.has_children():
+            stack.extend(child for child in reversed(node.node_contents) if child is not None)
+
+
+def preorder_nodes(root_node):
+    # The nodes preorder yields, as a list - quicker than listing preorder, for the hot paths that need them all
+    nodes = []
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        nodes.append(node)
+        if node.node_contents.__class__ is list:
+            stack.extend(reversed(node.node_contents))
+    return nodes
+
+
+def postorder(root_node):
+    # Yields every node in the tree, each after its children
+    stack = [(root_node, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if children_done or not node.has_children():
+            yield node
+            continue
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(node.node_contents) if child is not None)
+
+
+# Per-compilation state
+class Compilation:
+    # Owns everything produced while compiling one program - the text, tokens, parse tree and symbol tables. No stage
+    # keeps state on its class, so any number of compilations can run in one long-lived process, or at once in
+    # separate threads, without seeing each other's tables, and each one's memory goes when it is dropped. The one
+    # thing compilations may share is a ProcedureMemo, passed in as memo
+    def __init__(self, text, filename=None, memo=None):
+        self.text = text
+        self.filename = filename
+        self.memo = memo
+        self.lexer = Lexer(text)
+        self.tokens = None
+        self.program_node = None
+        self.num_nodes = 0
+        self.vtable = None
+        self.ftable = None
+        self.scope_table = None
+        self.analysis = None
+        # IRProgram, once run_ir has run, and the line-numbered BASIC generated from it, once run_generator has
+        self.ir = None
+        self.code = None
+        # BytecodeProgram, once run_bytecode has run, and PythonProgram, once run_python has
+        self.bytecode = None
+        self.python_program = None
+
+    def run_lexer(self):
+        self.tokens = self.lexer.run_lexer()
+        return self.tokens
+
+    def run_parser(self, procedures=None):
+        # procedures are PD nodes to adopt rather than parse, as Parser.procedures
+        parser = Parser(self.tokens)
+        parser.procedures = procedures
+        try:
+            self.program_node = parser.run_parser()
+        finally:
+            self.program_node = parser.program_node
+            self.num_nodes = parser.num_nodes
+        return self.program_node
+
+    def run_analyst(self, summaries=None, scope_table=True):
+        # Every semantic check, plus the scope table (unless scope_table is False), vtable and ftable, in one
+        # traversal - procs with summaries (as Analyst takes them) aren't checked again
+        analyst = Analyst(self.program_node, self.tokens, self.memo, summaries)
+        try:
+            return analyst.analyse(scope_table)
+        finally:
+            self.analysis = analyst.analysis
+            self.vtable = analyst.vtable
+            self.ftable = analyst.ftable
+            self.scope_table = analyst.parent_node
+
+    def run_ir(self):
+        # Three-address code for the checked program, kept in ir
+        generator = AstIntermediateGenerator(self.program_node, self.vtable, self.ftable, self.analysis.bindings,
+                                             self.analysis.procedures)
+        self.ir = generator.generate_ir()
+        return self.ir
+
+    def run_generator(self):
+        # BASIC for the checked program, kept in code
+        if self.ir is None:
+            self.run_ir()
+        generator = AstIntermediateGenerator(self.program_node, self.vtable, self.ftable, self.analysis.bindings)
+        self.code = generator.generate_basic(program=self.ir)
+        return self.code
+
+    def run_optimiser(self):
+        # Simplifies the checked tree in place - ConstantFolder folds its expressions, DeadCodeEliminator strips the
+        # code that can't run, and then the procs no call reaches and the declarations no longer used go - and
+        # rebuilds the tables to match. Code generated before is dropped, as it no longer matches the tree. Returns
+        # the number of expressions simplified and instructions, procs and declarations removed
+        # The procs' code fragments are of the tree as checked - the memo's summaries don't cover what is done here
+        self.analysis.procedures = {}
+        folder = ConstantFolder()
+        eliminator = DeadCodeEliminator()
+        walk(self.program_node, folder, eliminator)
+        changes = folder.folded + eliminator.removed + remove_unreachable_procedures(self.program_node)
+        variable_count = len(self.vtable.variable_list)
+        used = remove_unused_declarations(self.program_node, self.analysis.bindings)
+        # The VarDecls and ProcDefs left empty
+        walk(self.program_node, DeadCodeEliminator())
+        self.vtable.variable_list[:] = [variable for variable in self.vtable.variable_list if variable in used]
+        changes += variable_count - len(self.vtable.variable_list)
+        if changes:
+            self.ftable = self.analysis.ftable = rebuild_ftable(self.program_node, self.analysis.bindings)
+            self.ir = self.code = self.bytecode = self.python_program = None
+        return changes
+
+    def run_bytecode(self):
+        # BytecodeProgram for the checked program, kept in bytecode
+        compiler = BytecodeCompiler(self.analysis.bindings)
+        walk(self.program_node, compiler)
+        self.bytecode = compiler.bytecode_program()
+        return self.bytecode
+
+    def run_python(self):
+        # PythonProgram for the checked program, kept in python_program
+        compiler = PythonCompiler(self.analysis.bindings)
+        walk(self.program_node, compiler)
+        self.python_program = compiler.python_program()
+        return self.python_program
+
+    def execute(self, read=input, write=print, python=False):
+        # Runs the checked program on a BytecodeVM - or as Python code, if python is set - compiling it first if need
+        # be. Returns the VM, or the PythonProgram
+        if python:
+            if self.python_program is None:
+                self.run_python()
+            self.python_program.run(read, write)
+            return self.python_program
+        if self.bytecode is None:
+            self.run_bytecode()
+        vm = BytecodeVM(self.bytecode, read, write)
+        vm.run()
+        return vm
+
+    def run(self, scope_table=True):
+        # Lexes, parses and checks the program, raising CompilationErrors for the first stage that fails
+        self.run_lexer()
+        self.run_parser()
+        self.run_analyst(scope_table=scope_table)
+        return self.program_node
+
+    def run_parallel(self, executor):
+        # Same as run, but each top-level proc is lexed, parsed, checked and generated by analyse_procedures on the
+        # worker processes of executor (a ProcessPoolExecutor, e.g. one kept by a server) - only the rest of the
+        # program, and linking the procs' tokens, nodes and summaries in, is done here, and run_ir links the procs'
+        # code fragments in after main's code. A proc that doesn't parse on its own is parsed here instead, so its
+        # errors are reported just as run reports them, and a program that can't be split, or has a bad word
+        # anywhere, is compiled by run. The scope table is left out, as it is from cached compilations - building it
+        # here would cost as much as checking the procs
+        program_split = split_source(self.text)
+        if program_split is None or len(program_split[0]) < PARALLEL_MIN_PROCEDURES:
+            return self.run(scope_table=False)
+        segments, rest_start = program_split
+        rest_lexer = Lexer(self.text[rest_start:])
+        try:
+            rest_tokens = rest_lexer.run_lexer()
+        except CompilationErrors:
+            return self.run(scope_table=False)
+        environment = program_environment(rest_tokens, [segment[3] for segment in segments])
+        futures = [executor.submit(analyse_procedures, [self.text[start:end] for start, end, comma, name in task],
+                                   environment)
+                   for task in parallel_tasks(segments)]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        if None in results:
+            return self.run(scope_table=False)
+
+        # The procs' tokens, then the rest's, renumbered and moved to their place in the text
+        lexer = self.lexer
+        tokens = lexer.tokens
+        token_starts = lexer.token_starts
+        procedures = {}
+        summaries_by_index = {}
+        for (start, end, comma, name), (token_types, contents, starts, encoded_procedure, summary) \
+                in zip(segments, results):
+            first_index = len(tokens)
+            token_starts.extend([start + offset for offset in starts])
+            tokens.extend(map(Token, token_types, range(first_index, first_index + len(contents)),
+                              map(sys.intern, contents), repeat(token_starts)))
+            if comma is not None:
+                token_starts.append(comma)
+                tokens.append(Token(TT_COMMA, len(tokens), ',', token_starts))
+            if encoded_procedure is not None:
+                procedures[first_index] = encoded_procedure
+                summaries_by_index[first_index] = summary
+        first_index = len(tokens)
+        token_starts.extend([rest_start + offset for offset in rest_lexer.token_starts])
+        tokens.extend(Token(token.type, first_index + token.id, token.contents, token_starts) for token in rest_tokens)
+        lexer.num_tokens = len(tokens)
+        lexer.line_starts.extend(match.end() for match in NEWLINE_REGEX.finditer(self.text))
+        self.tokens = tokens
+
+        self.run_parser(procedures)
+        # The parser swaps each proc it adopted for its nodes
+        summaries = {procedures[first_index][0]: (summary, procedures[first_index])
+                     for first_index, summary in summaries_by_index.items()
+                     if isinstance(procedures[first_index][0], Node)}
+        self.run_analyst(summaries, scope_table=False)
+        return self.program_node
+
+    def line_column(self, offset):
+        return self.lexer.line_column(offset)
+
+    def error_messages(self, error):
+        # The lines to report error (or each of a CompilationErrors' errors) with, giving file, line and column
+        # where known
+        messages = []
+        for each_error in getattr(error, 'errors', [error]):
+            if each_error.position is not None:
+                line, column = self.line_column(each_error.position)
+                messages.append(f'{self.filename}:{line}:{column}: {each_error}')
+            else:
+                messages.append(str(each_error))
+        return messages
+
+    def __getstate__(self):
+        # The scope table is left out of pickles (e.g. CompilationCache entries) - it has an entry per node, so it
+        # would double their size and load time, and Analyst.analyse_scope can rebuild it from the tree
+        state = self.__dict__.copy()
+        state['scope_table'] = None
+        state['memo'] = None
+        # Code objects can't be pickled - run_python builds it again
+        state['python_program'] = None
+        return state
+
+
+# Compilation cache
+# Default size limit of a CompilationCache directory
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class CompilationCache:
+    # Content-addressed on-disk cache of successful compilations. The tokens, parse tree, analysis (apart from the
+    # scope table) and generated code of a source text are pickled to <directory>/<key>.pickle, where the key hashes
+    # the text together with the compiler's own source, so any change to the compiler invalidates every entry.
+    # Least recently used entries are deleted once the directory holds more than max_bytes. Entries are unpickled
+    # when loaded, so the directory must only be writable by users trusted to run code.
+    # Typical use: compilation = CompilationCache(directory).compile(text)
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        with open(__file__, 'rb') as compiler_source:
+            self.compiler_version = hashlib.sha256(compiler_source.read()).hexdigest()
+
+    def key(self, text):
+        return hashlib.sha256((self.compiler_version + '\0' + text).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def compile(self, text, filename=None, compilation=None, run=None):
+        # Returns the Compilation of text, its BASIC generated, from the cache if possible. Otherwise checks
+        # compilation - a new Compilation of text by default, or one the caller keeps to report errors with - by
+        # calling run(compilation), or compilation.run() by default (either raising CompilationErrors), generates
+        # its BASIC and stores it
+        cached = self.load(text, filename)
+        if cached is not None:
+            return cached
+        if compilation is None:
+            compilation = Compilation(text, filename)
+        if run is None:
+            compilation.run()
+        else:
+            run(compilation)
+        compilation.run_generator()
+        self.store(compilation)
+        return compilation
+
+    def load(self, text, filename=None):
+        # Returns the cached Compilation of text, or None
+        path = self.path(self.key(text))
+        try:
+            with open(path, 'rb') as cache_file:
+                compilation = pickle.load(cache_file)
+            os.utime(path)  # Marks the entry as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as error:
+            # A damaged or unreadable entry is dropped and treated as a miss
+            runner_log.warning('Discarding cache entry %s: %s', path, error)
+            self.remove(path)
+            self.misses += 1
+            return None
+        if not isinstance(compilation, Compilation) or compilation.text != text:
+            self.remove(path)
+            self.misses += 1
+            return None
+        compilation.filename = filename
+        self.hits += 1
+        return compilation
+
+    def store(self, compilation):
+        # Written to a temporary file first and then renamed, so a concurrent load never sees half an entry
+        path = self.path(self.key(compilation.text))
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as cache_file:
+                pickle.dump(compilation, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+        except BaseException:
+            self.remove(temporary_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        # Deletes least recently used entries until the directory is within max_bytes
+        entries = []
+        total_bytes = 0
+        with os.scandir(self.directory) as directory_entries:
+            for entry in directory_entries:
+                if entry.name.endswith('.pickle'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_bytes += stat.st_size
+        entries.sort()
+        for modified_time, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            self.remove(path)
+            total_bytes -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Batch compilation
+BATCH_OUTPUT_SUFFIX = '.bas'
+
+# The ProcedureMemo of a batch worker process, kept across the files it compiles, as batches of related programs
+# share procedures
+worker_memo = None
+# The CompilationCache of a batch worker process (None if the batch isn't cached), made once so that the compiler's
+# source is only hashed once per worker
+worker_cache = None
+
+
+class BatchResult:
+    # What compile_file did with one source file - output is the path the BASIC was written to (None if it
+    # failed), errors the lines reporting everything that went wrong, and cached whether the compilation came from
+    # the cache
+    def __init__(self, filename, output=None):
+        self.filename = filename
+        self.output = output
+        self.errors = []
+        self.cached = False
+        self.seconds = 0.0
+
+
+def batch_sources(patterns):
+    # The files named by patterns - file names or glob patterns, where ** matches any depth of directories - each
+    # once, in order. A pattern matching nothing is kept as it is, to be reported as a missing file
+    filenames = []
+    seen = set()
+    for pattern in patterns:
+        if any(character in pattern for character in '*?['):
+            matches = [match for match in sorted(glob.glob(pattern, recursive=True)) if not os.path.isdir(match)]
+        else:
+            matches = []
+        for filename in matches or [pattern]:
+            if filename not in seen:
+                seen.add(filename)
+                filenames.append(filename)
+    return filenames
+
+
+def batch_output_path(filename, output_directory=None):
+    # <name>.bas, in output_directory or else beside the source
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(output_directory or os.path.dirname(filename), stem + BATCH_OUTPUT_SUFFIX)
+
+
+def start_batch_worker(cache_directory=None):
+    global worker_memo, worker_cache
+    worker_memo = ProcedureMemo()
+    worker_cache = CompilationCache(cache_directory) if cache_directory else None
+
+
+def compile_file(filename, output, cache_directory=None):
+    # Compiles one file of a batch and writes its BASIC to output. Never raises - whatever goes wrong is in the
+    # result's errors, so that one bad file can't stop a batch
+    start = time.perf_counter()
+    result = BatchResult(filename)
+    compilation = None
+    try:
+        file_reader = FileReader(filename)
+        try:
+            text = file_reader.get_all_text()
+        finally:
+            file_reader.close_file()
+        cache = worker_cache
+        if not cache_directory:
+            cache = None
+        elif cache is None or cache.directory != cache_directory:
+            cache = CompilationCache(cache_directory)  # Not called from a worker started for this cache
+        compilation = Compilation(text, filename, worker_memo)
+        if cache:
+            checked = cache.compile(text, filename, compilation)
+            result.cached = checked is not compilation
+            compilation = checked
+        else:
+            compilation.run()
+            compilation.run_generator()
+        with open(output, 'w') as output_file:
+            output_file.write(compilation.code)
+        result.output = output
+    except CompilerError as error:
+        result.errors = compilation.error_messages(error) if compilation is not None else [str(error)]
+    except OSError as error:
+        result.errors = [f'{filename}: {error}']
+    except Exception as error:
+        # A compiler bug rather than a problem with the file - reported with the file, the traceback is logged
+        runner_log.exception('Internal error compiling %s', filename)
+        result.errors = [f'{filename}: Internal compiler error! {error!r}']
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def compile_batch(filenames, output_directory=None, workers=None, cache_directory=None):
+    # Compiles every file with compile_file on a pool of worker processes - by default one per core - yielding a
+    # BatchResult for each, in the order given. Raises CompilerError before starting if two files would be
+    # written to the same output
+    filenames = list(filenames)
+    outputs = [batch_output_path(filename, output_directory) for filename in filenames]
+    sources_by_output = {}
+    for filename, output in zip(filenames, outputs):
+        if sources_by_output.setdefault(os.path.abspath(output), filename) != filename:
+            raise CompilerError(f'Batch error! {sources_by_output[os.path.abspath(output)]} and {filename} would '
+                                f'both be compiled to {output}')
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+    if cache_directory:
+        os.makedirs(cache_directory, exist_ok=True)  # Here rather than in the workers, which it would stop
+    workers = min(workers or os.cpu_count() or 1, len(filenames))
+    if workers <= 1:
+        start_batch_worker(cache_directory)
+        for filename, output in zip(filenames, outputs):
+            yield compile_file(filename, output, cache_directory)
+        return
+    # Files are handed out a few at a time, as there are typically thousands of short ones
+    chunk_size = max(1, len(filenames) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_batch_worker,
+                             initargs=(cache_directory,)) as executor:
+        yield from executor.map(compile_file, filenames, outputs, repeat(cache_directory), chunksize=chunk_size)
+
+
+# Parallel compilation of one program
+# Fewest top-level procs worth sending to worker processes
+PARALLEL_MIN_PROCEDURES = 2
+# Characters of procs sent to a worker at a time - enough that each task is worth the trip
+PARALLEL_TASK_CHARACTERS = 16384
+
+BRACE_REGEX = re.compile(r'[{}]')
+NEWLINE_REGEX = re.compile(r'\n')
+SPACE_REGEX = re.compile(r'\s*')
+PROC_REGEX = re.compile(r'proc(?![a-z0-9])\s*([a-z][a-z0-9]*)?')
+
+
+def split_source(text):
+    # For Compilation.run_parallel - (start, end, offset of the comma after it or None, name) of each top-level
+    # proc's text, found by matching braces (which can't be in strings), and the offset the rest of the program
+    # starts at. None if the braces don't match
+    segments = []
+    position = SPACE_REGEX.match(text).end()
+    while True:
+        proc_match = PROC_REGEX.match(text, position)
+        if proc_match is None:
+            break
+        depth = 0
+        end = None
+        for brace in BRACE_REGEX.finditer(text, position):
+            depth += 1 if brace.group() == '{' else -1
+            if depth <= 0:
+                end = brace.end() if depth == 0 else None
+                break
+        if end is None:
+            return None
+        after = SPACE_REGEX.match(text, end).end()
+        comma = after if text.startswith(',', after) else None
+        segments.append((position, end, comma, proc_match.group(1)))
+        if comma is None:
+            position = after
+            break
+        position = SPACE_REGEX.match(text, comma + 1).end()
+    return segments, position
+
+
+def program_environment(rest_tokens, procedure_names):
+    # The scope top-level procs are checked in - (name, type code, array?) of each variable the program declares
+    # after its halt ; (halt is only used there), from the tokens of the program after the procs, and the name of
+    # each top-level proc
+    variables = []
+    halt_index = next((token.id for token in reversed(rest_tokens)
+                       if token.type == TT_KEYWORD and token.contents == 'halt'), None)
+    if halt_index is not None:
+        parser = Parser(rest_tokens[halt_index + 2:], halt_index + 2)
+        try:
+            var_decl = parser.VarDecl()
+        except ParserError:
+            # The parser reports it when the program is parsed, and the program isn't checked then
+            var_decl = None
+        for dec in var_decl.node_contents if var_decl is not None else ():
+            variable = make_vtable_node(dec, 0)
+            variables.append((variable.var_name, variable.var_type, variable.var_array))
+    return variables, [name for name in procedure_names if name is not None]
+
+
+def parallel_tasks(segments):
+    # Groups consecutive procs into tasks of about PARALLEL_TASK_CHARACTERS characters
+    task = []
+    task_characters = 0
+    for segment in segments:
+        task.append(segment)
+        task_characters += segment[1] - segment[0]
+        if task_characters >= PARALLEL_TASK_CHARACTERS:
+            yield task
+            task = []
+            task_characters = 0
+    if task:
+        yield task
+
+
+def analyse_procedures(procedure_texts, environment):
+    # Runs on a worker process for Compilation.run_parallel - lexes, parses and checks the text of each proc, in
+    # the scope program_environment describes, and generates its code. Returns, for each, its tokens as (types,
+    # contents, starts), its PD encoded by encode_procedure and its ProcedureSummary, with the proc's CodeFragment
+    # unless it has errors - the last two None if it didn't parse cleanly, and the whole result None if it didn't lex
+    variables, procedure_names = environment
+    checker = DeclarationChecker()
+    checker.vtable.push_scope()
+    checker.ftable.push_scope()
+    for name, var_type, var_array in variables:
+        variable = Vtable_node()
+        variable.var_name = name
+        variable.var_id = len(checker.vtable.variable_list)
+        variable.var_type = var_type
+        variable.var_array = var_array
+        checker.vtable.add_variable(variable)
+    for name in procedure_names:
+        function = Ftable_node()
+        function.function_name = name
+        function.function_id = len(checker.ftable.function_list)
+        function.function_type = 'proc'
+        checker.ftable.add_function(function)
+    type_checker = TypeChecker(checker.bindings)
+    ftable_builder = FtableBuilder(checker.ftable)
+    memo = worker_memo if worker_memo is not None else ProcedureMemo()
+
+    # The procs share the checks - a summary only covers what was added while its proc was walked
+    results = []
+    for text in procedure_texts:
+        lexer = Lexer(text)
+        try:
+            tokens = lexer.run_lexer()
+        except CompilationErrors:
+            results.append(None)
+            continue
+        token_lists = (bytes(token.type for token in tokens), [token.contents for token in tokens],
+                       lexer.token_starts)
+        parser = Parser(tokens)
+        try:
+            pd_node = parser.PD()
+        except ParserError:
+            pd_node = None
+        if pd_node is None or parser.errors or not parser.at_end:
+            results.append(token_lists + (None, None))
+            continue
+        # No scope table - the program's is built when the proc is linked in
+        memoizer = ProcedureMemoizer(memo, tokens, checker, None, type_checker, ftable_builder)
+        walk(pd_node, memoizer, checker, type_checker, ftable_builder)
+        summary = memoizer.instances[pd_node].summary
+        if summary.fragment is None and not summary.errors:
+            # The proc's code, in the summary's CodeFragment, which IRGenerator.link places in the program - the
+            # top-level procs' labels here are only placeholders, as the fragment calls them by name
+            generator = IRGenerator(checker.bindings, memoizer.instances)
+            generator.procedures.append({name: next(generator.labels) for name in procedure_names})
+            walk(pd_node, generator)
+        results.append(token_lists + (encode_procedure(pd_node), summary))
+    return results
+
+
+def encode_procedure(pd_node):
+    # The PD's nodes in preorder as plain tuples, which pickle far quicker than the nodes themselves - (class, ID,
+    # token index) for a leaf, (class, ID, number of children, first token index or None, last token index) for a
+    # node with children, and None for a missing child. Token indexes are token IDs, so relative to the PD when it
+    # was parsed from its own tokens
+    encoded = []
+    stack = [pd_node]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            encoded.append(None)
+        elif isinstance(node.node_contents, list):
+            encoded.append((node.node_class, node.node_id, len(node.node_contents),
+                            None if node.first_token is None else node.first_token.id, node.last_token.id))
+            stack.extend(reversed(node.node_contents))
+        else:
+            encoded.append((node.node_class, node.node_id, node.node_contents.id))
+    return encoded
+
+
+# Incremental compilation
+class IncrementalCompiler:
+    # Keeps the tokens and parse tree of a program being edited (e.g. in the web front end), so that after each edit
+    # only the changed text is re-lexed and only the smallest enclosing Instr, Algorithm or PD is re-parsed:
+    # - compile(text) - lexes and parses the whole text
+    # - apply_edit(start, end, replacement) - replaces text[start:end] and updates the tokens and tree
+    # errors always holds the current lexer and parser errors, program_node the current (possibly recovered) tree
+
+    def __init__(self):
+        self.text = ''
+        self.lexer = None
+        self.tokens = []
+        self.program_node = None
+        self.errors = []
+        self.num_nodes = 0
+        # What the last apply_edit did, for diagnostics and tests - the number of tokens scanned again, and the
+        # node re-parsed in place (the program node after a full re-parse, None if the tree was untouched)
+        self.relexed_tokens = 0
+        self.reparsed_node = None
+
+    def compile(self, text):
+        self.text = text
+        self.lexer = Lexer(text)
+        self.errors = []
+        try:
+            self.tokens = self.lexer.run_lexer()
+        except CompilationErrors as error:
+            self.tokens = self.lexer.tokens
+            self.errors.extend(error.errors)
+        self.relexed_tokens = len(self.tokens)
+        self.reparse_all()
+        return self.program_node
+
+    def reparse_all(self):
+        parser = Parser(self.tokens)
+        try:
+            parser.run_parser()
+        except CompilationErrors:
+            pass
+        self.program_node = parser.program_node
+        self.num_nodes = parser.num_nodes
+        self.errors = [error for error in self.errors if not isinstance(error, ParserError)] + parser.errors
+        self.reparsed_node = self.program_node
+
+    def apply_edit(self, start, end, replacement):
+        # Falls back to a full compile whenever incremental work can't be trusted - lexer errors anywhere, or no
+        # tree to patch
+        new_text = self.text[:start] + replacement + self.text[end:]
+        if self.lexer is None or self.lexer.errors or self.program_node is None:
+            return self.compile(new_text)
+
+        tokens = self.tokens
+        starts = self.lexer.token_starts
+        delta = len(replacement) - (end - start)
+
+        # Re-lex from one token before the first token that starts before the edit, since text at the edit can join
+        # on to it, until the new tokens line up with an old token past the edit - from there on the text, and so
+        # the tokens, are the same as before, just shifted by delta
+        first = max(bisect_right(starts, start) - 2, 0)
+        scan_from = starts[first] if first < len(tokens) else start
+        rescanner = Lexer(None)
+        rescanner.buffer_offset = scan_from
+        new_tokens = []
+        resume = first
+        for token in rescanner.scan_buffer(new_text[scan_from:], True):
+            token_start = token.start
+            if token_start >= start + len(replacement):
+                old_start = token_start - delta
+                while resume < len(tokens) and starts[resume] < old_start:
+                    resume += 1
+                if resume < len(tokens) and starts[resume] == old_start and \
+                        tokens[resume].contents == token.contents and tokens[resume].type == token.type:
+                    break
+            new_tokens.append(token)
+        else:
+            resume = len(tokens)
+        if rescanner.errors:
+            return self.compile(new_text)
+        self.relexed_tokens = len(new_tokens)
+
+        self.text = new_text
+        self.lexer.text = new_text
+        self.update_line_starts(start, end, replacement, delta)
+
+        old_tokens = tokens[first:resume]
+        unchanged = [(token.type, token.contents) for token in old_tokens] == \
+                    [(token.type, token.contents) for token in new_tokens]
+        if unchanged:
+            # Only whitespace moved - keep the old tokens and tree, just shifting offsets
+            self.reparsed_node = None
+            self.shift_starts(first, [token.start for token in new_tokens], resume, delta)
+            return self.program_node
+
+        # Units are found on the old tree, whose token IDs still match the old positions
+        units, path = self.find_reparse_units(first, resume)
+        follow_tokens = [tokens[node.last_token.id + 1] if node.last_token.id + 1 < len(tokens) else None
+                         for node, parent, index in units]
+
+        new_starts = [token.start for token in new_tokens]
+        for index, token in enumerate(new_tokens, first):
+            token.starts = starts
+            token.id = index
+        tokens[first:resume] = new_tokens
+        self.shift_starts(first, new_starts, resume, delta)
+        if len(new_tokens) != resume - first:
+            for index in range(first + len(new_tokens), len(tokens)):
+                tokens[index].id = index
+
+        for (node, parent, index), follow_token in zip(units, follow_tokens):
+            if self.reparse_unit(node, parent, index, follow_token, path):
+                return self.program_node
+        self.reparse_all()
+        return self.program_node
+
+    def shift_starts(self, first, new_starts, resume, delta):
+        # Writes the start offsets of the re-lexed tokens into the lexer's array and shifts those after them
+        starts = self.lexer.token_starts
+        tail = starts[resume:]
+        if delta:
+            tail = array('l', [token_start + delta for token_start in tail])
+        starts[first:] = array('l', new_starts) + tail
+
+    def update_line_starts(self, start, end, replacement, delta):
+        line_starts = self.lexer.line_starts
+        low = bisect_right(line_starts, start)
+        high = bisect_right(line_starts, end)
+        new_lines = [start + index + 1 for index, character in enumerate(replacement) if character == '\n']
+        tail = line_starts[high:]
+        if delta:
+            tail = array('l', [line_start + delta for line_start in tail])
+        line_starts[low:] = array('l', new_lines) + tail
+
+    def find_reparse_units(self, first, resume):
+        # Returns (node, parent, index in parent) for each PD, Algorithm and Instr node that strictly contains the
+        # changed tokens (old positions first to resume), innermost first - the first and following tokens of such a
+        # node are untouched by the edit, so it can be re-parsed on its own between them. Also returns the path of
+        # nodes from the root down that contain the change.
+        units = []
+        path = []
+        node = self.program_node
+        while node is not None and node.has_children():
+            path.append(node)
+            inner = None
+            for index, child in enumerate(node.node_contents):
+                if child is None or child.first_token is None:
+                    continue
+                if child.first_token.id < first and child.last_token.id + 1 >= resume:
+                    if child.node_class in (NT_PD, NT_ALGORITHM, NT_INSTR):
+                        units.append((child, node, index))
+                    inner = child
+                    break
+            node = inner
+        units.reverse()
+        return units, path
+
+    def reparse_unit(self, node, parent, index, follow_token, path):
+        # Re-parses node from its first token - succeeds if the new node ends just before the same following token
+        if follow_token is None:
+            return False
+        parser = Parser(islice(self.tokens, node.first_token.id, None), node.first_token.id)
+        parser.num_nodes = self.num_nodes
+        try:
+            if node.node_class == NT_PD:
+                new_node = parser.PD()
+            elif node.node_class == NT_INSTR:
+                new_node = parser.Instr()
+            else:
+                new_node = parser.Algorithm()
+        except ParserError:
+            return False
+        if new_node is None or parser.at_end or parser.current_token is not follow_token:
+            return False
+        # An error on the following token could have come from this node or from the production around it - only
+        # a wider re-parse can tell
+        if any(isinstance(error, ParserError) and error.token is follow_token
+               for error in self.errors + parser.errors):
+            return False
+
+        parent.node_contents[index] = new_node
+        self.num_nodes = parser.num_nodes
+        # Ancestors that ended on a token the edit replaced now end on the re-parsed node's last token
+        for ancestor in path:
+            if ancestor is node:
+                break
+            if not self.is_live(ancestor.last_token):
+                ancestor.last_token = new_node.last_token
+        low = new_node.first_token.id
+        high = follow_token.id
+        self.errors = [error for error in self.errors
+                       if not isinstance(error, ParserError) or
+                       (self.is_live(error.token) and not low <= error.token.id < high)] + parser.errors
+        self.reparsed_node = new_node
+        return True
+
+    def is_live(self, token):
+        return token is not None and token.id < len(self.tokens) and self.tokens[token.id] is token
 
 
 # Scope table entry
 class ScopeTableEntry:
+    __slots__ = ('id', 'parent', 'children', 'node', 'text')
+
     def __init__(self, id, parent, children, node, text):
         self.id = id
         self.parent = parent
@@ -923,13 +2123,41 @@ class ScopeTableEntry:
         self.text = text
 
     def __repr__(self):
+        # Built with an explicit stack rather than by recursing through the children's reprs, like Node.__repr__
+        parts = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            parts.append(item.describe())
+            if item.children is None:
+                parts.append('None')
+                continue
+            parts.append('[')
+            stack.append(']')
+            for index in range(len(item.children) - 1, -1, -1):
+                stack.append(item.children[index])
+                if index:
+                    stack.append(', ')
+        return ''.join(parts)
+
+    def describe(self):
+        # The entry's own part of its repr, up to its children
         if self.parent is not None and self.node is not None:
-            return f'\nID: {self.id} (Node type: {self.node.node_class}, node ID: {self.node.node_id}), ' \
-                   f'Parent node: {self.parent.node_class}, parent parse tree ID: {self.parent.node_id}, ' \
-                   f'Children: {self.children}'
+            return f'\nID: {self.id} (Node type: {NODE_CLASS_NAMES[self.node.node_class]}, ' \
+                   f'node ID: {self.node.node_id}), ' \
+                   f'Parent node: {NODE_CLASS_NAMES[self.parent.node_class]}, ' \
+                   f'parent parse tree ID: {self.parent.node_id}, ' \
+                   f'Children: '
         else:
             return f'\nID: {self.id}, ' \
-                   f'Parent node: None, Children: {self.children}'
+                   f'Parent node: None, Children: '
+
+    def __reduce__(self):
+        # Pickled as a plain constructor call, like Token
+        return ScopeTableEntry, (self.id, self.parent, self.children, self.node, self.text)
 
     def update_children(self, children: list):
         self.children = children
@@ -938,50 +2166,100 @@ class ScopeTableEntry:
         self.text = text
 
 
+class DeferredScopeTableEntry(ScopeTableEntry):
+    # The entry of a PD that ProcedureMemoizer took over - the entries below it are only made when its children are
+    # first asked for, as most scope tables are never looked at
+    __slots__ = ()
+
+    @property
+    def children(self):
+        children = ScopeTableEntry.children.__get__(self)
+        if children is None:
+            children = []
+            ScopeTableEntry.children.__set__(self, children)
+            add_child_entries(self)
+        return children
+
+    @children.setter
+    def children(self, children):
+        ScopeTableEntry.children.__set__(self, children)
+
+
+def add_child_entries(entry):
+    # Makes the entries ScopeTableBuilder would for the subtree below entry's node, with an explicit stack
+    stack = [(child, entry, entry.id + 1) for child in reversed(entry.node.node_contents) if child is not None]
+    while stack:
+        node, parent_entry, level = stack.pop()
+        current_entry = ScopeTableEntry(level, parent_entry.node, None, node, None)
+        parent_entry.children.append(current_entry)
+        if isinstance(node.node_contents, list):
+            current_entry.children = []
+            stack.extend((child, current_entry, level + 1) for child in reversed(node.node_contents)
+                         if child is not None)
+        else:
+            current_entry.text = node.node_contents
+
+
 # Static semantic analyst
 class Analyst:
-    scope_level = 0
-    parent_node = None
-
-    def __init__(self, program_node: list, node_list: list):
+    # node_list is the program's token list. With it and a ProcedureMemo, analyse reuses the analysis of any proc
+    # the memo has seen before, and with it and summaries - (ProcedureSummary, the PD's nodes in preorder or None)
+    # by PD node, from Compilation.run_parallel - uses those instead of checking the procs
+    def __init__(self, program_node, node_list=None, memo=None, summaries=None):
         self.program_node = program_node
         self.node_list = node_list
-
-    def recursive_scope_analysis(self, current_node, parent):
-        # Creates scope table entry object from current node, recursively checks scope of children and creates object
-        # for each child, and then adds children into original object upwards in tree, eventually returning the final
-        # entry
-
-        # print('Recursive scope analysis - scope level ' + str(self.scope_level))
-
-        current_entry = ScopeTableEntry(self.scope_level, parent, None, current_node,None)
-        # print('Instantiated current entry')
-        if current_node is not None and current_node.has_children():
-            # print('Current node has children')
-            child_entries = []  # Array of child ScopeTableEntry object
-            # print('Created empty array of child entries at level ' + str(self.scope_level))
-            for child_node in current_node.node_contents:
-                self.scope_level += 1
-                # print('Delving into recursive layer')
-                child_entries.append(self.recursive_scope_analysis(child_node, current_node))
-                self.scope_level -= 1
-            current_entry.update_children(child_entries)
-        elif current_node is not None and type(current_node.node_contents) is not list:
-            current_entry.set_text(current_node.node_contents)
-        print(current_entry)
-        return current_entry
-
-        # Ultimately returns parent ScopeTableEntry object - might render actual scope table object a bit redundant,
-        # but we can work on that later if necessary with a TODO
+        self.memo = memo
+        self.summaries = summaries
+        self.parent_node = None
+        self.vtable = Vtable()
+        self.ftable = Ftable()
+        self.errors = []
+        self.analysis = None
 
     def analyse_scope(self):
         # Returns scope table entry object, which categorises all given AST nodes into their respective scope levels
-        print('Starting scope analysis...')
-        self.parent_node = self.recursive_scope_analysis(self.program_node, None)
-        print('Recursive scope analysis complete:')
-        print(self.parent_node)
+        analyst_log.info('Starting scope analysis...')
+        scope_builder = ScopeTableBuilder()
+        walk(self.program_node, scope_builder)
+        self.parent_node = scope_builder.root_entry
+        analyst_log.info('Scope analysis complete:')
+        analyst_log.info('%s', self.parent_node)
         return self.parent_node
 
+    def analyse(self, scope_table=True):
+        # Every semantic pass in a single traversal of the tree - the declaration and usage checks, the scope table
+        # (unless scope_table is False - analyse_scope can build it later), the type checks and the ftable of
+        # operations. Returns a SemanticAnalysis, or raises CompilationErrors listing every error found, in source
+        # order (the analysis is still kept in self.analysis)
+        checker = DeclarationChecker()
+        scope_builder = ScopeTableBuilder() if scope_table else None
+        type_checker = TypeChecker(checker.bindings)
+        ftable_builder = FtableBuilder(checker.ftable)
+        visitors = tuple(visitor for visitor in (checker, scope_builder, type_checker, ftable_builder)
+                         if visitor is not None)
+        memoizer = None
+        if (self.memo is not None or self.summaries) and self.node_list is not None:
+            # First, so that it can take over a proc before the other passes see it
+            memoizer = ProcedureMemoizer(self.memo, self.node_list, checker, scope_builder, type_checker,
+                                         ftable_builder, self.summaries)
+            visitors = (memoizer,) + visitors
+        walk(self.program_node, *visitors)
+        ftable_builder.resolve_arguments(checker.vtable, checker.bindings)
+
+        self.parent_node = scope_builder.root_entry if scope_builder is not None else None
+        self.vtable = checker.vtable
+        self.ftable = checker.ftable
+        self.errors = sorted(checker.errors + type_checker.errors,
+                             key=lambda error: -1 if error.position is None else error.position)
+        self.analysis = SemanticAnalysis(self.vtable, self.ftable, self.parent_node, checker.bindings,
+                                         type_checker.node_types, self.errors,
+                                         memoizer.instances if memoizer is not None else None)
+        if self.errors:
+            raise CompilationErrors(self.errors)
+
+        analyst_log.info('%s', self.vtable.variable_list)
+        return self.analysis
+
     def analyse_syntactic_objects(self):
         # Checking for no procedures being named "main" done implicitly in parsing stage
 
@@ -1000,141 +2278,530 @@ class Analyst:
         # possibly do some variable analysis - check whether there are any variables that are re-declared somewhere?
 
     def nested_procedure_def_error(self, proc_name):
-        print('Nested program declaration error!')
-        print('Redeclared procedure: ' + proc_name)
-        print('COMPILATION TERMINATING')
-        quit()
+        raise SemanticError('Nested program declaration error! Redeclared procedure: ' + proc_name)
 
-    def convert_types(self, type, content):
-        if type == TT_NUMBER:
-            if content.contains('-'):
-                return 'N'
-            else:
-                return 'NN'
-        if type == 'boolean':
-            if content == 'true':
-                return 'BT'
-            else:
-                return 'BF'
-        if type == TT_SHORTSTRING:
-            return 'S'
+    def check_types(self, given_node=None):
+        # Builds the variable and procedure tables for the program, checking that every name used is declared in the
+        # same or an enclosing scope (DECL-APPL) and that every declared variable is used (APPL-DECL)
 
-    variable_list = []
-    def check_types(self, given_node):
-        # search through whole program for variables
-        # when a variable is found, add it to the list of named variables
-        # when used, check if in list
-        # if not, then decl-appl
-
-        # when done, run through list and find any variables which haven't been used
-        # emit appl-decl error
-
-        for node in given_node.node_contents:
-            # pass 1 - find all declarations
-            if node.node_class == NT_VARDECL:
-                new_var = VariableItem()
-                child_node = node.node_contents[0]
-                if child_node.node_contents[0].node_class == NT_TYP:
-                    # getting type from further down declaration
-                    new_var.set_type(self.convert_types(child_node.node_contents[0].node_class))
-                    # getting name from further down declaration
-                    new_var.set_name(child_node.node_contents[1].node_contents[0].node_contents)
-                    self.variable_list.append(new_var)
-                    for child in node.node_contents:
-                        self.check_types(child)
-                else:
-                    new_var.set_array(True)
-                    if child_node.node_contents[1].node_class == NT_TYP:
-                        new_var.set_type(self.convert_types(child_node.node_contents[1].node_class))
-                        new_var.set_name(child_node.node_contents[2].node_contents[0].node_contents)
-                        self.variable_list.append(new_var)
-                        for child in node.node_contents:
-                            self.check_types(child)
-
-            elif node.node_class == NT_VAR:
-                var_name = node.node_contents[0].node_contents
-                for variable_node in self.variable_list:
-                    if variable_node.node_name == var_name:
-                        variable_node.set_used(True)
-                        self.variable_list.append(new_var)
-                for child in node.node_contents:
-                    self.check_types(child)
-
-            elif node.node_class == NT_BINOP:
-                if node.node_contents[2] == NT_EXPR and node.node_contents[4] == NT_EXPR:
-                    new_var.set_type('B')
-                    new_var.set_name('binop')
-                    self.variable_list.append(new_var)
-                    for child in node.node_contents:
-                        self.check_types(child)
-                else:
-                    new_var.set_type('BF')
-                    new_var.set_name('binop')
-                    self.variable_list.append(new_var)
-                    for child in node.node_contents:
-                        self.check_types(child)
-
-            elif node.node_class == NT_UNOP:
-                new_var.set_type('B')
-                new_var.set_name('unop')
-                self.variable_list.append(new_var)
-                for child in node.node_contents:
-                    self.check_types(child)
-
-            elif node.node_class == NT_BINOP:
-                argument_1 = node.node_contents[1]
-                argument_2 = node.node_contents[2]
-                name_1 = ''
-                type_1 = ''
-                name_2 = ''
-                type_2 = ''
-                for variable in self.variable_list:
-                    if variable.name == argument_1:
-                        name_1 = variable.name
-                        type_1 = variable.type
-                    elif variable.name == argument_2:
-                        name_2 = variable.name
-                        type_2 = variable.type
-                if type_1 != type_2:
-                    print('Lack of value error! ' + name_1)
-                    quit()
-                else:
-                    self.check_types(child)
+        # Returns the variable table entries in declaration order, or raises CompilationErrors listing every
+        # semantic error found
+        checker = DeclarationChecker()
+        walk(given_node or self.program_node, checker)
+        return self.finish_checks(checker)
 
-        for variable in self.variable_list:
-            if variable.used == False and variable.name != 'binop':
-                print('Declared variable not used! APPL-DECL error! ' + var_name)
-                quit()
+    def finish_checks(self, checker):
+        self.vtable = checker.vtable
+        self.ftable = checker.ftable
+        self.errors = checker.errors
+        if self.errors:
+            raise CompilationErrors(self.errors)
 
-            if variable.type == None:
-                print('Declared variable not used! DECL-APPL error! ' + var_name)
-                quit()
+        analyst_log.info('%s', self.vtable.variable_list)
+        return self.vtable.variable_list
 
-        print(self.variable_list)
-        return self.variable_list
 
+class DeclarationChecker(NodeVisitor):
+    # The checks behind Analyst.check_types. The program and each proc open a scope - declarations come at the end
+    # of a scope in SPL, so they are all read when the scope is entered, before its procedures and algorithm
+    def __init__(self):
+        super().__init__()
+        self.vtable = Vtable()
+        self.ftable = Ftable()
+        self.errors = []
+        # The vtable entry each variable use refers to, by Var (or Field array name) node
+        self.bindings = {}
+        # Vars are only uses inside an algorithm - elsewhere they name procedures
+        self.algorithm_depth = 0
+        # When a list, every lookup of a used name is appended to it as (kind, name, entry or None), kind being
+        # 'var' or 'proc' - ProcedureMemoizer uses it to find the names a proc takes from outside
+        self.lookup_log = None
+
+    def enter_SPLProgram(self, node):
+        self.vtable.push_scope()
+        self.ftable.push_scope()
+        for child in node.node_contents:
+            if child is None:
+                continue
+            if child.node_class == NT_VARDECL:
+                for dec in child.node_contents:
+                    self.declare_variable(dec)
+            elif child.node_class == NT_PROCDEFS:
+                # Every procedure in the list is declared first, so that siblings can call each other
+                for pd in child.node_contents:
+                    self.declare_procedure(pd)
+
+    enter_PD = enter_SPLProgram
+
+    def leave_SPLProgram(self, node):
+        for variable in self.vtable.pop_scope().values():
+            if not variable.var_used:
+                self.errors.append(SemanticError('Semantic Error! APPL-DECL error! Variable declared but never used: '
+                                                 + variable.var_name, variable.var_token))
+        self.ftable.pop_scope()
+
+    leave_PD = leave_SPLProgram
+
+    def enter_VarDecl(self, node):
+        return SKIP_CHILDREN
+
+    def enter_Algorithm(self, node):
+        self.algorithm_depth += 1
+
+    def leave_Algorithm(self, node):
+        self.algorithm_depth -= 1
+
+    def enter_Var(self, node):
+        if self.algorithm_depth:
+            self.use_variable(node)
+
+    def enter_Field(self, node):
+        # The array name is a UserDefinedName rather than a Var
+        self.use_variable(node.node_contents[0])
+
+    def enter_PCall(self, node):
+        name_token = node.node_contents[1].node_contents
+        function = self.ftable.find_function(name_token.contents)
+        if self.lookup_log is not None:
+            self.lookup_log.append(('proc', name_token.contents, function))
+        if function is None:
+            self.errors.append(SemanticError('Semantic Error! DECL-APPL error! Procedure called but not declared: '
+                                             + name_token.contents, name_token))
+        return SKIP_CHILDREN
+
+    def declare_variable(self, dec_node):
+        new_var = make_vtable_node(dec_node, len(self.vtable.variable_list))
+        if self.vtable.add_variable(new_var) is not None:
+            self.errors.append(SemanticError('Semantic Error! Variable declared twice in the same scope: '
+                                             + new_var.var_name, new_var.var_token))
+
+    def declare_procedure(self, pd_node):
+        new_function = make_ftable_node(pd_node, len(self.ftable.function_list))
+        if self.ftable.add_function(new_function) is not None:
+            self.errors.append(SemanticError('Semantic Error! Procedure declared twice in the same scope: '
+                                             + new_function.function_name, pd_node.node_contents[1].node_contents))
+
+    def use_variable(self, name_node):
+        name_token = name_node.node_contents
+        variable = self.vtable.find_variable(name_token.contents)
+        if self.lookup_log is not None:
+            self.lookup_log.append(('var', name_token.contents, variable))
+        if variable is None:
+            self.errors.append(SemanticError('Semantic Error! DECL-APPL error! Variable used but not declared: '
+                                             + name_token.contents, name_token))
+        else:
+            variable.var_used = True
+            self.bindings[name_node] = variable
+
+
+class TypeChecker(NodeVisitor):
+    # Works out the type of every expression bottom-up, from the vtable entries variable uses are bound to, and
+    # checks operator arguments, assignments and conditions. Unknown types (U) come from earlier errors and are
+    # accepted anywhere, so that each mistake is reported once
+    def __init__(self, bindings):
+        super().__init__()
+        self.bindings = bindings
+        self.node_types = {}
+        self.errors = []
+
+    def expect(self, node, expected, description):
+        actual = self.node_types.get(node, 'U')
+        if expected != actual and 'U' not in (expected, actual):
+            self.errors.append(SemanticError(f'Semantic Error! Type error! {description} should be '
+                                             f'{TYPE_NAMES[expected]}, not {TYPE_NAMES[actual]}', node.first_token))
+
+    def enter_VarDecl(self, node):
+        return SKIP_CHILDREN
+
+    def leave_Const(self, node):
+        token = node.node_contents
+        if token.type == TT_NUMBER:
+            self.node_types[node] = 'N'
+        elif token.type == TT_SHORTSTRING:
+            self.node_types[node] = 'S'
+        else:
+            self.node_types[node] = 'B'
+
+    def leave_Var(self, node):
+        variable = self.bindings.get(node)
+        if variable is not None:
+            self.node_types[node] = variable.var_type
+
+    def leave_Field(self, node):
+        array, index = node.node_contents
+        self.expect(index, 'N', 'An array index')
+        variable = self.bindings.get(array)
+        if variable is not None:
+            self.node_types[node] = variable.var_type
+
+    def leave_Expr(self, node):
+        self.node_types[node] = self.node_types.get(node.node_contents[0], 'U')
+
+    def leave_LHS(self, node):
+        # Leaves output, which has no type of its own, unknown
+        if node.has_children():
+            self.leave_Expr(node)
+
+    def leave_BinOp(self, node):
+        operator, argument_1, argument_2 = node.node_contents
+        argument_type, result_type = BINOP_TYPES[operator.node_contents.contents]
+        description = 'The arguments of ' + operator.node_contents.contents
+        if argument_type is None:
+            # eq compares any two values of the same type
+            self.expect(argument_2, self.node_types.get(argument_1, 'U'), description)
+        else:
+            self.expect(argument_1, argument_type, description)
+            self.expect(argument_2, argument_type, description)
+        self.node_types[node] = result_type
+
+    def leave_UnOp(self, node):
+        operator, argument = node.node_contents
+        if operator.node_contents.contents == 'not':
+            self.expect(argument, 'B', 'The argument of not')
+            self.node_types[node] = 'B'
+        else:
+            self.expect(argument, 'N', 'The variable read by input')
+            self.node_types[node] = 'N'
+
+    def leave_Assignment(self, node):
+        lhs, expr = node.node_contents
+        # output is unknown, so it can be given a value of any type
+        self.expect(expr, self.node_types.get(lhs, 'U'), 'The assigned value')
+
+    def leave_Loop(self, node):
+        # do Algorithm until Expr, or while Expr do Algorithm
+        condition = node.node_contents[3] if node.node_contents[0].node_contents.contents == 'do' \
+            else node.node_contents[1]
+        self.expect(condition, 'B', 'A loop condition')
+
+    def leave_Branch(self, node):
+        self.expect(node.node_contents[1], 'B', 'An if condition')
+
+
+class SemanticAnalysis:
+    # The result of Analyst.analyse:
+    # - vtable, ftable - every variable and procedure declared (scoped) and every operation, loop and branch
+    # - scope_table - the root ScopeTableEntry
+    # - bindings - the vtable entry each Var (or Field array name) node in an algorithm refers to
+    # - node_types - the type code of each expression node
+    # - errors - every semantic error found, in source order
+    # - procedures - the ProcedureInstance of each PD with a ProcedureSummary, when a ProcedureMemo (or summaries
+    #   from Compilation.run_parallel) took part
+    def __init__(self, vtable, ftable, scope_table, bindings, node_types, errors, procedures=None):
+        self.vtable = vtable
+        self.ftable = ftable
+        self.scope_table = scope_table
+        self.bindings = bindings
+        self.node_types = node_types
+        self.errors = errors
+        self.procedures = procedures if procedures is not None else {}
+
+    def __getstate__(self):
+        # Left out of pickles like Compilation.scope_table
+        state = self.__dict__.copy()
+        state['scope_table'] = None
+        return state
+
+
+class ScopeTableBuilder(NodeVisitor):
+    # The pass behind Analyst.analyse_scope - a scope table entry for every node, with its depth in the tree as its
+    # scope level and the entries of its children as its children
+    def __init__(self):
+        super().__init__()
+        self.root_entry = None
+        # Entries of the nodes with children currently being walked, innermost last
+        self.open_entries = []
+        self.trace = analyst_log.isEnabledFor(logging.DEBUG)
+        # Nodes of these classes never have children, so there is nothing to do when leaving them
+        self.leave_handlers = tuple(None if node_class in LEAF_NODE_CLASSES else handler
+                                    for node_class, handler in enumerate(self.leave_handlers))
+
+    def enter_node(self, node):
+        open_entries = self.open_entries
+        if open_entries:
+            parent_entry = open_entries[-1]
+            current_entry = ScopeTableEntry(len(open_entries), parent_entry.node, None, node, None)
+            parent_entry.children.append(current_entry)
+        else:
+            current_entry = ScopeTableEntry(0, None, None, node, None)
+            self.root_entry = current_entry
+        if self.trace:
+            analyst_log.debug('Scope level %d: %s', current_entry.id, NODE_CLASS_NAMES[node.node_class])
+        if isinstance(node.node_contents, list):
+            current_entry.children = []
+            open_entries.append(current_entry)
+        else:
+            current_entry.text = node.node_contents
 
-class VariableItem:
-    name = None
-    type = None
-    used = False
-    array = False
-    value = None
+    def leave_node(self, node):
+        if isinstance(node.node_contents, list):
+            self.open_entries.pop()
 
-    def __repr__(self):
-        f'{self.name}, {self.type}, Used? {self.used}, Array? {self.array}'
 
-    def set_name(self, name):
-        self.name = name
+# Per-procedure memoization
+# Default number of distinct procs a ProcedureMemo remembers
+PROCEDURE_MEMO_SIZE = 1024
+# Most summaries kept for one proc, each for a different outside environment
+PROCEDURE_MEMO_VARIANTS = 4
+
+
+def describe_entry(entry):
+    # What a proc's analysis depends on about a name it takes from outside - whether it is declared and, for a
+    # variable, its type
+    if entry is None:
+        return None
+    if isinstance(entry, Ftable_node):
+        return ('proc',)
+    return ('var', entry.var_type, entry.var_array)
+
+
+class ProcedureSummary:
+    # Everything analysing one PD subtree adds to a SemanticAnalysis, with nodes given as their index in a preorder
+    # walk of the subtree and tokens as their offset from the PD's first token, so that it applies to any copy of the
+    # proc, in any program:
+    # - free_names - (kind, name, describe_entry of its entry) for each name used from outside the proc
+    # - variables - (name, type, array, used, token offset) of each variable declared in it or in a nested proc
+    # - functions - ftable entries added, in order - ('proc', name) for a nested proc, or (function type, argument
+    #   node index or None, argument node index or None) for an operation, loop or branch
+    # - bindings - (node index, 'local', variables index) or (node index, 'free', name)
+    # - node_types - (node index, type code)
+    # - errors - (message, token offset)
+    # - fragment - the proc's code as a CodeFragment, once IRGenerator has generated it
+    def __init__(self, free_names, variables, functions, bindings, node_types, errors):
+        self.free_names = free_names
+        self.variables = variables
+        self.functions = functions
+        self.bindings = bindings
+        self.node_types = node_types
+        self.errors = errors
+        self.fragment = None
+
+
+class ProcedureInstance:
+    # A ProcedureSummary as it applies to one PD of a program - the vtable entries of the variables the PD declares,
+    # in the summary's order, the entries of the variables it takes from outside, by name, and the program's tokens
+    def __init__(self, summary, variables, free_variables, tokens):
+        self.summary = summary
+        self.variables = variables
+        self.free_variables = free_variables
+        self.tokens = tokens
+
 
-    def set_type(self, type):
-        self.type = type
+class ProcedureMemo:
+    # Bounded LRU of ProcedureSummary objects, for sharing between compilations (e.g. all of a long-running
+    # server's), so that a proc analysed before - in any file - is not analysed again. Procs are identified by a hash
+    # of their tokens, and a summary is only used where every name in its free_names resolves the way it did when the
+    # summary was made. Safe to share between threads
+    def __init__(self, max_entries=PROCEDURE_MEMO_SIZE):
+        self.max_entries = max_entries
+        self.summaries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, structure_hash, fits):
+        # The summary for the proc whose tokens hash to structure_hash for which fits(summary) is true, or None
+        with self.lock:
+            summaries = self.summaries.get(structure_hash)
+            if summaries is not None:
+                self.summaries.move_to_end(structure_hash)
+                summaries = list(summaries)
+        for summary in summaries or ():
+            if fits(summary):
+                with self.lock:
+                    self.hits += 1
+                return summary
+        with self.lock:
+            self.misses += 1
+        return None
 
-    def set_used(self, used):
-        self.used = used
+    def store(self, structure_hash, summary):
+        with self.lock:
+            summaries = self.summaries.setdefault(structure_hash, [])
+            summaries.append(summary)
+            del summaries[:-PROCEDURE_MEMO_VARIANTS]
+            self.summaries.move_to_end(structure_hash)
+            while len(self.summaries) > self.max_entries:
+                self.summaries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.summaries)
+
+
+class ProcedureMemoizer(NodeVisitor):
+    # Runs as the first visitor of Analyst.analyse. On entering a PD with a summary - in summaries (as Analyst
+    # takes them), or else in the memo - it applies the summary and returns SKIP_NODE, so the checks never see the
+    # proc, and its scope table entries are only made if asked for (see DeferredScopeTableEntry). Otherwise it lets
+    # the checks run, and if there is a memo, summarises what they added on leaving the PD. Either way the PD's
+    # ProcedureInstance goes in instances, for IRGenerator to reuse the proc's code
+    def __init__(self, memo, tokens, checker, scope_builder, type_checker, ftable_builder, summaries=None):
+        super().__init__()
+        self.memo = memo
+        self.tokens = tokens
+        self.checker = checker
+        self.scope_builder = scope_builder
+        self.type_checker = type_checker
+        self.ftable_builder = ftable_builder
+        self.summaries = summaries or {}
+        self.instances = {}
+        if memo is not None:
+            checker.lookup_log = []
+        # (PD node, structure hash, and how long each list was on entering it) for each PD being analysed
+        self.open_procedures = []
+
+    def structure_hash(self, node):
+        # Two procs have the same tokens exactly when their texts agree token for token - a token's type follows
+        # from its text
+        contents = [token.contents for token in self.tokens[node.first_token.id:node.last_token.id + 1]]
+        return hashlib.blake2b('\0'.join(contents).encode(), digest_size=16).digest()
+
+    def resolve(self, kind, name):
+        if kind == 'var':
+            return self.checker.vtable.find_variable(name)
+        return self.checker.ftable.find_function(name)
+
+    def fits(self, summary):
+        # Whether every name the summarised proc takes from outside resolves here as it did there
+        return all(describe_entry(self.resolve(kind, name)) == description
+                   for kind, name, description in summary.free_names)
+
+    def enter_PD(self, node):
+        checker = self.checker
+        summary, nodes = self.summaries.get(node, (None, None))
+        if summary is not None and self.fits(summary):
+            self.apply(node, summary, nodes)
+            return SKIP_NODE
+        if self.memo is None:
+            return None
+        structure_hash = self.structure_hash(node)
+        summary = self.memo.find(structure_hash, self.fits)
+        if summary is not None:
+            self.apply(node, summary)
+            return SKIP_NODE
+        self.open_procedures.append((node, structure_hash, len(checker.vtable.variable_list),
+                                     len(checker.ftable.function_list), len(checker.errors),
+                                     len(self.type_checker.errors), len(checker.lookup_log)))
+
+    def leave_PD(self, node):
+        if self.memo is None:
+            return
+        checker = self.checker
+        (_, structure_hash, variable_start, function_start, error_start, type_error_start,
+         lookup_start) = self.open_procedures.pop()
+        nodes = preorder_nodes(node)
+        node_indexes = {id(each): index for index, each in enumerate(nodes)}
+        first_token_id = node.first_token.id
+
+        variables = checker.vtable.variable_list[variable_start:]
+        variable_indexes = {id(variable): index for index, variable in enumerate(variables)}
+        functions = checker.ftable.function_list[function_start:]
+        local_functions = {id(function) for function in functions}
+        free_names = {}
+        for kind, name, entry in checker.lookup_log[lookup_start:]:
+            if entry is None or (id(entry) not in variable_indexes and id(entry) not in local_functions):
+                free_names[kind, name] = describe_entry(entry)
+
+        bindings = []
+        node_types = []
+        free_variables = {}
+        for index, each in enumerate(nodes):
+            variable = checker.bindings.get(each)
+            if variable is not None:
+                local_index = variable_indexes.get(id(variable))
+                if local_index is None:
+                    bindings.append((index, 'free', variable.var_name))
+                    free_variables[variable.var_name] = variable
+                else:
+                    bindings.append((index, 'local', local_index))
+            node_type = self.type_checker.node_types.get(each)
+            if node_type is not None:
+                node_types.append((index, node_type))
+
+        function_summaries = []
+        for function in functions:
+            if function.function_type == 'proc':
+                function_summaries.append(('proc', function.function_name))
+            else:
+                function_summaries.append((function.function_type,
+                                           None if function.function_arg1 is None
+                                           else node_indexes[id(function.function_arg1)],
+                                           None if function.function_arg2 is None
+                                           else node_indexes[id(function.function_arg2)]))
+
+        errors = [(error.args[0], None if error.token is None else error.token.id - first_token_id)
+                  for error in checker.errors[error_start:] + self.type_checker.errors[type_error_start:]]
+        summary = ProcedureSummary(
+            tuple((kind, name, description) for (kind, name), description in free_names.items()),
+            [(variable.var_name, variable.var_type, variable.var_array, variable.var_used,
+              variable.var_token.id - first_token_id) for variable in variables],
+            function_summaries, bindings, node_types, errors)
+        self.memo.store(structure_hash, summary)
+        self.instances[node] = ProcedureInstance(summary, variables, free_variables, self.tokens)
+        if not self.open_procedures:
+            # No enclosing proc needs the lookups
+            del checker.lookup_log[:]
+
+    def apply(self, node, summary, nodes=None):
+        # Adds what analysing the PD would have added, with the PD's own nodes (in preorder, if they are to hand)
+        # and tokens
+        checker = self.checker
+        tokens = self.tokens
+        first_token_id = node.first_token.id
+        scope_builder = self.scope_builder
+        if scope_builder is not None:
+            if scope_builder.trace:
+                walk(node, scope_builder)
+            else:
+                open_entries = scope_builder.open_entries
+                open_entries[-1].children.append(DeferredScopeTableEntry(len(open_entries), open_entries[-1].node,
+                                                                         None, node, None))
+        if nodes is None:
+            nodes = preorder_nodes(node)
+        if self.open_procedures:
+            # An enclosing proc being summarised takes these names from outside too
+            checker.lookup_log.extend((kind, name, self.resolve(kind, name)) for kind, name, _ in summary.free_names)
+
+        variables = []
+        for name, var_type, var_array, var_used, token_offset in summary.variables:
+            new_var = Vtable_node()
+            new_var.var_name = name
+            new_var.var_id = len(checker.vtable.variable_list)
+            new_var.var_type = var_type
+            new_var.var_array = var_array
+            new_var.var_used = var_used
+            new_var.var_token = tokens[first_token_id + token_offset]
+            # Straight into the list - the proc's scopes would have been closed by now
+            checker.vtable.variable_list.append(new_var)
+            variables.append(new_var)
+
+        for function_type, *arguments in summary.functions:
+            if function_type == 'proc':
+                new_function = Ftable_node()
+                new_function.function_name = arguments[0]
+                new_function.function_id = len(checker.ftable.function_list)
+                new_function.function_type = 'proc'
+                checker.ftable.function_list.append(new_function)
+            else:
+                self.ftable_builder.add_function(function_type, *(None if index is None else nodes[index]
+                                                                  for index in arguments))
 
-    def set_array(self, is_array):
-        self.array = is_array
+        free_variables = {}
+        for index, kind, reference in summary.bindings:
+            if kind == 'local':
+                variable = variables[reference]
+            else:
+                variable = free_variables.get(reference)
+                if variable is None:
+                    variable = free_variables[reference] = checker.vtable.find_variable(reference)
+                    variable.var_used = True
+            checker.bindings[nodes[index]] = variable
+        node_types = self.type_checker.node_types
+        for index, node_type in summary.node_types:
+            node_types[nodes[index]] = node_type
+        checker.errors.extend(SemanticError(message, None if token_offset is None
+                                            else tokens[first_token_id + token_offset])
+                              for message, token_offset in summary.errors)
+        self.instances[node] = ProcedureInstance(summary, variables, free_variables, tokens)
 
 
 # Types for reference:
@@ -1147,11 +2814,38 @@ class VariableItem:
 # U - Unknown
 # M - Mixed
 
+# Type codes of the declarable types
+TYP_CODES = {'num': 'N', 'bool': 'B', 'string': 'S'}
+TYPE_NAMES = {'N': 'a number', 'B': 'a boolean', 'S': 'a string', 'U': 'unknown'}
+
+# Argument and result type codes of each binary operator - eq takes any two values of the same type
+BINOP_TYPES = {'add': ('N', 'N'), 'sub': ('N', 'N'), 'mult': ('N', 'N'), 'and': ('B', 'B'), 'or': ('B', 'B'),
+               'larger': ('N', 'B'), 'eq': (None, 'B')}
+
+
 class Vtable_node:
     var_name = ''
     var_id = ''
     var_value = ''
     var_type = ''
+    var_array = False
+    var_used = False
+    var_token = None
+
+    def __repr__(self):
+        return f'{self.var_name}, {self.var_type}, Used? {self.var_used}, Array? {self.var_array}'
+
+def make_vtable_node(dec_node, var_id):
+    # Vtable entry for a Dec node - its children are TYP Var, or Keyword TYP Const Var for arrays
+    name_token = dec_node.node_contents[-1].node_contents
+    new_var = Vtable_node()
+    new_var.var_name = name_token.contents
+    new_var.var_id = var_id
+    new_var.var_type = TYP_CODES[dec_node.node_contents[-3 if len(dec_node.node_contents) == 4 else 0]
+                                 .node_contents.contents]
+    new_var.var_array = len(dec_node.node_contents) == 4
+    new_var.var_token = name_token
+    return new_var
 
 class Ftable_node:
     function_name = ''
@@ -1160,90 +2854,140 @@ class Ftable_node:
     function_arg1 = None
     function_arg2 = None
 
-class Vtable:
+def make_ftable_node(pd_node, function_id):
+    # Ftable entry for a PD node - its children start with Keyword Var, the Var being the procedure's name
+    new_function = Ftable_node()
+    new_function.function_name = pd_node.node_contents[1].node_contents.contents
+    new_function.function_id = function_id
+    new_function.function_type = 'proc'
+    return new_function
+
+class ScopedTable:
+    # Symbol table with nested scopes - one dict per open scope, innermost last, so a lookup costs a dict probe per
+    # enclosing scope rather than a scan of every name seen so far. entries keeps everything added, in order
+    name_attribute = None
+
     def __init__(self):
-        self.variable_list = []
+        self.entries = []
+        self.scopes = [{}]
+
+    def push_scope(self):
+        self.scopes.append({})
+
+    def pop_scope(self):
+        # Closes the innermost scope, returning its dict of entries by name
+        return self.scopes.pop()
+
+    def add(self, entry):
+        # Adds entry to the innermost scope - unless that scope already has an entry of the same name, which is
+        # returned instead
+        scope = self.scopes[-1]
+        name = getattr(entry, self.name_attribute)
+        existing = scope.get(name)
+        if existing is None:
+            scope[name] = entry
+            self.entries.append(entry)
+        return existing
+
+    def find(self, name):
+        # Returns the entry for name in the innermost scope that declares it, or None
+        for scope in reversed(self.scopes):
+            entry = scope.get(name)
+            if entry is not None:
+                return entry
+        return None
+
+class Vtable(ScopedTable):
+    name_attribute = 'var_name'
+
+    def __init__(self):
+        super().__init__()
+        self.variable_list = self.entries
 
     def add_variable(self, variable):
-        self.variable_list.append(variable)
+        return self.add(variable)
 
     def find_variable(self, variable_name):
-        for variable in self.variable_list:
-            if variable.var_name == variable_name:
-                return variable
+        return self.find(variable_name)
 
-        return None
+class Ftable(ScopedTable):
+    name_attribute = 'function_name'
 
-class Ftable:
     def __init__(self):
-        self.function_list = []
+        super().__init__()
+        self.function_list = self.entries
         self.performs = None
 
     def add_function(self, function):
-        self.function_list.append(function)
+        return self.add(function)
 
     def find_function(self, function_name):
-        for function in self.function_list:
-            if function.function_name == function_name:
-                return function
+        return self.find(function_name)
+
+# Code emission
+# Default file generate_code writes
+DEFAULT_OUTPUT_PATH = 'data.txt'
+# Characters a CodeEmitter gathers before writing them to its stream
+EMITTER_CHUNK_SIZE = 64 * 1024
+
+
+class CodeEmitter:
+    # Collects generated code as a list of pieces, joined once at the end, so that emitting is linear in the size of
+    # the output. With a stream (any text file or io.StringIO) the pieces are written to it whenever chunk_size
+    # characters have gathered, and by flush, so a program's code never has to be held whole
+    def __init__(self, stream=None, chunk_size=EMITTER_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.pieces = []
+        self.size = 0
+
+    def emit(self, *pieces):
+        self.pieces.extend(pieces)
+        if self.stream is not None:
+            self.size += sum(map(len, pieces))
+            if self.size >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        # Writes out what has gathered, if there's a stream
+        if self.stream is not None and self.pieces:
+            self.stream.write(''.join(self.pieces))
+            self.pieces.clear()
+            self.size = 0
+
+    def getvalue(self):
+        # Everything emitted, as text - only for an emitter without a stream
+        return ''.join(self.pieces)
 
-        return None
 
 class AstIntermediateGenerator:
-    parent_node = None
-    vtable = Vtable()
-    ftable = Ftable()
-
-    def __init__(self, parent_node):
+    def __init__(self, parent_node=None, vtable=None, ftable=None, bindings=None, procedures=None):
+        # The tables and bindings are normally the ones the analyst built for the same compilation - without
+        # bindings, generate_ir finds them itself. procedures are as SemanticAnalysis.procedures, for IRGenerator
         self.parent_node = parent_node
-        self.v_recursive_level = 0
-        self.f_id = 0
+        self.vtable = vtable if vtable is not None else Vtable()
+        self.ftable = ftable if ftable is not None else Ftable()
+        self.bindings = bindings
+        self.procedures = procedures
 
     def generate_vtable(self):
-        self.generate_vtable_recursive(self.parent_node)
-
-    def generate_vtable_recursive(self):
-        for node in self.parent_node.node_contents:
-            # pass 1 - find all declarations
-            if node.node_class == NT_VARDECL:
-                new_var = Vtable_node()
-                child_node = node.node_contents[0]
-                if child_node.node_contents[0].node_class == NT_TYP:
-                    # getting type from further down declaration
-                    new_var.variable_type = \
-                        self.convert_types(child_node.node_contents[0].node_class,
-                                           child_node.node_contents[0].node_contents)
-                    # getting name from further down declaration
-                    new_var.variable_name = child_node.node_contents[1].node_contents[0].node_contents
-                    new_var.variable_value = child_node.node_contents[1].node_contents[0].node_contents
-                    new_var.variable_id = self.v_recursive_level
-                    self.v_recursive_level += 1
-                    self.vtable.add(new_var)
-                    if node.has_children():
-                        for child in node.node_contents:
-                            self.generate_vtable_recursive(child)
-            elif node.node_class == NT_ASSIGN:
-                if node.node_contents[0].node_contents == 'output':
-                    # PRINT function
-                    pass
-                elif node.node_contents[0].node_type == NT_USERDEFINEDNAME:
-                    # variable assignment
-                    table_entry = self.ftable.find_function(node.node_contents[0].node_contents)
-                    if table_entry is not None:
-                        table_entry.variable_value = node.node_contents[2].node_contents
-                        self.generate_vtable_recursive(child)
-                    else:
-                        print('Some weirdness beyond my comprehension is happening with the vtable -'
-                              ' looking for nonexistent entry, probably possible to reach here')
-                        quit()
-            if node.has_children():
-                for child in node.node_contents:
-                    self.generate_vtable_recursive(child)
-            else:
-                return
+        # Adds every declared variable to the vtable, unless the analyst has already filled it in
+        if not self.vtable.variable_list:
+            walk(self.parent_node, VtableBuilder(self.vtable))
 
     def generate_ftable(self):
-        self.generate_ftable_recursive(self.parent_node)
+        ftable_builder = FtableBuilder(self.ftable)
+        walk(self.parent_node, ftable_builder)
+        ftable_builder.resolve_arguments(self.vtable)
+
+    def generate_tables(self):
+        # generate_vtable and generate_ftable in a single traversal of the tree
+        ftable_builder = FtableBuilder(self.ftable)
+        visitors = [ftable_builder]
+        if not self.vtable.variable_list:
+            visitors.append(VtableBuilder(self.vtable))
+        walk(self.parent_node, *visitors)
+        ftable_builder.resolve_arguments(self.vtable)
 
     FT_UNOP_NOT = 'ft_unop_not'
     FT_UNOP_INPUT = 'ft_unop_input'
@@ -1260,105 +3004,44 @@ class AstIntermediateGenerator:
     FT_LOOP_WHILE = 'loop_while'
     FT_BRANCH = 'branch'
 
-    def generate_ftable_recursive(self, parent_node):
-        for child_node in parent_node.node_contents:
-            new_function = Ftable_node()
-            if child_node.node_type == NT_BRANCH:
-                pass
-            if child_node.node_type == NT_ALGORITHM:
-                if child_node.node_contents[0].node_type == NT_LOOP:
-                    if child_node.node_contents[1].node_contents == 'while' or child_node.node_contents[1].node_contents == 'do':
-                        new_function.function_type = self.FT_LOOP_WHILE
-                        new_function.performs(self.generate_ftable_recursive(child_node))
-                    elif child_node.node_contents[1].node_contents == 'if':
-                        new_function.function_type = self.FT_BRANCH
-                        new_function.performs(self.generate_ftable_recursive(child_node))
-
-                arg_var_1 = self.vtable.find_variable(child_node.node_contents[3].node_contents[0].node_contents)
-                arg_var_2 = self.vtable.find_variable(child_node.node_contents[3].node_contents[0].node_contents)
-                new_function.function_arg1 = arg_var_1
-                new_function.function_arg2 = arg_var_2
-
-            elif child_node.node_type == NT_UNOP:
-                if child_node.node_contents[0].node_contents == 'input':
-                    new_function.type = self.FT_UNOP_INPUT
-                elif child_node.node_contents[0].node_contents == 'not':
-                    new_function.type = self.FT_UNOP_NOT
-
-                # add argument
-                arg_var = self.vtable.find_variable(child_node.node_contents[1].node_contents[0])
-                new_function.function_arg1 = arg_var
-            elif child_node.node_type == NT_BINOP:
-                if child_node.node_contents[0].node_contents == 'add':
-                    new_function.type = self.FT_BINOP_PLUS
-                elif child_node.node_contents[0].node_contents == 'sub':
-                    new_function.type = self.FT_BINOP_MINUS
-                elif child_node.node_contents[0].node_contents == 'mult':
-                    new_function.type = self.FT_BINOP_TIMES
-                elif child_node.node_contents[0].node_contents == 'and':
-                    new_function.type = self.FT_BINOP_AND
-                elif child_node.node_contents[0].node_contents == 'or':
-                    new_function.type = self.FT_BINOP_OR
-                elif child_node.node_contents[0].node_contents == 'eq':
-                    new_function.type = self.FT_BINOP_EQ
-                elif child_node.node_contents[0].node_contents == 'larger':
-                    new_function.type = self.FT_BINOP_LARGER
-
-                # add arguments
-                arg_var_1 = self.vtable.find_variable(child_node.node_contents[1].node_contents[0])
-                arg_var_2 = self.vtable.find_variable(child_node.node_contents[2].node_contents[0])
-                new_function.function_arg1 = arg_var_1
-                new_function.function_arg2 = arg_var_2
-
-            new_function.function_id = self.f_id
-            self.f_id += 1
-            new_function.function_name = f'FUNC-{new_function.function_id}/{new_function.function_type}'
-            self.ftable.add_function(new_function)
-            self.generate_ftable_recursive(child_node)
-            return new_function
-
-    def generate_code(self):
-        print('VTABLE:')
-        print(self.vtable)
-
-
-        print('FTABLE:')
-        print(self.ftable)
-
-
-        basic_code = ''
-
-        for variable in self.vtable.variable_list:
-            if variable.var_type == 'S':
-                basic_code += 'LET $' + variable.var_name + ' = ' + variable.var_value
-            else:
-                basic_code += 'LET ' + variable.var_name + ' = ' + variable.var_value
-
-        for function in self.ftable.function_list:
-            if function.function_type == self.FT_LOOP_WHILE:
-                basic_code += f'if UNOP then GOSUB {function}'
-            elif function.function_type == self.FT_BINOP_PLUS:
-                basic_code += f'{function.function_arg1.variable_name} + {function.function_arg2.variable_name}\n'
-            elif function.function_type == self.FT_BINOP_MINUS:
-                basic_code += f'{function.function_arg1.variable_name} - {function.function_arg2.variable_name}\n'
-            elif function.function_type == self.FT_BINOP_TIMES:
-                basic_code += f'{function.function_arg1.variable_name} * {function.function_arg2.variable_name}\n'
-            elif function.function_type == self.FT_BINOP_LARGER:
-                basic_code += f'{function.function_arg1.variable_name} > {function.function_arg2.variable_name}\n'
-            elif function.function_type == self.FT_BINOP_EQ:
-                basic_code += f'{function.function_arg1.variable_name} = {function.function_arg2.variable_name}\n'
-
-
-
-        basic_code += 'END\n'
-        basic_code += 'STOP'
-
-        text_file = open('data.txt', 'w')
-        text_file.write(basic_code)
-        text_file.close()
-
-        os.startfile('data.txt')
+    def generate_ir(self):
+        # The program in three-address code, an IRProgram
+        bindings = self.bindings
+        if bindings is None:
+            checker = DeclarationChecker()
+            walk(self.parent_node, checker)
+            bindings = checker.bindings
+        ir_generator = IRGenerator(bindings, self.procedures)
+        walk(self.parent_node, ir_generator)
+        return ir_generator.ir_program()
+
+    def generate_basic(self, emitter=None, program=None):
+        # Returns the program as line-numbered BASIC, or emits it through emitter (a CodeEmitter) if given. program
+        # is its IRProgram, if already generated
+        generator_log.info('VTABLE:')
+        generator_log.info('%s', self.vtable)
+
+        generator_log.info('FTABLE:')
+        generator_log.info('%s', self.ftable)
+
+        if program is None:
+            program = self.generate_ir()
+        generator_log.debug('IR:\n%s', program)
+
+        code = emitter if emitter is not None else CodeEmitter()
+        assemble_basic(BasicTranslator(program).translate(), code)
+        if emitter is None:
+            return code.getvalue()
+        code.flush()
+        return None
 
+    def generate_code(self, output_path=DEFAULT_OUTPUT_PATH, open_output=False, program=None):
+        # Writes the BASIC to output_path a chunk at a time, and opens it in the default program for .txt files if
+        # open_output is set and the platform can (Windows only). program is as for generate_basic
+        with open(output_path, 'w') as output_file:
+            self.generate_basic(CodeEmitter(output_file), program)
+        if open_output and hasattr(os, 'startfile'):
+            os.startfile(output_path)
 
     def convert_types(self, type, content):
         if type == TT_NUMBER:
@@ -1374,14 +3057,1683 @@ class AstIntermediateGenerator:
         if type == TT_SHORTSTRING:
             return 'S'
 
+
+class VtableBuilder(NodeVisitor):
+    # The pass behind AstIntermediateGenerator.generate_vtable - a vtable entry for every declaration
+    def __init__(self, vtable):
+        super().__init__()
+        self.vtable = vtable
+
+    def enter_Dec(self, node):
+        self.vtable.add_variable(make_vtable_node(node, len(self.vtable.variable_list)))
+        return SKIP_CHILDREN
+
+    def enter_Algorithm(self, node):
+        # Declarations are never inside an algorithm
+        return SKIP_CHILDREN
+
+
+class FtableBuilder(NodeVisitor):
+    # The pass behind AstIntermediateGenerator.generate_ftable - an ftable entry for every operation, loop and
+    # branch. Argument Var nodes are recorded, and resolved by resolve_arguments once the vtable is complete, as SPL
+    # declares variables after the algorithm that uses them
+    BINOP_FUNCTION_TYPES = {'add': AstIntermediateGenerator.FT_BINOP_PLUS,
+                            'sub': AstIntermediateGenerator.FT_BINOP_MINUS,
+                            'mult': AstIntermediateGenerator.FT_BINOP_TIMES,
+                            'and': AstIntermediateGenerator.FT_BINOP_AND,
+                            'or': AstIntermediateGenerator.FT_BINOP_OR,
+                            'eq': AstIntermediateGenerator.FT_BINOP_EQ,
+                            'larger': AstIntermediateGenerator.FT_BINOP_LARGER}
+    UNOP_FUNCTION_TYPES = {'input': AstIntermediateGenerator.FT_UNOP_INPUT,
+                           'not': AstIntermediateGenerator.FT_UNOP_NOT}
+
+    def __init__(self, ftable, declare_procedures=False):
+        super().__init__()
+        self.ftable = ftable
+        # Whether to add the procs' entries too, as their scopes are entered, when rebuilding an ftable (see
+        # rebuild_ftable) - otherwise DeclarationChecker adds them
+        self.declare_procedures = declare_procedures
+
+    def enter_SPLProgram(self, node):
+        if not self.declare_procedures:
+            return
+        self.ftable.push_scope()
+        for child in node.node_contents:
+            if child is not None and child.node_class == NT_PROCDEFS:
+                for pd in child.node_contents:
+                    self.ftable.add_function(make_ftable_node(pd, len(self.ftable.function_list)))
+
+    enter_PD = enter_SPLProgram
+
+    def leave_SPLProgram(self, node):
+        if self.declare_procedures:
+            self.ftable.pop_scope()
+
+    leave_PD = leave_SPLProgram
+
+    def add_function(self, function_type, argument_1=None, argument_2=None):
+        new_function = Ftable_node()
+        new_function.function_id = len(self.ftable.function_list)
+        new_function.function_type = function_type
+        new_function.function_name = f'FUNC-{new_function.function_id}/{new_function.function_type}'
+        new_function.function_arg1 = self.argument_var(argument_1)
+        new_function.function_arg2 = self.argument_var(argument_2)
+        self.ftable.add_function(new_function)
+
+    def argument_var(self, node):
+        # The Var node of an argument Var or Expr, or None if it isn't a plain variable
+        if node is not None and node.node_class == NT_EXPR:
+            node = node.node_contents[0]
+        if node is not None and node.node_class == NT_VAR:
+            return node
+        return None
+
+    def enter_BinOp(self, node):
+        operator, argument_1, argument_2 = node.node_contents
+        self.add_function(self.BINOP_FUNCTION_TYPES[operator.node_contents.contents], argument_1, argument_2)
+
+    def enter_UnOp(self, node):
+        operator, argument = node.node_contents
+        self.add_function(self.UNOP_FUNCTION_TYPES[operator.node_contents.contents], argument)
+
+    def enter_Loop(self, node):
+        # do Algorithm until Expr, or while Expr do Algorithm
+        if node.node_contents[0].node_contents.contents == 'do':
+            self.add_function(AstIntermediateGenerator.FT_LOOP_DO, node.node_contents[3])
+        else:
+            self.add_function(AstIntermediateGenerator.FT_LOOP_WHILE, node.node_contents[1])
+
+    def enter_Branch(self, node):
+        self.add_function(AstIntermediateGenerator.FT_BRANCH, node.node_contents[1])
+
+    def resolve_arguments(self, vtable, bindings=None):
+        # Replaces the argument Var nodes with their vtable entries - from the analyst's bindings when given, or
+        # else by name alone, as the generated code has a single flat set of variables
+        if bindings is None:
+            bindings = {}
+            variables = {variable.var_name: variable for variable in vtable.variable_list}
+            for function in self.ftable.function_list:
+                for argument in (function.function_arg1, function.function_arg2):
+                    if argument is not None:
+                        bindings[argument] = variables.get(argument.node_contents.contents)
+        for function in self.ftable.function_list:
+            if isinstance(function.function_arg1, Node):
+                function.function_arg1 = bindings.get(function.function_arg1)
+            if isinstance(function.function_arg2, Node):
+                function.function_arg2 = bindings.get(function.function_arg2)
+
+
+# Optimisation
+# How each binary operation works out its value, when the constant folder does it at compile time - as at run time
+FOLDING_OPERATIONS = {'add': operator.add, 'sub': operator.sub, 'mult': operator.mul,
+                      'and': operator.and_, 'or': operator.or_, 'eq': operator.eq, 'larger': operator.gt}
+
+
+def constant_value(token):
+    # The value of a Const node's token - an int or float, a bool, or a str without its quotes
+    if token.type == TT_SHORTSTRING:
+        return token.contents[1:-1]
+    if token.type == TT_NUMBER:
+        return float(token.contents) if '.' in token.contents else int(token.contents)
+    return token.contents == 'true'
+
+
+def is_int(value, number):
+    # Whether value is the int number - not a float or bool equal to it, which would change the type of a result
+    return value.__class__ is int and value == number
+
+
+class ConstantFolder(NodeVisitor):
+    # Simplifies the expressions of a checked tree in place, each Expr as it is left, so that folding works up
+    # through nested operations: an operation on constants becomes a Const, and identities - add(x, 0), sub(x, 0),
+    # mult(x, 1), and(true, x), or(false, x), not(not(x)) - become x. and(false, x) and or(true, x) become constants
+    # too, but only when x has no input in it, as that reads a number whatever the result. A new Const keeps the
+    # node id and span of the operation it replaces, with a token made here
+    def __init__(self):
+        super().__init__()
+        self.folded = 0
+        # Expr nodes with an input in them
+        self.reads_input = set()
+
+    def leave_Expr(self, node):
+        operation = node.node_contents[0]
+        if operation.node_class == NT_BINOP:
+            replacement = self.fold_binop(operation)
+        elif operation.node_class == NT_UNOP:
+            replacement = self.fold_unop(operation)
+        else:
+            replacement = None
+        if replacement is not None:
+            node.node_contents[0] = operation = replacement
+            self.folded += 1
+        if operation.node_class == NT_UNOP and operation.node_contents[0].node_contents.contents == 'input':
+            self.reads_input.add(node)
+        elif operation.node_class in (NT_BINOP, NT_UNOP) and any(
+                argument in self.reads_input for argument in operation.node_contents[1:]):
+            self.reads_input.add(node)
+
+    def value(self, expr):
+        # The value of an argument Expr that is a constant, or None
+        if expr.node_contents[0].node_class == NT_CONST:
+            return constant_value(expr.node_contents[0].node_contents)
+        return None
+
+    def fold_binop(self, node):
+        operator_word = node.node_contents[0].node_contents.contents
+        argument_1, argument_2 = node.node_contents[1:]
+        value_1, value_2 = self.value(argument_1), self.value(argument_2)
+        if value_1 is not None and value_2 is not None:
+            return self.constant(FOLDING_OPERATIONS[operator_word](value_1, value_2), node)
+        if operator_word == 'add' and is_int(value_1, 0) or operator_word == 'mult' and is_int(value_1, 1):
+            return argument_2.node_contents[0]
+        if operator_word in ('add', 'sub') and is_int(value_2, 0) or operator_word == 'mult' and is_int(value_2, 1):
+            return argument_1.node_contents[0]
+        if operator_word in ('and', 'or'):
+            # The identity is true for and, false for or - the other value decides the result by itself
+            identity = operator_word == 'and'
+            for value, other in ((value_1, argument_2), (value_2, argument_1)):
+                if value is identity:
+                    return other.node_contents[0]
+                if value is (not identity) and other not in self.reads_input:
+                    return self.constant(value, node)
+        return None
+
+    def fold_unop(self, node):
+        operator_word, argument = node.node_contents[0].node_contents.contents, node.node_contents[1]
+        if operator_word != 'not':
+            return None
+        value = self.value(argument)
+        if value is not None:
+            return self.constant(not value, node)
+        inner = argument.node_contents[0]
+        if inner.node_class == NT_UNOP and inner.node_contents[0].node_contents.contents == 'not':
+            return inner.node_contents[1].node_contents[0]
+        return None
+
+    def constant(self, value, node):
+        # A Const node for value in place of node, or None if value can't be written as an SPL constant
+        if value is True or value is False:
+            token = Token(TT_KEYWORD, node.first_token.id, 'true' if value else 'false')
+        else:
+            try:
+                contents = repr(value)
+            except ValueError:
+                return None
+            match = TOKEN_REGEX.fullmatch(contents)
+            if match is None or match.lastgroup != 'NUMBER':
+                return None
+            token = Token(TT_NUMBER, node.first_token.id, contents)
+        return Node(node.node_id, NT_CONST, token, node.last_token, node.first_token)
+
+
+class DeadCodeEliminator(NodeVisitor):
+    # Strips the instructions that can never run, as each Algorithm is left: a branch on a constant condition
+    # becomes the instructions of the side taken, a loop whose condition is false from the start nothing - or, for
+    # do-until, its body once - and the instructions after a loop that never ends (while true, until false) go, as
+    # SPL has no way out of one. Algorithms, Alternats and ProcDefs left empty become None in their parents, as the
+    # parser leaves missing ones. remove_unreachable_procedures and remove_unused_declarations finish the job
+    def __init__(self):
+        super().__init__()
+        self.removed = 0
+
+    def condition(self, expr):
+        # The value of a condition that is a constant, or None
+        if expr.node_contents[0].node_class == NT_CONST:
+            return constant_value(expr.node_contents[0].node_contents)
+        return None
+
+    def leave_Algorithm(self, node):
+        instructions = []
+        for position, instruction in enumerate(node.node_contents):
+            statement = instruction.node_contents[0]
+            if statement.node_class == NT_BRANCH:
+                # if Expr then Algorithm Alternat
+                condition = self.condition(statement.node_contents[1])
+                alternat = statement.node_contents[4]
+                if condition is not None:
+                    taken = statement.node_contents[3] if condition else (alternat.node_contents[1] if alternat
+                                                                          else None)
+                    instructions.extend(taken.node_contents if taken is not None else [])
+                    self.removed += 1
+                    continue
+                if alternat is not None and alternat.node_contents[1] is None:
+                    statement.node_contents[4] = None
+            elif statement.node_class == NT_LOOP:
+                if statement.node_contents[0].node_contents.contents == 'do':
+                    # do Algorithm until Expr
+                    body, condition = statement.node_contents[1], self.condition(statement.node_contents[3])
+                    ends = condition is not False
+                    if condition:
+                        instructions.extend(body.node_contents if body is not None else [])
+                        self.removed += 1
+                        continue
+                else:
+                    # while Expr do Algorithm
+                    condition = self.condition(statement.node_contents[1])
+                    ends = condition is not True
+                    if condition is False:
+                        self.removed += 1
+                        continue
+                if not ends:
+                    instructions.append(instruction)
+                    self.removed += len(node.node_contents) - position - 1
+                    break
+            instructions.append(instruction)
+        node.node_contents[:] = instructions
+
+    def leave_node(self, node):
+        # Drops the children an earlier leave_Algorithm (or the eliminator's other passes) left empty
+        if node.has_children():
+            children = node.node_contents
+            for index, child in enumerate(children):
+                if child is not None and child.node_class in (NT_ALGORITHM, NT_PROCDEFS, NT_VARDECL) \
+                        and not child.node_contents:
+                    children[index] = None
+
+
+def remove_unreachable_procedures(program_node):
+    # Removes every proc no call can reach from main, following calls through the procs they reach. Returns the
+    # number of procs removed
+    calls = {}
+    # Each open scope's procs by name, innermost last, and the open PDs (None for main), innermost last
+    scopes = []
+    callers = [None]
+    stack = [(program_node, False)]
+    while stack:
+        node, leaving = stack.pop()
+        if leaving:
+            scopes.pop()
+            if node.node_class == NT_PD:
+                callers.pop()
+            continue
+        if node.node_class in (NT_SPLPROGRAM, NT_PD):
+            if node.node_class == NT_PD:
+                callers.append(node)
+            scope = {}
+            for child in node.node_contents:
+                if child is not None and child.node_class == NT_PROCDEFS:
+                    for pd in child.node_contents:
+                        scope[pd.node_contents[1].node_contents.contents] = pd
+            scopes.append(scope)
+            stack.append((node, True))
+        elif node.node_class == NT_PCALL:
+            name = node.node_contents[1].node_contents.contents
+            callee = next(scope[name] for scope in reversed(scopes) if name in scope)
+            calls.setdefault(callers[-1], []).append(callee)
+            continue
+        if node.has_children():
+            stack.extend((child, False) for child in reversed(node.node_contents)
+                         if child is not None and child.node_class not in (NT_VARDECL, NT_EXPR))
+
+    reached = set()
+    pending = [None]
+    while pending:
+        for callee in calls.get(pending.pop(), ()):
+            if callee not in reached:
+                reached.add(callee)
+                pending.append(callee)
+
+    removed = 0
+    for node in list(preorder(program_node)):
+        if node.node_class == NT_PROCDEFS:
+            pds = [pd for pd in node.node_contents if pd in reached]
+            removed += len(node.node_contents) - len(pds)
+            node.node_contents[:] = pds
+    return removed
+
+
+def remove_unused_declarations(program_node, bindings):
+    # Removes the declarations of variables no longer used anywhere, and forgets the bindings of removed nodes.
+    # Returns the vtable entries of the variables still used
+    used = set()
+    live_bindings = {}
+    declarations = []
+    for node in preorder(program_node):
+        variable = bindings.get(node)
+        if variable is not None:
+            used.add(variable)
+            live_bindings[node] = variable
+        elif node.node_class == NT_VARDECL:
+            declarations.append(node)
+    used_tokens = {variable.var_token for variable in used}
+    for var_decl in declarations:
+        # Each Dec ends with the Var it declares
+        var_decl.node_contents[:] = [dec for dec in var_decl.node_contents
+                                     if dec.node_contents[-1].node_contents in used_tokens]
+    bindings.clear()
+    bindings.update(live_bindings)
+    return used
+
+
+def rebuild_ftable(program_node, bindings):
+    # A new ftable for a tree the optimiser has changed - entries for the procs, operations, loops and branches
+    # left, in the order analysis adds them
+    ftable_builder = FtableBuilder(Ftable(), True)
+    walk(program_node, ftable_builder)
+    ftable_builder.resolve_arguments(None, bindings)
+    return ftable_builder.ftable
+
+
+# Three-address code
+# Opcodes of the intermediate representation - each instruction has an opcode, a destination and up to two
+# arguments. Operands are variables (vtable entries), constants (their tokens) and temporaries; labels are ints
+IR_LABEL = 0            # label [arg1] marks this place
+IR_COPY = 1             # dest := arg1
+IR_ADD = 2              # dest := arg1 + arg2, and so on for the other binary operations
+IR_SUB = 3
+IR_MULT = 4
+IR_AND = 5
+IR_OR = 6
+IR_EQ = 7
+IR_LARGER = 8
+IR_NOT = 9              # dest := not arg1
+IR_LOAD_ELEMENT = 10    # dest := arg1[arg2]
+IR_STORE_ELEMENT = 11   # dest[arg1] := arg2
+IR_INPUT = 12           # read a number into variable dest
+IR_OUTPUT = 13          # write arg1 out
+IR_JUMP = 14            # go to label arg1
+IR_JUMP_IF_FALSE = 15   # go to label arg2 if arg1 is false
+IR_CALL = 16            # go to label arg1, coming back on return
+IR_RETURN = 17
+IR_END = 18
+IR_OPCODE_NAMES = ('LABEL', 'COPY', 'ADD', 'SUB', 'MULT', 'AND', 'OR', 'EQ', 'LARGER', 'NOT', 'LOAD_ELEMENT',
+                   'STORE_ELEMENT', 'INPUT', 'OUTPUT', 'JUMP', 'JUMP_IF_FALSE', 'CALL', 'RETURN', 'END')
+IR_BINOP_OPCODES = {'add': IR_ADD, 'sub': IR_SUB, 'mult': IR_MULT, 'and': IR_AND, 'or': IR_OR, 'eq': IR_EQ,
+                    'larger': IR_LARGER}
+# Opcodes after which a basic block ends
+IR_BLOCK_ENDS = frozenset([IR_JUMP, IR_JUMP_IF_FALSE, IR_CALL, IR_RETURN, IR_END])
+
+
+class IRTemporary:
+    # A value one instruction works out for another - each temporary is set once and used once
+    __slots__ = ('temp_id', 'var_type')
+
+    def __init__(self, temp_id, var_type):
+        self.temp_id = temp_id
+        self.var_type = var_type
+
+    def __repr__(self):
+        return f't{self.temp_id}'
+
+
+class IRInstruction:
+    # token is the source token of an instruction that can fail at run time
+    __slots__ = ('opcode', 'dest', 'arg1', 'arg2', 'token')
+
+    def __init__(self, opcode, dest=None, arg1=None, arg2=None, token=None):
+        self.opcode = opcode
+        self.dest = dest
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.token = token
+
+    def __repr__(self):
+        dest, arg1, arg2 = (operand_text(operand) for operand in (self.dest, self.arg1, self.arg2))
+        opcode = self.opcode
+        if opcode == IR_LABEL:
+            return f'L{self.arg1}:'
+        if opcode == IR_COPY:
+            return f'    {dest} := {arg1}'
+        if opcode == IR_NOT:
+            return f'    {dest} := not {arg1}'
+        if opcode == IR_LOAD_ELEMENT:
+            return f'    {dest} := {arg1}[{arg2}]'
+        if opcode == IR_STORE_ELEMENT:
+            return f'    {dest}[{arg1}] := {arg2}'
+        if opcode in (IR_JUMP, IR_CALL):
+            return f'    {IR_OPCODE_NAMES[opcode].lower()} L{self.arg1}'
+        if opcode == IR_JUMP_IF_FALSE:
+            return f'    if not {arg1} jump L{self.arg2}'
+        if IR_ADD <= opcode <= IR_LARGER:
+            return f'    {dest} := {arg1} {IR_OPCODE_NAMES[opcode].lower()} {arg2}'
+        return f'    {IR_OPCODE_NAMES[opcode].lower()} {dest if opcode == IR_INPUT else arg1}'.rstrip()
+
+
+def operand_text(operand):
+    # How an IR listing shows an operand
+    if operand.__class__ is Vtable_node:
+        return operand.var_name
+    if operand.__class__ is Token:
+        return operand.contents
+    return '' if operand is None else repr(operand)
+
+
+class CodeGenerator(NodeVisitor, metaclass=ABCMeta):
+    # Base of the code generation passes, which build each node's code bottom-up, as it is left. Code is a list of
+    # items, whose kind is up to the subclass - this class gives each proc a label (an int) in its scope, sets the
+    # arrays aside, and joins the code of statements and procs in order. Subclasses give the code of a call to a proc
+    # by its label, and lay out loops, branches, procs and the program - with jumps for LabelledCodeGenerator's, and
+    # with Python's own statements for PythonCompiler
+    def __init__(self, bindings):
+        super().__init__()
+        self.bindings = bindings
+        self.labels = count()
+        # The code of each statement-level node
+        self.lines = {}
+        # The label of each proc, by name, for each open scope - innermost last
+        self.procedures = []
+        # (name token, size token) of each array declared, whose space is set aside before the program starts
+        self.dimensions = []
+        self.program = None
+
+    @abstractmethod
+    def call(self, label):
+        pass
+
+    def arrays(self):
+        # (vtable entry, size) of every array used
+        variables = {variable.var_token: variable for variable in self.bindings.values()}
+        arrays = []
+        for name, size in self.dimensions:
+            variable = variables.get(name)
+            if variable is None:
+                continue
+            if size.type != TT_NUMBER or not size.contents.isdigit():
+                raise SemanticError('Semantic Error! An array size should be a whole number, not ' + size.contents,
+                                    size)
+            arrays.append((variable, int(size.contents)))
+        return arrays
+
+    def block(self, node):
+        # The code of an algorithm, or none for a missing one
+        return self.lines.pop(node, []) if node is not None else []
+
+    def enter_SPLProgram(self, node):
+        scope = {}
+        for child in node.node_contents:
+            if child is not None and child.node_class == NT_PROCDEFS:
+                for pd in child.node_contents:
+                    scope[pd.node_contents[1].node_contents.contents] = next(self.labels)
+        self.procedures.append(scope)
+
+    enter_PD = enter_SPLProgram
+
+    def enter_Dec(self, node):
+        # arr TYP [Const] Var
+        if len(node.node_contents) == 4:
+            self.dimensions.append((node.node_contents[3].node_contents, node.node_contents[2].node_contents))
+        return SKIP_CHILDREN
+
+    def enter_PCall(self, node):
+        name = node.node_contents[1].node_contents.contents
+        label = next(scope[name] for scope in reversed(self.procedures) if name in scope)
+        self.lines[node] = [self.call(label)]
+        return SKIP_CHILDREN
+
+    def leave_Instruction(self, node):
+        self.lines[node] = self.lines.pop(node.node_contents[0])
+
+    def leave_Algorithm(self, node):
+        lines = []
+        for instruction in node.node_contents:
+            lines.extend(self.lines.pop(instruction))
+        self.lines[node] = lines
+
+    def leave_ProcedureDefinitions(self, node):
+        lines = []
+        for pd in node.node_contents:
+            lines.extend(self.lines.pop(pd))
+        self.lines[node] = lines
+
+
+class LabelledCodeGenerator(CodeGenerator):
+    # Base of the code generators that lay out control flow with jumps: main, then the end of the program, then
+    # every proc, each starting at its label and ending in a return. Labels (ints) among the items mark the places a
+    # jump goes to, which the backend's assembler turns into addresses once the whole program is laid out.
+    # Subclasses give the instructions below, and those for jump and condition_jump
+    end_instruction = None
+    return_instruction = None
+
+    @abstractmethod
+    def jump(self, label):
+        pass
+
+    @abstractmethod
+    def condition_jump(self, condition, label):
+        # The code that jumps to label when expression node condition is false
+        pass
+
+    def prologue(self):
+        # The code run before main
+        return []
+
+    def leave_Loop(self, node):
+        top = next(self.labels)
+        if node.node_contents[0].node_contents.contents == 'do':
+            # do Algorithm until Expr - round again while the condition is false
+            self.lines[node] = [top, *self.block(node.node_contents[1]), *self.condition_jump(node.node_contents[3],
+                                                                                                top)]
+        else:
+            # while Expr do Algorithm
+            end = next(self.labels)
+            self.lines[node] = [top, *self.condition_jump(node.node_contents[1], end),
+                                *self.block(node.node_contents[3]), self.jump(top), end]
+
+    def leave_Branch(self, node):
+        # if Expr then Algorithm Alternat - the else Algorithm, if any, is the Alternat's second child
+        alternat = node.node_contents[4]
+        end = next(self.labels)
+        if alternat is None:
+            self.lines[node] = [*self.condition_jump(node.node_contents[1], end), *self.block(node.node_contents[3]),
+                                end]
+        else:
+            other = next(self.labels)
+            self.lines[node] = [*self.condition_jump(node.node_contents[1], other),
+                                *self.block(node.node_contents[3]), self.jump(end), other,
+                                *self.block(alternat.node_contents[1]), end]
+
+    def leave_PD(self, node):
+        # The proc's own code, then the procs declared inside it - Keyword Var ProcDefs Algorithm Keyword VarDecl
+        label = self.procedures[-2][node.node_contents[1].node_contents.contents]
+        self.procedures.pop()
+        self.lines[node] = [label, *self.block(node.node_contents[3]), self.return_instruction,
+                            *self.block(node.node_contents[2])]
+
+    def leave_SPLProgram(self, node):
+        # ProcDefs Keyword Algorithm Keyword VarDecl
+        self.procedures.pop()
+        self.program = [*self.prologue(), *self.block(node.node_contents[2]), self.end_instruction,
+                        *self.block(node.node_contents[0])]
+
+
+class IRGenerator(LabelledCodeGenerator):
+    # The pass behind AstIntermediateGenerator.generate_ir - lowers a checked parse tree to an IRProgram. An
+    # expression's code is the instructions that work out its value and the operand holding it, and the other items
+    # are IRInstructions. Operands are read left to right, and an assignment's value before an array element's
+    # index, as in the run tiers
+    # Given the ProcedureInstance of each PD that has a ProcedureSummary (as SemanticAnalysis.procedures), it links
+    # in the summary's CodeFragment rather than walking the PD again, or else makes one from the PD's code
+    def __init__(self, bindings, procedures=None):
+        super().__init__(bindings)
+        self.instances = procedures or {}
+        self.temporary_count = 0
+        # (instructions, operand) by expression node - or for a Field assigned to, (instructions, index operand,
+        # array, token)
+        self.values = {}
+        # Fields that are assigned to rather than read
+        self.targets = set()
+        # Every variable used, in the order the tree first uses them, and every use while a fragment is being made
+        self.variables = {}
+        self.variable_log = []
+        # (PD node, and the temporary count, variable_log length and dimensions length on entering it) for each PD
+        # a fragment is being made of
+        self.open_fragments = []
+
+    @property
+    def end_instruction(self):
+        return IRInstruction(IR_END)
+
+    @property
+    def return_instruction(self):
+        return IRInstruction(IR_RETURN)
+
+    def temporary(self, var_type):
+        self.temporary_count += 1
+        return IRTemporary(self.temporary_count - 1, var_type)
+
+    def variable(self, variable):
+        self.variables[variable] = None
+        if self.open_fragments:
+            self.variable_log.append(variable)
+        return variable
+
+    def enter_PD(self, node):
+        instance = self.instances.get(node)
+        if instance is not None:
+            if instance.summary.fragment is not None:
+                self.lines[node] = self.link(node, instance)
+                return SKIP_NODE
+            self.open_fragments.append((node, self.temporary_count, len(self.variable_log), len(self.dimensions)))
+        return super().enter_PD(node)
+
+    def leave_PD(self, node):
+        super().leave_PD(node)
+        if self.open_fragments and self.open_fragments[-1][0] is node:
+            _, temporary_start, log_start, dimension_start = self.open_fragments.pop()
+            self.instances[node].summary.fragment = self.fragment(node, self.instances[node], temporary_start,
+                                                                  log_start, dimension_start)
+            if not self.open_fragments:
+                del self.variable_log[:]
+
+    def fragment(self, node, instance, temporary_start, log_start, dimension_start):
+        # The CodeFragment of a PD just generated
+        first_token_id = node.first_token.id
+        local_variables = {id(variable): index for index, variable in enumerate(instance.variables)}
+        procedure_names = {label: name for scope in self.procedures for name, label in scope.items()}
+        lines = self.lines[node]
+        labels = {}
+        for item in lines:
+            if isinstance(item, int):
+                labels[item] = len(labels)
+        items = []
+        for item in lines:
+            if isinstance(item, int):
+                items.append(labels[item])
+                continue
+            operands = [encode_operand(operand, local_variables, temporary_start)
+                        for operand in (item.dest, item.arg1, item.arg2)]
+            if item.opcode in (IR_JUMP, IR_CALL, IR_JUMP_IF_FALSE):
+                # The label argument - one of the fragment's, or a proc outside it, by name
+                position = 2 if item.opcode == IR_JUMP_IF_FALSE else 1
+                label = operands[position]
+                operands[position] = labels[label] if label in labels else ('proc', procedure_names[label])
+            items.append((item.opcode, *operands, None if item.token is None else item.token.id - first_token_id))
+        variables = [encode_operand(variable, local_variables, temporary_start)
+                     for variable in dict.fromkeys(self.variable_log[log_start:])]
+        # Arrays are declared in the PD, so their variables are its own
+        local_tokens = {variable.var_token: index for index, variable in enumerate(instance.variables)}
+        arrays = [(local_tokens[name], size.id - first_token_id) for name, size in self.dimensions[dimension_start:]]
+        return CodeFragment(items, len(labels), self.temporary_count - temporary_start, variables, arrays)
+
+    def link(self, node, instance):
+        # The code of a PD from its summary's CodeFragment, with the fragment's labels, temporaries and variables
+        # swapped for this program's - and its arrays and variables noted as if the PD had been walked
+        fragment = instance.summary.fragment
+        tokens = instance.tokens
+        first_token_id = node.first_token.id
+        labels = [self.procedures[-1][node.node_contents[1].node_contents.contents]]
+        labels.extend(next(self.labels) for _ in range(fragment.label_count - 1))
+        temporaries = {}
+        temporary_start = self.temporary_count
+        self.temporary_count += fragment.temporary_count
+        for variable in fragment.variables:
+            self.variable(decode_operand(variable, instance, first_token_id, temporaries, temporary_start))
+        for variable_index, size_offset in fragment.arrays:
+            self.dimensions.append((instance.variables[variable_index].var_token,
+                                    tokens[first_token_id + size_offset]))
+
+        items = []
+        for item in fragment.items:
+            if isinstance(item, int):
+                items.append(labels[item])
+                continue
+            opcode, *operands, token_offset = item
+            operands = [decode_operand(operand, instance, first_token_id, temporaries, temporary_start)
+                        for operand in operands]
+            if opcode in (IR_JUMP, IR_CALL, IR_JUMP_IF_FALSE):
+                position = 2 if opcode == IR_JUMP_IF_FALSE else 1
+                label = operands[position]
+                if isinstance(label, int):
+                    operands[position] = labels[label]
+                else:
+                    operands[position] = next(scope[label[1]] for scope in reversed(self.procedures)
+                                              if label[1] in scope)
+            items.append(IRInstruction(opcode, *operands, None if token_offset is None
+                                       else tokens[first_token_id + token_offset]))
+        return items
+
+    def jump(self, label):
+        return IRInstruction(IR_JUMP, None, label)
+
+    def call(self, label):
+        return IRInstruction(IR_CALL, None, label)
+
+    def condition_jump(self, condition, label):
+        code, operand = self.values.pop(condition)
+        return [*code, IRInstruction(IR_JUMP_IF_FALSE, None, operand, label)]
+
+    def held(self, code, operand, later_code):
+        # code and operand, copying operand into a temporary first if it's a variable later_code reads input into -
+        # so that it keeps the value it had before
+        if operand.__class__ is Vtable_node and any(instruction.opcode == IR_INPUT and instruction.dest is operand
+                                                    for instruction in later_code):
+            temporary = self.temporary(operand.var_type)
+            return [*code, IRInstruction(IR_COPY, temporary, operand)], temporary
+        return code, operand
+
+    def enter_LHS(self, node):
+        if node.has_children() and node.node_contents[0].node_class == NT_FIELD:
+            self.targets.add(node.node_contents[0])
+
+    def leave_Const(self, node):
+        self.values[node] = ([], node.node_contents)
+
+    def leave_Var(self, node):
+        # Only uses are bound - the names of procs and declarations aren't values
+        variable = self.bindings.get(node)
+        if variable is not None:
+            self.values[node] = ([], self.variable(variable))
+
+    def leave_Field(self, node):
+        array, index = node.node_contents
+        code, operand = self.values.pop(index)
+        variable = self.variable(self.bindings[array])
+        if node in self.targets:
+            self.targets.discard(node)
+            self.values[node] = (code, operand, variable, array.node_contents)
+            return
+        temporary = self.temporary(variable.var_type)
+        self.values[node] = ([*code, IRInstruction(IR_LOAD_ELEMENT, temporary, variable, operand,
+                                                   array.node_contents)], temporary)
+
+    def leave_Expr(self, node):
+        self.values[node] = self.values.pop(node.node_contents[0])
+
+    def leave_UnOp(self, node):
+        operator, argument = node.node_contents
+        if operator.node_contents.contents == 'input':
+            # input(Var) reads a number into the Var, and has its value
+            variable = self.values.pop(argument)[1]
+            self.values[node] = ([IRInstruction(IR_INPUT, variable, None, None, operator.node_contents)], variable)
+        else:
+            code, operand = self.values.pop(argument)
+            temporary = self.temporary('B')
+            self.values[node] = ([*code, IRInstruction(IR_NOT, temporary, operand)], temporary)
+
+    def leave_BinOp(self, node):
+        operator, argument_1, argument_2 = node.node_contents
+        code_2, operand_2 = self.values.pop(argument_2)
+        code_1, operand_1 = self.held(*self.values.pop(argument_1), code_2)
+        operation = operator.node_contents.contents
+        temporary = self.temporary(BINOP_TYPES[operation][1])
+        self.values[node] = ([*code_1, *code_2, IRInstruction(IR_BINOP_OPCODES[operation], temporary, operand_1,
+                                                              operand_2)], temporary)
+
+    def leave_Assignment(self, node):
+        lhs, expr = node.node_contents
+        code, operand = self.values.pop(expr)
+        if not lhs.has_children():
+            self.lines[node] = [*code, IRInstruction(IR_OUTPUT, None, operand)]
+            return
+        target = self.values.pop(lhs.node_contents[0])
+        if len(target) == 4:
+            index_code, index, variable, token = target
+            code, operand = self.held(code, operand, index_code)
+            self.lines[node] = [*code, *index_code, IRInstruction(IR_STORE_ELEMENT, variable, index, operand, token)]
+        elif operand.__class__ is IRTemporary:
+            # Work the value out straight into the variable - the temporary, made last, is given back
+            code[-1].dest = target[1]
+            if operand.temp_id == self.temporary_count - 1:
+                self.temporary_count -= 1
+            self.lines[node] = code
+        elif operand is target[1]:
+            # The value is already in the variable, as for n := input(n)
+            self.lines[node] = code
+        else:
+            self.lines[node] = [*code, IRInstruction(IR_COPY, target[1], operand)]
+
+    def ir_program(self):
+        # The IRProgram, once the tree has been walked
+        instructions = [IRInstruction(IR_LABEL, None, item) if isinstance(item, int) else item
+                        for item in self.program]
+        return IRProgram(instructions, list(self.variables), self.arrays(), self.temporary_count)
+
+
+class CodeFragment:
+    # The code of a PD as its ProcedureSummary keeps it, relative to the PD, so that IRGenerator.link can place it
+    # in any program where the summary applies:
+    # - items - IRGenerator's items for the PD, with labels numbered from 0 (the proc's own) in the order placed,
+    #   and each instruction as (opcode, dest, arg1, arg2, fault token offset or None), operands as encode_operand
+    #   gives them - except for a label argument, which is a label number or ('proc', name) for a proc outside
+    # - label_count, temporary_count
+    # - variables - every variable used, in the order first used
+    # - arrays - (index into the ProcedureInstance's variables, size token offset) of each array declared
+    def __init__(self, items, label_count, temporary_count, variables, arrays):
+        self.items = items
+        self.label_count = label_count
+        self.temporary_count = temporary_count
+        self.variables = variables
+        self.arrays = arrays
+
+
+def encode_operand(operand, local_variables, temporary_start):
+    # An IR operand as a CodeFragment keeps it - ('local', index into the ProcedureInstance's variables), ('free',
+    # name), ('temporary', number from the PD's first, type) or ('constant', token type, contents). Labels (ints)
+    # and None are kept as they are
+    if operand.__class__ is Vtable_node:
+        local_index = local_variables.get(id(operand))
+        return ('free', operand.var_name) if local_index is None else ('local', local_index)
+    if operand.__class__ is IRTemporary:
+        return 'temporary', operand.temp_id - temporary_start, operand.var_type
+    if operand.__class__ is Token:
+        return 'constant', operand.type, operand.contents
+    return operand
+
+
+def decode_operand(operand, instance, first_token_id, temporaries, temporary_start):
+    # The operand encode_operand encoded, for the PD of instance - temporaries keeps each temporary made, as every
+    # use of one must be the same object
+    if operand.__class__ is not tuple or operand[0] == 'proc':
+        return operand
+    kind = operand[0]
+    if kind == 'local':
+        return instance.variables[operand[1]]
+    if kind == 'free':
+        return instance.free_variables[operand[1]]
+    if kind == 'temporary':
+        temporary = temporaries.get(operand[1])
+        if temporary is None:
+            temporary = temporaries[operand[1]] = IRTemporary(temporary_start + operand[1], operand[2])
+        return temporary
+    return Token(operand[1], first_token_id, operand[2])
+
+
+class IRProgram:
+    # A program in three-address code, as IRGenerator lowers it:
+    # - instructions - main, then the end of the program, then every proc, each starting at its label and ending in
+    #   a return
+    # - variables - every variable used, in the order the source first uses them
+    # - arrays - (vtable entry, size) of each array
+    # - temporary_count - temporaries are numbered from 0
+    def __init__(self, instructions, variables, arrays, temporary_count):
+        self.instructions = instructions
+        self.variables = variables
+        self.arrays = arrays
+        self.temporary_count = temporary_count
+
+    def control_flow_graph(self):
+        return ControlFlowGraph(self)
+
+    def __repr__(self):
+        return '\n'.join(repr(instruction) for instruction in self.instructions)
+
+
+class BasicBlock:
+    # Instructions [start, end) of a program, which run one after the other. successors and predecessors are the
+    # indexes of the blocks control can go to and come from, and callee that of the block a call at the end goes to
+    __slots__ = ('start', 'end', 'successors', 'predecessors', 'callee')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.successors = []
+        self.predecessors = []
+        self.callee = None
+
+    def __repr__(self):
+        return f'BasicBlock({self.start}, {self.end}) -> {self.successors}'
+
+
+class ControlFlowGraph:
+    # The basic blocks of an IRProgram. A block starts at a label (or run of labels) and after each jump, call,
+    # return and end. A block ending in a call goes on to the next block, as the call returns there, and has the
+    # proc's first block as its callee
+    def __init__(self, program):
+        self.program = program
+        self.blocks = []
+        # Index of the block each label starts
+        self.label_blocks = {}
+        instructions = program.instructions
+        starts = []
+        new_block = True
+        for index, instruction in enumerate(instructions):
+            opcode = instruction.opcode
+            if new_block or (opcode == IR_LABEL and instructions[index - 1].opcode != IR_LABEL):
+                starts.append(index)
+            if opcode == IR_LABEL:
+                self.label_blocks[instruction.arg1] = len(starts) - 1
+            new_block = opcode in IR_BLOCK_ENDS
+        ends = starts[1:] + [len(instructions)]
+        self.blocks = [BasicBlock(start, end) for start, end in zip(starts, ends)]
+
+        label_blocks = self.label_blocks
+        for block_index, block in enumerate(self.blocks):
+            last = instructions[block.end - 1]
+            opcode = last.opcode
+            if opcode == IR_JUMP:
+                successors = [label_blocks[last.arg1]]
+            elif opcode == IR_JUMP_IF_FALSE:
+                successors = [block_index + 1, label_blocks[last.arg2]]
+            elif opcode in (IR_RETURN, IR_END):
+                successors = []
+            else:
+                successors = [block_index + 1] if block_index + 1 < len(self.blocks) else []
+                if opcode == IR_CALL:
+                    block.callee = label_blocks[last.arg1]
+            for successor in successors:
+                if successor not in block.successors:
+                    block.successors.append(successor)
+                    self.blocks[successor].predecessors.append(block_index)
+
+    def instructions(self, block):
+        return self.program.instructions[block.start:block.end]
+
+
+# BASIC backend
+# Line numbers of the generated BASIC - the first, the gap between lines, and the highest GW-BASIC accepts
+BASIC_FIRST_LINE = 10
+BASIC_LINE_STEP = 10
+BASIC_MAX_LINE = 65529
+# BASIC operator for each binary operation. Booleans are -1 (true) and 0 (false), as BASIC's comparisons give, so
+# that AND, OR and NOT work on them bit by bit
+BASIC_OPERATORS = {IR_ADD: '+', IR_SUB: '-', IR_MULT: '*', IR_AND: 'AND', IR_OR: 'OR', IR_EQ: '=', IR_LARGER: '>'}
+BASIC_BOOLEANS = {'true': '-1', 'false': '0'}
+
+
+class BasicTranslator:
+    # The pass behind AstIntermediateGenerator.generate_basic - turns an IRProgram into lines of BASIC text, and
+    # (text, label) jumps and labels for assemble_basic. Every SPL variable becomes one BASIC variable (V0, V1$,
+    # ...), as procs have no frames. A temporary is used once, just after it is worked out, so rather than a
+    # variable of its own it becomes part of the text of the instruction using it - unless a variable its text
+    # reads changes in between, when it is saved in a variable (T0, T1$, ...) first
+    def __init__(self, program):
+        self.program = program
+        self.names = {}
+        for variable in program.variables:
+            self.name(variable)
+        # (text, whether it's an operation, variables read) of each temporary worked out but not used yet
+        self.pending = {}
+        self.items = []
+
+    def name(self, variable):
+        name = self.names.get(variable)
+        if name is None:
+            name = self.names[variable] = f'V{len(self.names)}' + ('$' if variable.var_type == 'S' else '')
+        return name
+
+    def operand(self, operand, bracket=False):
+        # The text of an operand and the variables it reads - bracketed if bracket is set and it's an operation
+        if operand.__class__ is IRTemporary:
+            text, operation, reads = self.pending.pop(operand)
+            return (f'({text})' if bracket and operation else text), reads
+        if operand.__class__ is Vtable_node:
+            return self.name(operand), (operand,)
+        return BASIC_BOOLEANS.get(operand.contents, operand.contents), ()
+
+    def changing(self, variable):
+        # Saves the temporaries whose text reads variable, before it changes
+        for temporary, (text, operation, reads) in self.pending.items():
+            if variable in reads:
+                name = f'T{temporary.temp_id}' + ('$' if temporary.var_type == 'S' else '')
+                self.items.append(f'LET {name} = {text}')
+                self.pending[temporary] = (name, False, ())
+
+    def define(self, dest, text, operation, reads):
+        if dest.__class__ is IRTemporary:
+            self.pending[dest] = (text, operation, reads)
+        else:
+            self.changing(dest)
+            self.items.append(f'LET {self.name(dest)} = {text}')
+
+    def translate(self):
+        items = self.items
+        items.extend(f'DIM {self.name(variable)}({size})' for variable, size in self.program.arrays)
+        for instruction in self.program.instructions:
+            opcode = instruction.opcode
+            if opcode == IR_LABEL:
+                items.append(instruction.arg1)
+            elif IR_ADD <= opcode <= IR_LARGER:
+                text_1, reads_1 = self.operand(instruction.arg1, True)
+                text_2, reads_2 = self.operand(instruction.arg2, True)
+                self.define(instruction.dest, f'{text_1} {BASIC_OPERATORS[opcode]} {text_2}', True, reads_1 + reads_2)
+            elif opcode == IR_COPY:
+                text, reads = self.operand(instruction.arg1)
+                self.define(instruction.dest, text, False, reads)
+            elif opcode == IR_NOT:
+                text, reads = self.operand(instruction.arg1, True)
+                self.define(instruction.dest, f'NOT {text}', True, reads)
+            elif opcode == IR_LOAD_ELEMENT:
+                text, reads = self.operand(instruction.arg2)
+                self.define(instruction.dest, f'{self.name(instruction.arg1)}({text})', False,
+                            reads + (instruction.arg1,))
+            elif opcode == IR_STORE_ELEMENT:
+                value, _ = self.operand(instruction.arg2)
+                index, _ = self.operand(instruction.arg1)
+                self.changing(instruction.dest)
+                items.append(f'LET {self.name(instruction.dest)}({index}) = {value}')
+            elif opcode == IR_INPUT:
+                self.changing(instruction.dest)
+                items.append(f'INPUT {self.name(instruction.dest)}')
+            elif opcode == IR_OUTPUT:
+                items.append(f'PRINT {self.operand(instruction.arg1)[0]}')
+            elif opcode == IR_JUMP_IF_FALSE:
+                items.append((f'IF NOT {self.operand(instruction.arg1, True)[0]} THEN {{}}', instruction.arg2))
+            elif opcode == IR_JUMP:
+                items.append(('GOTO {}', instruction.arg1))
+            elif opcode == IR_CALL:
+                items.append(('GOSUB {}', instruction.arg1))
+            elif opcode == IR_RETURN:
+                items.append('RETURN')
+            else:
+                items.append('END')
+        return items
+
+
+def assemble_basic(program, emitter, first_line=BASIC_FIRST_LINE, step=BASIC_LINE_STEP):
+    # Emits the lines of program (as BasicTranslator lays them out) with line numbers, in two passes - the first
+    # numbers the lines and so finds the line of each label (the line placed after it), the second writes them out
+    # with each jump's label replaced by its line. Items are a line of text, a (text, label) jump with {} where the
+    # line number goes, or a label (an int)
+    line_count = sum(1 for item in program if not isinstance(item, int))
+    if first_line + (line_count - 1) * step > BASIC_MAX_LINE:
+        step = 1
+        if first_line + line_count - 1 > BASIC_MAX_LINE:
+            raise CompilerError(f'Code generation error! {line_count} lines is too long a program for BASIC')
+
+    label_lines = {}
+    line_number = first_line
+    for item in program:
+        if isinstance(item, int):
+            label_lines[item] = line_number
+        else:
+            line_number += step
+
+    line_number = first_line
+    for item in program:
+        if isinstance(item, int):
+            continue
+        if isinstance(item, tuple):
+            item = item[0].format(label_lines[item[1]])
+        emitter.emit(str(line_number), ' ', item, '\n')
+        line_number += step
+
+
+# Bytecode
+# Opcodes - each instruction is an opcode and one argument, a variable slot, constant index or the address (index)
+# of an instruction, 0 when unused. Operations pop their arguments off the value stack and push their result
+OP_LOAD = 0             # push variable [argument]
+OP_CONST = 1            # push constant [argument]
+OP_STORE = 2            # pop into variable [argument]
+OP_JUMP_IF_FALSE = 3    # pop, and go to argument if false
+OP_JUMP = 4             # go to argument
+OP_ADD = 5
+OP_SUB = 6
+OP_MULT = 7
+OP_LARGER = 8
+OP_EQ = 9
+OP_AND = 10
+OP_OR = 11
+OP_NOT = 12
+OP_LOAD_ELEMENT = 13    # pop an index, push that element of array [argument]
+OP_STORE_ELEMENT = 14   # pop an index, then a value into that element of array [argument]
+OP_CALL = 15            # go to argument, coming back on return
+OP_RETURN = 16
+OP_INPUT = 17           # read a number into variable [argument], and push it
+OP_OUTPUT = 18          # pop, and write it out
+OP_HALT = 19
+OPCODE_NAMES = ('LOAD', 'CONST', 'STORE', 'JUMP_IF_FALSE', 'JUMP', 'ADD', 'SUB', 'MULT', 'LARGER', 'EQ', 'AND', 'OR',
+                'NOT', 'LOAD_ELEMENT', 'STORE_ELEMENT', 'CALL', 'RETURN', 'INPUT', 'OUTPUT', 'HALT')
+BINOP_OPCODES = {'add': OP_ADD, 'sub': OP_SUB, 'mult': OP_MULT, 'larger': OP_LARGER, 'eq': OP_EQ, 'and': OP_AND,
+                 'or': OP_OR}
+# Opcodes whose argument is a code address, given as a label until assemble_bytecode
+JUMP_OPCODES = frozenset([OP_JUMP, OP_JUMP_IF_FALSE, OP_CALL])
+# Initial value of a variable (or each element of an array) of each type code
+DEFAULT_VALUES = {'N': 0, 'B': False, 'S': ''}
+# Most calls a running program may have unreturned, so runaway recursion stops with an error
+MAX_CALL_DEPTH = 100000
+
+
+class BytecodeProgram:
+    # A program compiled by BytecodeCompiler:
+    # - code - array of ints, each instruction's opcode then its argument
+    # - constants - the values OP_CONST pushes
+    # - initial_values - of each variable slot, as DEFAULT_VALUES
+    # - arrays - (slot, size) of each array, whose slot starts as a list of size of its initial value
+    # - names - the SPL name of each slot
+    # - fault_tokens - the source token of each instruction that can fail at run time, by address
+    def __init__(self, code, constants, initial_values, arrays, names, fault_tokens):
+        self.code = code
+        self.constants = constants
+        self.initial_values = initial_values
+        self.arrays = arrays
+        self.names = names
+        self.fault_tokens = fault_tokens
+
+    def disassemble(self):
+        lines = []
+        for address in range(0, len(self.code), 2):
+            opcode, argument = self.code[address], self.code[address + 1]
+            line = f'{address // 2:5} {OPCODE_NAMES[opcode]:<14}'
+            if opcode == OP_CONST:
+                line += repr(self.constants[argument])
+            elif opcode in (OP_LOAD, OP_STORE, OP_LOAD_ELEMENT, OP_STORE_ELEMENT, OP_INPUT):
+                line += self.names[argument]
+            elif opcode in JUMP_OPCODES:
+                line += str(argument)
+            lines.append(line.rstrip())
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return self.disassemble()
+
+
+class BytecodeCompiler(LabelledCodeGenerator):
+    # Lowers a checked parse tree to a BytecodeProgram. An expression's code is the instructions that push its
+    # value, and the other items are (opcode, argument) instructions, with a third item, the source token, for those
+    # that can fail. Every SPL variable gets its own slot, as procs have no frames
+    end_instruction = (OP_HALT, 0)
+    return_instruction = (OP_RETURN, 0)
+
+    def __init__(self, bindings):
+        super().__init__(bindings)
+        self.slots = {}
+        self.constants = []
+        # Index of each constant, by type and value, as True == 1
+        self.constant_indexes = {}
+        # The instructions of each expression node
+        self.values = {}
+
+    def slot(self, variable):
+        slot = self.slots.get(variable)
+        if slot is None:
+            slot = self.slots[variable] = len(self.slots)
+        return slot
+
+    def constant(self, value):
+        key = (type(value), value)
+        index = self.constant_indexes.get(key)
+        if index is None:
+            index = self.constant_indexes[key] = len(self.constants)
+            self.constants.append(value)
+        return index
+
+    def jump(self, label):
+        return OP_JUMP, label
+
+    def call(self, label):
+        return OP_CALL, label
+
+    def condition_jump(self, condition, label):
+        return [*self.values.pop(condition), (OP_JUMP_IF_FALSE, label)]
+
+    def leave_Const(self, node):
+        self.values[node] = [(OP_CONST, self.constant(constant_value(node.node_contents)))]
+
+    def leave_Var(self, node):
+        # Only uses are bound - the names of procs and declarations aren't values
+        variable = self.bindings.get(node)
+        if variable is not None:
+            self.values[node] = [(OP_LOAD, self.slot(variable))]
+
+    def leave_Field(self, node):
+        array, index = node.node_contents
+        self.values[node] = [*self.values.pop(index), (OP_LOAD_ELEMENT, self.slot(self.bindings[array]),
+                                                       array.node_contents)]
+
+    def leave_Expr(self, node):
+        self.values[node] = self.values.pop(node.node_contents[0])
+
+    def leave_UnOp(self, node):
+        operator, argument = node.node_contents
+        if operator.node_contents.contents == 'input':
+            self.values.pop(argument)
+            self.values[node] = [(OP_INPUT, self.slot(self.bindings[argument]), operator.node_contents)]
+        else:
+            self.values[node] = [*self.values.pop(argument), (OP_NOT, 0)]
+
+    def leave_BinOp(self, node):
+        operator, argument_1, argument_2 = node.node_contents
+        self.values[node] = [*self.values.pop(argument_1), *self.values.pop(argument_2),
+                             (BINOP_OPCODES[operator.node_contents.contents], 0)]
+
+    def leave_Assignment(self, node):
+        lhs, expr = node.node_contents
+        value = self.values.pop(expr)
+        if not lhs.has_children():
+            self.lines[node] = [*value, (OP_OUTPUT, 0)]
+            return
+        target = self.values.pop(lhs.node_contents[0])
+        if target[-1][0] == OP_LOAD_ELEMENT:
+            # The value, then the index, into the element instead of loading it - the value first, as in Python and
+            # the generated BASIC, so a[i] := input(i) stores at the new i
+            self.lines[node] = [*value, *target[:-1], (OP_STORE_ELEMENT, *target[-1][1:])]
+        else:
+            self.lines[node] = [*value, (OP_STORE, target[0][1])]
+
+    def bytecode_program(self):
+        # The BytecodeProgram, once the tree has been walked
+        code, fault_tokens = assemble_bytecode(self.program)
+        initial_values = [None] * len(self.slots)
+        names = [None] * len(self.slots)
+        for variable, slot in self.slots.items():
+            initial_values[slot] = DEFAULT_VALUES[variable.var_type]
+            names[slot] = variable.var_name
+        arrays = [(self.slot(variable), size) for variable, size in self.arrays()]
+        return BytecodeProgram(code, self.constants, initial_values, arrays, names, fault_tokens)
+
+
+def assemble_bytecode(program):
+    # Lays out the items of a BytecodeCompiler program as code, in two passes like assemble_basic - the first finds
+    # the address of each label, the second writes the instructions with labels replaced by addresses. Returns the
+    # code and the fault tokens by address
+    label_addresses = {}
+    address = 0
+    for item in program:
+        if isinstance(item, int):
+            label_addresses[item] = address
+        else:
+            address += 1
+
+    code = array('l')
+    fault_tokens = {}
+    for item in program:
+        if isinstance(item, int):
+            continue
+        opcode, argument = item[0], item[1]
+        if opcode in JUMP_OPCODES:
+            argument = label_addresses[argument]
+        elif len(item) == 3:
+            fault_tokens[len(code) // 2] = item[2]
+        code.append(opcode)
+        code.append(argument)
+    return code, fault_tokens
+
+
+class ExecutionError(CompilerError):
+    # Raised by BytecodeVM when the running program goes wrong - token (if known) is where in the source
+    def __init__(self, message, token=None):
+        super().__init__(message)
+        self.token = token
+
+    @property
+    def position(self):
+        return self.token.start if self.token is not None else None
+
+
+def format_value(value):
+    # An SPL value as output writes it
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    return str(value)
+
+
+class BytecodeVM:
+    # Runs a BytecodeProgram. read is called with no arguments for each number input reads, and write with the text
+    # of each value output writes - by default they are input and print
+    def __init__(self, program, read=input, write=print):
+        self.program = program
+        self.read = read
+        self.write = write
+        # The variables as the program left them, once run returns
+        self.variables = None
+
+    def read_number(self, address):
+        text = self.read().strip()
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            return float(text)
+        except ValueError:
+            raise ExecutionError(f'Runtime error! input should be a number, not {text!r}',
+                                 self.program.fault_tokens.get(address)) from None
+
+    def array_index(self, index, address):
+        # index as a list index, if it's a whole number that isn't negative - the slow path of the element opcodes
+        if index.__class__ is float and index.is_integer():
+            index = int(index)
+        if index.__class__ is not int or index < 0:
+            raise ExecutionError(f'Runtime error! Array index out of range: '
+                                 f'{self.program.names[self.program.code[2 * address + 1]]}[{index!r}]',
+                                 self.program.fault_tokens.get(address))
+        return index
+
+    def run(self):
+        # Runs the program from the start until it halts. The dispatch loop keeps everything it touches in locals,
+        # with the commonest opcodes tested first
+        program = self.program
+        code = list(zip(program.code[::2], program.code[1::2]))
+        constants = program.constants
+        variables = list(program.initial_values)
+        for slot, size in program.arrays:
+            variables[slot] = [variables[slot]] * size
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        returns = []
+        address = 0
+        try:
+            while True:
+                opcode, argument = code[address]
+                address += 1
+                if opcode == OP_LOAD:
+                    push(variables[argument])
+                elif opcode == OP_CONST:
+                    push(constants[argument])
+                elif opcode == OP_STORE:
+                    variables[argument] = pop()
+                elif opcode == OP_JUMP_IF_FALSE:
+                    if not pop():
+                        address = argument
+                elif opcode == OP_JUMP:
+                    address = argument
+                elif opcode == OP_ADD:
+                    value = pop()
+                    stack[-1] += value
+                elif opcode == OP_SUB:
+                    value = pop()
+                    stack[-1] -= value
+                elif opcode == OP_MULT:
+                    value = pop()
+                    stack[-1] *= value
+                elif opcode == OP_LARGER:
+                    value = pop()
+                    stack[-1] = stack[-1] > value
+                elif opcode == OP_EQ:
+                    value = pop()
+                    stack[-1] = stack[-1] == value
+                elif opcode == OP_AND:
+                    value = pop()
+                    stack[-1] = stack[-1] and value
+                elif opcode == OP_OR:
+                    value = pop()
+                    stack[-1] = stack[-1] or value
+                elif opcode == OP_NOT:
+                    stack[-1] = not stack[-1]
+                elif opcode == OP_LOAD_ELEMENT:
+                    index = stack[-1]
+                    if index.__class__ is not int or index < 0:
+                        index = self.array_index(index, address - 1)
+                    stack[-1] = variables[argument][index]
+                elif opcode == OP_STORE_ELEMENT:
+                    index = pop()
+                    value = pop()
+                    if index.__class__ is not int or index < 0:
+                        index = self.array_index(index, address - 1)
+                    variables[argument][index] = value
+                elif opcode == OP_CALL:
+                    if len(returns) == MAX_CALL_DEPTH:
+                        raise ExecutionError(f'Runtime error! More than {MAX_CALL_DEPTH} calls in progress')
+                    returns.append(address)
+                    address = argument
+                elif opcode == OP_RETURN:
+                    address = returns.pop()
+                elif opcode == OP_INPUT:
+                    variables[argument] = self.read_number(address - 1)
+                    push(variables[argument])
+                elif opcode == OP_OUTPUT:
+                    self.write(format_value(pop()))
+                else:
+                    break
+        except IndexError:
+            # Only the element opcodes index past the end of anything
+            raise ExecutionError(f'Runtime error! Array index out of range: '
+                                 f'{program.names[code[address - 1][1]]}[{index!r}]',
+                                 program.fault_tokens.get(address - 1)) from None
+        finally:
+            self.variables = variables
+
+
+# Python code tier
+# File name of the code PythonCompiler generates, by which its frames are told apart in tracebacks
+PYTHON_FILENAME = '<spl>'
+
+
+class PythonCompiler(CodeGenerator):
+    # Translates a checked parse tree into a Python ast.Module defining one function, spl_program(read, write,
+    # number, index, text, calls, overflow), that runs the program. Each SPL variable is a local of spl_program, each
+    # proc a function inside it - declaring nonlocal the variables it assigns - and loops and branches are Python's
+    # own, so the program runs as CPython bytecode. An expression's code is a Python expression, and the other items
+    # statements.
+    # A call yields the proc's function to PythonProgram.run, which keeps the calls in progress on a stack of its
+    # own, calls, so that as many can be in progress as on the VM whatever Python's recursion limit. A proc that makes
+    # no calls itself is called straight, and checks the stack's depth as it starts instead.
+    # The helpers spl_program takes read input numbers, check array indexes and format output (see PythonProgram) -
+    # those that can fail are given the index of their entry in faults, (token, array name, index), as are the
+    # element loads and stores, as the line number their IndexError is raised at
+    PYTHON_OPERATORS = {AstIntermediateGenerator.FT_BINOP_PLUS: ast.Add,
+                        AstIntermediateGenerator.FT_BINOP_MINUS: ast.Sub,
+                        AstIntermediateGenerator.FT_BINOP_TIMES: ast.Mult,
+                        # Not and/or, which would skip the second argument - and its input, if any
+                        AstIntermediateGenerator.FT_BINOP_AND: ast.BitAnd,
+                        AstIntermediateGenerator.FT_BINOP_OR: ast.BitOr}
+    PYTHON_COMPARISONS = {AstIntermediateGenerator.FT_BINOP_EQ: ast.Eq,
+                          AstIntermediateGenerator.FT_BINOP_LARGER: ast.Gt}
+
+    def __init__(self, bindings):
+        super().__init__(bindings)
+        self.names = {}
+        self.values = {}
+        # The names assigned in each open proc (or the program), innermost last
+        self.assigned = []
+        # Whether each open proc (or the program) makes calls, innermost last, and the labels of the procs that don't
+        self.calling = []
+        self.leaves = set()
+        # (statement, label) of each call, made a plain call once the walk shows the proc is a leaf
+        self.call_sites = []
+        self.faults = []
+        self.module = None
+
+    def python_name(self, variable):
+        # v_<name>_<number> - procs' functions are p_<label>, and the helpers have no underscore, so no name is two
+        # things
+        name = self.names.get(variable)
+        if name is None:
+            name = self.names[variable] = f'v_{variable.var_name}_{len(self.names)}'
+        return name
+
+    def load(self, variable):
+        return ast.Name(self.python_name(variable), ast.Load())
+
+    def helper_call(self, helper, *arguments):
+        return ast.Call(ast.Name(helper, ast.Load()), list(arguments), [])
+
+    def fault(self, token, array_name=None, index=None):
+        self.faults.append((token, array_name, index))
+        return len(self.faults) - 1
+
+    def call(self, label):
+        statement = ast.Expr(ast.Yield(ast.Name(f'p_{label}', ast.Load())))
+        self.call_sites.append((statement, label))
+        self.calling[-1] = True
+        return statement
+
+    def enter_PD(self, node):
+        self.enter_SPLProgram(node)
+
+    def enter_SPLProgram(self, node):
+        super().enter_SPLProgram(node)
+        self.assigned.append(set())
+        self.calling.append(False)
+
+    def leave_Const(self, node):
+        self.values[node] = ast.Constant(constant_value(node.node_contents))
+
+    def leave_Var(self, node):
+        # Only uses are bound - the names of procs and declarations aren't values
+        variable = self.bindings.get(node)
+        if variable is not None:
+            self.values[node] = self.load(variable)
+
+    def leave_Field(self, node):
+        # array[index] - an index that isn't a whole number, or is negative, goes through the index helper, which
+        # raises ExecutionError for it. The index is a Var or Const, so it can be evaluated twice
+        array, index = node.node_contents
+        variable = self.bindings[array]
+        index_value = self.values.pop(index)
+        index_name = index_value.id if isinstance(index_value, ast.Name) else None
+        fault = self.fault(array.node_contents, variable.var_name, index_name if index_name else index_value.value)
+        checked = self.helper_call('index', index_value, ast.Constant(fault))
+        if index_name is not None:
+            test = ast.BoolOp(ast.And(), [
+                ast.Compare(ast.Attribute(index_value, '__class__', ast.Load()), [ast.Is()],
+                            [ast.Name('int', ast.Load())]),
+                ast.Compare(index_value, [ast.GtE()], [ast.Constant(0)])])
+            checked = ast.IfExp(test, index_value, checked)
+        elif index_value.value.__class__ is int and index_value.value >= 0:
+            checked = index_value
+        # Line 1 is everything else
+        self.values[node] = ast.Subscript(self.load(variable), checked, ast.Load(), lineno=fault + 2,
+                                          end_lineno=fault + 2, col_offset=0, end_col_offset=0)
+
+    def leave_Expr(self, node):
+        self.values[node] = self.values.pop(node.node_contents[0])
+
+    def leave_UnOp(self, node):
+        operator, argument = node.node_contents
+        if operator.node_contents.contents == 'input':
+            # input(Var) reads a number into the Var, and has its value
+            variable = self.bindings[argument]
+            self.values.pop(argument)
+            self.assigned[-1].add(self.python_name(variable))
+            self.values[node] = ast.NamedExpr(ast.Name(self.python_name(variable), ast.Store()),
+                                              self.helper_call('number', ast.Constant(self.fault(
+                                                  operator.node_contents))))
+        else:
+            self.values[node] = ast.UnaryOp(ast.Not(), self.values.pop(argument))
+
+    def leave_BinOp(self, node):
+        operator, argument_1, argument_2 = node.node_contents
+        operation = FtableBuilder.BINOP_FUNCTION_TYPES[operator.node_contents.contents]
+        value_1 = self.values.pop(argument_1)
+        value_2 = self.values.pop(argument_2)
+        if operation in self.PYTHON_COMPARISONS:
+            self.values[node] = ast.Compare(value_1, [self.PYTHON_COMPARISONS[operation]()], [value_2])
+        else:
+            self.values[node] = ast.BinOp(value_1, self.PYTHON_OPERATORS[operation](), value_2)
+
+    def leave_Assignment(self, node):
+        lhs, expr = node.node_contents
+        value = self.values.pop(expr)
+        if not lhs.has_children():
+            self.lines[node] = [ast.Expr(self.helper_call('write', self.helper_call('text', value)))]
+            return
+        target = self.values.pop(lhs.node_contents[0])
+        target.ctx = ast.Store()
+        if isinstance(target, ast.Name):
+            self.assigned[-1].add(target.id)
+        self.lines[node] = [ast.Assign([target], value)]
+
+    def leave_Loop(self, node):
+        if node.node_contents[0].node_contents.contents == 'do':
+            # do Algorithm until Expr - while True, breaking out once the condition holds
+            body = [*self.block(node.node_contents[1]), ast.If(self.values.pop(node.node_contents[3]),
+                                                                [ast.Break()], [])]
+            self.lines[node] = [ast.While(ast.Constant(True), body, [])]
+        else:
+            condition = self.values.pop(node.node_contents[1])
+            self.lines[node] = [ast.While(condition, self.block(node.node_contents[3]) or [ast.Pass()], [])]
+
+    def leave_Branch(self, node):
+        alternat = node.node_contents[4]
+        condition = self.values.pop(node.node_contents[1])
+        self.lines[node] = [ast.If(condition, self.block(node.node_contents[3]) or [ast.Pass()],
+                                   self.block(alternat.node_contents[1]) if alternat is not None else [])]
+
+    def leave_PD(self, node):
+        # A function for the proc, then those of the procs declared inside it - all of them are defined in
+        # spl_program, as each SPL variable has one Python name
+        label = self.procedures[-2][node.node_contents[1].node_contents.contents]
+        self.procedures.pop()
+        assigned = self.assigned.pop()
+        body = self.block(node.node_contents[3]) or [ast.Pass()]
+        if not self.calling.pop():
+            # A plain function, called straight from its callers, so it counts itself among the calls in progress
+            self.leaves.add(label)
+            body.insert(0, ast.If(ast.Compare(self.helper_call('len', ast.Name('calls', ast.Load())), [ast.Gt()],
+                                              [ast.Constant(MAX_CALL_DEPTH)]),
+                                  [ast.Expr(self.helper_call('overflow'))], []))
+        if assigned:
+            body.insert(0, ast.Nonlocal(sorted(assigned)))
+        self.lines[node] = [ast.FunctionDef(f'p_{label}', self.arguments(), body, [], lineno=1),
+                            *self.block(node.node_contents[2])]
+
+    def leave_SPLProgram(self, node):
+        # Every variable, then every proc, then main - ProcDefs Keyword Algorithm Keyword VarDecl
+        self.procedures.pop()
+        self.assigned.pop()
+        self.calling.pop()
+        for statement, label in self.call_sites:
+            if label in self.leaves:
+                statement.value = self.helper_call(f'p_{label}')
+        main = self.block(node.node_contents[2])
+        procedures = self.block(node.node_contents[0])
+        sizes = {variable: size for variable, size in self.arrays()}
+        setup = []
+        for variable in list(self.names):
+            value = ast.Constant(DEFAULT_VALUES[variable.var_type])
+            if variable in sizes:
+                value = ast.BinOp(ast.List([value], ast.Load()), ast.Mult(), ast.Constant(sizes[variable]))
+            setup.append(ast.Assign([ast.Name(self.python_name(variable), ast.Store())], value))
+        arguments = self.arguments(['read', 'write', 'number', 'index', 'text', 'calls', 'overflow'])
+        function = ast.FunctionDef('spl_program', arguments, [*setup, *procedures, *main, ast.Return(None)], [],
+                                   lineno=1)
+        self.module = ast.fix_missing_locations(ast.Module([function], []))
+
+    def arguments(self, names=()):
+        return ast.arguments([], [ast.arg(name) for name in names], None, [], [], None, [])
+
+    def python_program(self):
+        # The PythonProgram, once the tree has been walked
+        return PythonProgram(compile(self.module, PYTHON_FILENAME, 'exec'), self.faults)
+
+
+class PythonProgram:
+    # A program compiled by PythonCompiler - code is the compiled module, and faults the (token, array name, index)
+    # of each place that can fail at run time, with index the Python name of a Var index or the value of a Const
+    def __init__(self, code, faults):
+        self.code = code
+        self.faults = faults
+        namespace = {}
+        exec(code, namespace)
+        self.function = namespace['spl_program']
+
+    def array_index(self, index, fault):
+        # index as a list index, if it's a whole number that isn't negative - as BytecodeVM.array_index
+        if index.__class__ is float and index.is_integer():
+            return int(index)
+        if index.__class__ is not int or index < 0:
+            token, array_name, _ = self.faults[fault]
+            raise ExecutionError(f'Runtime error! Array index out of range: {array_name}[{index!r}]', token)
+        return index
+
+    def run(self, read=input, write=print):
+        # Runs the program, with read and write as BytecodeVM takes them. spl_program and the procs that make calls
+        # are generators, yielding the function of each proc they call - the generators of the calls in progress are
+        # kept on calls, and a proc that makes no calls just runs
+        def number(fault):
+            text = read().strip()
+            try:
+                return int(text)
+            except ValueError:
+                pass
+            try:
+                return float(text)
+            except ValueError:
+                raise ExecutionError(f'Runtime error! input should be a number, not {text!r}',
+                                     self.faults[fault][0]) from None
+
+        def overflow():
+            raise ExecutionError(f'Runtime error! More than {MAX_CALL_DEPTH} calls in progress')
+
+        calls = []
+        try:
+            running = self.function(read, write, number, self.array_index, format_value, calls, overflow)
+            if running is not None:
+                calls.append(running)
+            while calls:
+                try:
+                    procedure = calls[-1].send(None)
+                except StopIteration:
+                    calls.pop()
+                    continue
+                if len(calls) > MAX_CALL_DEPTH:
+                    overflow()
+                running = procedure()
+                if running is not None:
+                    calls.append(running)
+        except IndexError as error:
+            # Raised by an element load or store - its line number is its entry in faults
+            traceback = error.__traceback__
+            line = None
+            while traceback is not None:
+                if traceback.tb_frame.f_code.co_filename == PYTHON_FILENAME:
+                    line = traceback.tb_lineno
+                    frame = traceback.tb_frame
+                traceback = traceback.tb_next
+            if line is None or line < 2:
+                raise
+            token, array_name, index = self.faults[line - 2]
+            if isinstance(index, str):
+                index = frame.f_locals.get(index)
+            raise ExecutionError(f'Runtime error! Array index out of range: {array_name}[{index!r}]', token) \
+                from None
+
+
 # File reading functionality implementation
+FILE_CHUNK_SIZE = 64 * 1024
+
+
 class FileReader:
     def __init__(self, filename):
         try:
             self.file = open(filename, "r")
-        except:
-            print('File error! Check that you provided the correct filename!')
-            quit()
+        except OSError as error:
+            raise CompilerError('File error! Check that you provided the correct filename! (' + str(error) + ')') \
+                from error
 
     def close_file(self):
         self.file.close()
@@ -1396,6 +4748,10 @@ class FileReader:
         full_text = ''.join(text_list)
         return full_text
 
+    def get_chunks(self, chunk_size=FILE_CHUNK_SIZE):
+        # Returns an iterator over the file in fixed-size pieces of text, for Lexer.stream_lexer
+        return iter(lambda: self.file.read(chunk_size), '')
+
 
 class Runner:
     def __init__(self):
@@ -1406,23 +4762,31 @@ class Runner:
     def run_lexer(self):
         self.lexer = Lexer(self.file_reader.get_all_text())
         self.lexer.run_lexer()
-        print('\n LEXER COMPLETED')
+        runner_log.info('\n LEXER COMPLETED')
 
     def run_parser_and_lexer(self):
         self.lexer = Lexer(self.file_reader.get_all_text())
         tokens = self.lexer.run_lexer()
-        print('\n LEXER COMPLETED!')
+        runner_log.info('\n LEXER COMPLETED!')
+        self.parser = Parser(tokens)
+        self.parser.run_parser()
+        runner_log.info('\n PARSER COMPLETED')
+
+    def run_parser_and_lexer_streaming(self):
+        # Same as run_parser_and_lexer, but tokens flow straight from the file into the parser
+        self.lexer = Lexer(None)
+        tokens = self.lexer.stream_lexer(self.file_reader.get_chunks())
         self.parser = Parser(tokens)
         self.parser.run_parser()
-        print('\n PARSER COMPLETED')
+        runner_log.info('\n LEXER AND PARSER COMPLETED')
 
     def run_parser_lexer_inital_scope(self):
         self.lexer = Lexer(self.file_reader.get_all_text())
         tokens = self.lexer.run_lexer()
-        print('\n LEXER COMPLETED!')
+        runner_log.info('\n LEXER COMPLETED!')
         self.parser = Parser(tokens)
         node = self.parser.run_parser()
-        print('\n PARSER COMPLETED')
+        runner_log.info('\n PARSER COMPLETED')
         analyst = Analyst(node)
         scope_table = analyst.analyse_scope()
-        print('\nINITIAL SCOPE CHECK COMPLETE')
+        runner_log.info('\nINITIAL SCOPE CHECK COMPLETE')
@@ -1,18 +1,757 @@
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
 import unittest
+import unittest.mock
+import benchmark_parser
 import spl
 
+
+def lex(text):
+    return [(token.type, token.contents) for token in spl.Lexer(text).run_lexer()]
+
+
+def analyse(text):
+    return spl.Analyst(spl.Parser(spl.Lexer(text).run_lexer()).run_parser()).check_types()
+
+
 class CompilerTest(unittest.TestCase):
 
     # TODO major testing!
 
     def test_lexer_number(self):
-        self.assertEqual('test_object', 'test_object')
+        self.assertEqual(lex('12 3.5 -4'), [(spl.TT_NUMBER, '12'), (spl.TT_NUMBER, '3.5'), (spl.TT_NUMBER, '-4')])
 
     def test_lexer_name(self):
-        self.assertEqual('test_object', 'test_object')
+        self.assertEqual(lex('abc main x1'), [(spl.TT_USERDEFINEDNAME, 'abc'), (spl.TT_KEYWORD, 'main'),
+                                              (spl.TT_USERDEFINEDNAME, 'x1')])
 
     def test_lexer_string(self):
-        self.assertEqual('test_object', 'test_object')
+        self.assertEqual(lex('"HELLO WORLD 1"'), [(spl.TT_SHORTSTRING, '"HELLO WORLD 1"')])
+
+    def test_lexer_spaced_and_glued_input_agree(self):
+        spaced = lex('x := add ( 1 , y ) ;')
+        glued = lex('x:=add(1,y);')
+        self.assertEqual(spaced, glued)
+        self.assertEqual([token_type for token_type, contents in glued],
+                         [spl.TT_USERDEFINEDNAME, spl.TT_ASSIGNMENTOPERATOR, spl.TT_KEYWORD, spl.TT_LBRACKET,
+                          spl.TT_NUMBER, spl.TT_COMMA, spl.TT_USERDEFINEDNAME, spl.TT_RBRACKET, spl.TT_SEMICOLON])
+
+    def test_lexer_token_ids_are_sequential(self):
+        tokens = spl.Lexer('main { halt ; }').run_lexer()
+        self.assertEqual([token.id for token in tokens], list(range(len(tokens))))
+
+    def test_lexer_streaming_matches_full_text(self):
+        text = 'proc p { return ; } , main { x := "AB C" ; halt ; num counter ; }'
+        expected = lex(text)
+        for chunk_size in (1, 3, 7, len(text)):
+            chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+            streamed = [(token.type, token.contents) for token in spl.Lexer(None).stream_lexer(chunks)]
+            self.assertEqual(streamed, expected)
+
+    def test_parser_accepts_token_stream(self):
+        text = 'proc p { return ; } , main { halt ; }'
+        from_list = spl.Parser(spl.Lexer(text).run_lexer()).run_parser()
+        from_stream = spl.Parser(spl.Lexer(None).stream_lexer([text[:10], text[10:]])).run_parser()
+        self.assertEqual(repr(from_stream), repr(from_list))
+        self.assertEqual(from_stream.node_class, spl.NT_SPLPROGRAM)
+
+    def test_parser_peek_does_not_consume(self):
+        parser = spl.Parser(spl.Lexer('proc p { return ; }').run_lexer())
+        self.assertTrue(parser.check_token(spl.TT_KEYWORD, 'proc'))
+        self.assertEqual(parser.peek_token(2).type, spl.TT_LBRACE)
+        self.assertTrue(parser.check_token(spl.TT_USERDEFINEDNAME, offset=1))
+        self.assertIsNone(parser.peek_token(50))
+        parser.advance()
+        self.assertEqual(parser.current_token.contents, 'p')
+        self.assertEqual(parser.token_index, 1)
+
+    def test_trace_logging_writes_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            trace_path = os.path.join(directory, 'trace.jsonl')
+            spl.configure_logging(trace_path=trace_path)
+            try:
+                spl.Parser(spl.Lexer('main { halt ; }').run_lexer()).run_parser()
+            finally:
+                spl.configure_logging()
+            with open(trace_path) as trace_file:
+                records = [json.loads(line) for line in trace_file]
+        self.assertIn({'stage': 'lexer', 'level': 'DEBUG', 'message': 'Added token main of type KEYWORD',
+                       'args': ['main', 'KEYWORD']},
+                      [{key: value for key, value in record.items() if key != 'time'} for record in records])
+        self.assertIn('Adding SPL program', [record['message'] for record in records])
+        self.assertFalse(logging.getLogger('spl').isEnabledFor(logging.INFO))
+
+    def test_tokens_and_nodes_have_no_instance_dict(self):
+        program_node = spl.Parser(spl.Lexer('main { halt ; }').run_lexer()).run_parser()
+        self.assertFalse(hasattr(program_node, '__dict__'))
+        self.assertFalse(hasattr(program_node.node_contents[1].node_contents, '__dict__'))
+        self.assertEqual(spl.NODE_CLASS_NAMES[program_node.node_class], 'SPLProgram')
+        self.assertEqual(repr(spl.Token(spl.TT_COMMA, 3, ',')), 'COMMA: ,, ID: 3')
+
+    def test_parser_full_program(self):
+        text = ('proc inc { n := add(n, 1) ; return ; } , '
+                'main { n := input(n) ; do { call inc ; a[0] := n ; } until (larger(n, 10)) ; '
+                'if (eq(n, 11)) then { output := "DONE" ; } else { output := not(true) ; } ; '
+                'while (larger(n, 0)) do { n := sub(n, 1) ; } ; halt ; num n ; arr num[3] a ; }')
+        program_node = spl.Parser(spl.Lexer(text).run_lexer()).run_parser()
+        self.assertEqual([child.node_class if child else None for child in program_node.node_contents],
+                         [spl.NT_PROCDEFS, spl.NT_KEYWORD, spl.NT_ALGORITHM, spl.NT_KEYWORD, spl.NT_VARDECL])
+
+    def test_parser_reports_every_error(self):
+        text = ('proc p { n := add(n 1) ; return ; } , proc 5 { return ; } , '
+                'main { n := ; if (n) then { x := 1 } ; y := 2 ; halt ; num ; num n ; }')
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Parser(spl.Lexer(text).run_lexer()).run_parser()
+        errors = context.exception.errors
+        self.assertEqual([error.token.contents for error in errors], ['1', '5', ';', '}', ';'])
+        self.assertEqual([error.node_class for error in errors],
+                         [spl.NT_BINOP, spl.NT_PD, spl.NT_EXPR, spl.NT_ALGORITHM, spl.NT_DEC])
+        self.assertTrue(all(isinstance(error, spl.ParserError) for error in errors))
+
+    def test_lexer_reports_every_error(self):
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Lexer('x := $ ; y := @@ ;').run_lexer()
+        self.assertEqual([error.position for error in context.exception.errors], [5, 14])
+
+    def test_streamed_lexer_reports_run_across_chunks_once(self):
+        text = 'main { x := 1 ; y := ' + '$' * 40 + ' ; halt ; }'
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Lexer(text).run_lexer()
+        expected = [(error.position, str(error)) for error in context.exception.errors]
+        self.assertEqual(expected, [(21, 'Lexer error! UNRECOGNISED WORD: ' + '$' * 40)])
+        for chunk_size in (1, 5, 64):
+            with self.assertRaises(spl.CompilationErrors) as context:
+                list(spl.Lexer(None).stream_lexer([text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]))
+            self.assertEqual([(error.position, str(error)) for error in context.exception.errors], expected)
+
+    def test_file_reader_error_is_raised(self):
+        with self.assertRaises(spl.CompilerError):
+            spl.FileReader('no-such-file.spl')
+
+    def test_token_and_node_spans(self):
+        text = 'main {\n  x := add(x, 12) ;\n  halt ;\n}'
+        lexer = spl.Lexer(text)
+        program_node = spl.Parser(lexer.run_lexer()).run_parser()
+        assignment = program_node.node_contents[2].node_contents[0].node_contents[0]
+        self.assertEqual(text[assignment.start:assignment.end], 'x := add(x, 12)')
+        binop = assignment.node_contents[1].node_contents[0]
+        self.assertEqual(text[binop.start:binop.end], 'add(x, 12)')
+        self.assertEqual(lexer.line_column(binop.start), (2, 8))
+        self.assertEqual(lexer.line_column(binop.end), (2, 18))
+        self.assertEqual((program_node.start, program_node.end), (0, len(text)))
+
+    def test_streamed_positions_match(self):
+        text = 'main {\n\n  halt ;\n  num n ;\n}'
+        lexer = spl.Lexer(None)
+        streamed = list(lexer.stream_lexer([text[i:i + 4] for i in range(0, len(text), 4)]))
+        self.assertEqual([token.start for token in streamed], [token.start for token in spl.Lexer(text).run_lexer()])
+        self.assertEqual(lexer.line_column(streamed[4].start), (4, 3))
+
+    def test_parser_error_position(self):
+        text = 'main {\n  x := ;\n  halt ;\n}'
+        lexer = spl.Lexer(text)
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Parser(lexer.run_lexer()).run_parser()
+        self.assertEqual(lexer.line_column(context.exception.errors[0].position), (2, 8))
+
+    def test_incremental_edit_matches_full_compile(self):
+        text = 'proc p { n := add(n, 1) ; return ; } , main { call p ; output := n ; halt ; num n ; }'
+        compiler = spl.IncrementalCompiler()
+        compiler.compile(text)
+        position = text.index('1)')
+        compiler.apply_edit(position, position + 1, '25')
+        self.assertEqual(compiler.reparsed_node.node_class, spl.NT_INSTR)
+        self.assertEqual(compiler.relexed_tokens, 2)
+
+        fresh = spl.Lexer(compiler.text).run_lexer()
+        self.assertEqual([(token.contents, token.start, token.id) for token in compiler.tokens],
+                         [(token.contents, token.start, token.id) for token in fresh])
+        self.assertEqual(repr(compiler.program_node).count('NUMBER: 25'), 1)
+        self.assertEqual(compiler.program_node.end, len(compiler.text))
+
+    def test_incremental_whitespace_edit_keeps_tree(self):
+        compiler = spl.IncrementalCompiler()
+        program_node = compiler.compile('main {\n  halt ;\n}')
+        compiler.apply_edit(6, 6, '\n\n')
+        self.assertIs(compiler.program_node, program_node)
+        self.assertIsNone(compiler.reparsed_node)
+        self.assertEqual(compiler.lexer.line_column(compiler.tokens[2].start), (4, 3))
+
+    def test_incremental_edit_fixes_error(self):
+        compiler = spl.IncrementalCompiler()
+        compiler.compile('main { x := ; y := 1 ; halt ; }')
+        self.assertEqual(len(compiler.errors), 1)
+        compiler.apply_edit(12, 12, '2 ')
+        self.assertEqual(compiler.errors, [])
+        self.assertEqual(compiler.reparsed_node.node_class, spl.NT_ALGORITHM)
+
+    def test_symbol_table_scopes(self):
+        vtable = spl.Vtable()
+        outer = spl.Vtable_node()
+        outer.var_name = 'x'
+        inner = spl.Vtable_node()
+        inner.var_name = 'x'
+        self.assertIsNone(vtable.add_variable(outer))
+        self.assertIs(vtable.add_variable(inner), outer)
+        vtable.push_scope()
+        self.assertIs(vtable.find_variable('x'), outer)
+        self.assertIsNone(vtable.add_variable(inner))
+        self.assertIs(vtable.find_variable('x'), inner)
+        vtable.pop_scope()
+        self.assertIs(vtable.find_variable('x'), outer)
+        self.assertIsNone(vtable.find_variable('y'))
+
+    def test_analyst_scoped_lookup(self):
+        # Procedures see the variables of enclosing scopes, and siblings can call each other
+        variables = analyse('proc a { call b ; n := 1 ; return ; } , proc b { s := "X" ; return ; string s ; } , '
+                            'main { call a ; output := n ; halt ; num n ; }')
+        self.assertEqual([(variable.var_name, variable.var_type, variable.var_used) for variable in variables],
+                         [('n', 'N', True), ('s', 'S', True)])
+
+    def test_analyst_reports_every_error(self):
+        text = 'proc p { y := 1 ; return ; num z ; } , main { call q ; x := 1 ; halt ; num n ; }'
+        with self.assertRaises(spl.CompilationErrors) as context:
+            analyse(text)
+        errors = context.exception.errors
+        self.assertEqual([text[error.position] for error in errors], ['y', 'z', 'q', 'x', 'n'])
+        self.assertTrue(all(isinstance(error, spl.SemanticError) for error in errors))
+
+    def test_compilations_are_isolated(self):
+        first = spl.Compilation('main { x := 1 ; halt ; num x ; }')
+        second = spl.Compilation('main { y := "A" ; halt ; string y ; }')
+        first.run()
+        second.run()
+        first.run_analyst()
+        self.assertEqual([variable.var_name for variable in first.vtable.variable_list], ['x'])
+        self.assertEqual([variable.var_name for variable in second.vtable.variable_list], ['y'])
+        self.assertIsNot(spl.AstIntermediateGenerator().vtable, spl.AstIntermediateGenerator().vtable)
+
+    def test_compilations_in_threads(self):
+        results = {}
+
+        def compile_program(index):
+            names = [f'v{index}n{count}' for count in range(50)]
+            compilation = spl.Compilation('main { ' + ' '.join(f'{name} := {index} ;' for name in names) +
+                                          ' halt ; ' + ' '.join(f'num {name} ;' for name in names) + ' }')
+            compilation.run()
+            results[index] = (names, [variable.var_name for variable in compilation.vtable.variable_list])
+
+        threads = [threading.Thread(target=compile_program, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        for names, declared in results.values():
+            self.assertEqual(declared, names)
+
+    def test_parser_builds_flat_lists(self):
+        program_node = spl.Parser(spl.Lexer('proc a { return ; } , proc b { return ; } , '
+                                            'main { x := 1 ; call a ; call b ; halt ; num x ; bool y ; }')
+                                  .run_lexer()).run_parser()
+        proc_defs, main, algorithm, halt, var_decl = program_node.node_contents
+        self.assertEqual([child.node_class for child in proc_defs.node_contents], [spl.NT_PD] * 2)
+        self.assertEqual([child.node_class for child in algorithm.node_contents], [spl.NT_INSTR] * 3)
+        self.assertEqual([child.node_class for child in var_decl.node_contents], [spl.NT_DEC] * 2)
+
+    def test_long_program_within_recursion_limit(self):
+        count = sys.getrecursionlimit() * 3
+        text = ' , '.join(f'proc p{index} {{ return ; }}' for index in range(count)) + \
+               ' , main { ' + ' '.join(f'x := {index} ;' for index in range(count)) + ' output := x ; halt ; ' + \
+               ' '.join(f'num v{index} ;' for index in range(count)) + ' }'
+        program_node = spl.Parser(spl.Lexer(text).run_lexer()).run_parser()
+        self.assertEqual(len(program_node.node_contents[2].node_contents), count + 1)
+        self.assertEqual(repr(program_node).count(':Dec:'), count)
+        scope_table = spl.Analyst(program_node).analyse_scope()
+        self.assertEqual(len(scope_table.children), 5)
+
+    def test_parse_time_grows_linearly(self):
+        # Time per proc at 8N procs against at N - about 1 if parsing is linear, and 8 if it went quadratic again
+        per_proc = [min(benchmark_parser.time_parse(proc_count) for _ in range(5)) / proc_count
+                    for proc_count in (400, 3200)]
+        self.assertLess(per_proc[1], per_proc[0] * 3)
+
+    def test_preorder_and_postorder(self):
+        program_node = spl.Parser(spl.Lexer('main { x := 1 ; halt ; num x ; }').run_lexer()).run_parser()
+        preorder = [spl.NODE_CLASS_NAMES[node.node_class] for node in spl.preorder(program_node)]
+        postorder = [spl.NODE_CLASS_NAMES[node.node_class] for node in spl.postorder(program_node)]
+        self.assertEqual(preorder[:6], ['SPLProgram', 'Keyword', 'Algorithm', 'Instruction', 'Assignment', 'LHS'])
+        self.assertEqual(postorder[:4], ['Keyword', 'Var', 'LHS', 'Const'])
+        self.assertEqual(postorder[-1], 'SPLProgram')
+        self.assertEqual(sorted(preorder), sorted(postorder))
+
+    def test_walk_runs_visitors_together(self):
+        class Recorder(spl.NodeVisitor):
+            def __init__(self, skip_class):
+                super().__init__()
+                self.skip_class = skip_class
+                self.seen = []
+
+            def enter_node(self, node):
+                self.seen.append(node.node_class)
+                if node.node_class == self.skip_class:
+                    return spl.SKIP_CHILDREN
+
+        program_node = spl.Parser(spl.Lexer('main { x := 1 ; halt ; num x ; }').run_lexer()).run_parser()
+        everything = Recorder(None)
+        no_algorithm = Recorder(spl.NT_ALGORITHM)
+        spl.walk(program_node, everything, no_algorithm)
+        self.assertEqual(everything.seen, [node.node_class for node in spl.preorder(program_node)])
+        self.assertIn(spl.NT_ALGORITHM, no_algorithm.seen)
+        self.assertNotIn(spl.NT_ASSIGN, no_algorithm.seen)
+        self.assertIn(spl.NT_DEC, no_algorithm.seen)
+
+    def test_generator_tables_in_one_pass(self):
+        compilation = spl.Compilation('proc inc { n := add(n, 1) ; return ; } , main { a[i] := 0 ; '
+                                      'while (larger(n, 0)) do { call inc ; } ; '
+                                      'halt ; num n ; arr num[3] a ; num i ; }')
+        compilation.run()
+        generator = spl.AstIntermediateGenerator(compilation.program_node)
+        generator.generate_tables()
+        self.assertEqual([variable.var_name for variable in generator.vtable.variable_list], ['n', 'a', 'i'])
+        self.assertEqual([function.function_type for function in generator.ftable.function_list],
+                         [spl.AstIntermediateGenerator.FT_BINOP_PLUS, spl.AstIntermediateGenerator.FT_LOOP_WHILE,
+                          spl.AstIntermediateGenerator.FT_BINOP_LARGER])
+        self.assertIs(generator.ftable.function_list[0].function_arg1, generator.vtable.variable_list[0])
+
+    def test_analysis_annotates_tree(self):
+        compilation = spl.Compilation('proc p { n := add(n, 1) ; return ; num n ; } , main { call p ; '
+                                      'if (larger(n, 2)) then { output := "BIG" ; } ; halt ; num n ; }')
+        compilation.run()
+        analysis = compilation.analysis
+        program_vars = [node for node in spl.preorder(compilation.program_node) if node.node_class == spl.NT_VAR
+                        and node in analysis.bindings]
+        # The n in p is p's own, the one in main's condition the program's
+        self.assertEqual([analysis.bindings[node].var_id for node in program_vars], [1, 1, 0])
+        conditions = [node.node_contents[1] for node in spl.preorder(compilation.program_node)
+                      if node.node_class == spl.NT_BRANCH]
+        self.assertEqual(analysis.node_types[conditions[0]], 'B')
+        self.assertEqual([function.function_name for function in analysis.ftable.function_list][0], 'p')
+        self.assertEqual(len(analysis.scope_table.children), 5)
+
+    def test_analysis_reports_type_errors(self):
+        text = 'main { n := "A" ; b := add(n, b) ; if (n) then { output := b ; } ; halt ; num n ; bool b ; }'
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Compilation(text).run()
+        errors = context.exception.errors
+        self.assertEqual([text[error.position:error.position + 3] for error in errors],
+                         ['"A"', 'add', 'b) ', 'n) '])
+        self.assertIn('should be a number, not a string', str(errors[0]))
+
+    def test_cache_reuses_compilation(self):
+        text = 'proc p { n := add(n, 1) ; return ; } , main {\n  call p ;\n  halt ;\n  num n ;\n}'
+        with tempfile.TemporaryDirectory() as directory:
+            cache = spl.CompilationCache(directory)
+            compiled = cache.compile(text, 'first.spl')
+            cached = spl.CompilationCache(directory).load(text, 'second.spl')
+            self.assertIsNotNone(cached)
+            self.assertIsNot(cached, compiled)
+            self.assertEqual(cached.filename, 'second.spl')
+            self.assertEqual(repr(cached.program_node), repr(compiled.program_node))
+            self.assertEqual(cached.line_column(cached.tokens[-1].start), (5, 1))
+            self.assertEqual([variable.var_name for variable in cached.vtable.variable_list], ['n'])
+            self.assertIsNone(cache.load(text + ' '))
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_cache_keeps_generated_code(self):
+        text = 'main { n := add(n, 1) ; output := n ; halt ; num n ; }'
+        with tempfile.TemporaryDirectory() as directory:
+            code = spl.CompilationCache(directory).compile(text).code
+            self.assertEqual(code.splitlines(), ['10 LET V0 = V0 + 1', '20 PRINT V0', '30 END'])
+            cache = spl.CompilationCache(directory)
+            with unittest.mock.patch.object(spl.Compilation, 'run_generator', side_effect=AssertionError):
+                cached = cache.compile(text)
+            self.assertEqual(cached.code, code)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_cache_runs_given_compilation(self):
+        text = 'main {\n  n := m ;\n  halt ;\n  num n ;\n}'
+        with tempfile.TemporaryDirectory() as directory:
+            cache = spl.CompilationCache(directory)
+            compilation = spl.Compilation(text, 'bad.spl')
+            with self.assertRaises(spl.CompilerError) as context:
+                cache.compile(text, 'bad.spl', compilation, lambda each: each.run(scope_table=False))
+            self.assertEqual(compilation.error_messages(context.exception),
+                             ['bad.spl:2:8: Semantic Error! DECL-APPL error! Variable used but not declared: m'])
+            self.assertIsNone(compilation.scope_table)
+            self.assertIsNone(cache.load(text))
+
+    def test_cache_evicts_least_recently_used(self):
+        texts = [f'main {{ x := {index} ; halt ; num x ; }}' for index in range(3)]
+        with tempfile.TemporaryDirectory() as directory:
+            cache = spl.CompilationCache(directory)
+            cache.compile(texts[0])
+            entry_size = os.path.getsize(cache.path(cache.key(texts[0])))
+            cache.max_bytes = entry_size * 2 + entry_size // 2
+            cache.compile(texts[1])
+            os.utime(cache.path(cache.key(texts[0])), (0, 0))
+            os.utime(cache.path(cache.key(texts[1])), (1, 1))
+            cache.load(texts[0])
+            cache.compile(texts[2])
+            self.assertIsNotNone(cache.load(texts[0]))
+            self.assertIsNone(cache.load(texts[1]))
+            self.assertIsNotNone(cache.load(texts[2]))
+
+    def test_cache_discards_damaged_entry(self):
+        text = 'main { halt ; }'
+        with tempfile.TemporaryDirectory() as directory:
+            cache = spl.CompilationCache(directory)
+            cache.compile(text)
+            with open(cache.path(cache.key(text)), 'wb') as cache_file:
+                cache_file.write(b'not a pickle')
+            self.assertIsNone(cache.load(text))
+            self.assertFalse(os.path.exists(cache.path(cache.key(text))))
+
+    def test_memo_reuses_unchanged_procedures(self):
+        procedures = ['proc p { x := add(n, 1) ; return ; num x ; }', 'proc q { n := mult(n, 2) ; return ; }']
+        main = ' , main { call p ; call q ; halt ; num n ; }'
+        memo = spl.ProcedureMemo()
+        spl.Compilation(' , '.join(procedures) + main, memo=memo).run()
+        self.assertEqual((memo.hits, memo.misses), (0, 2))
+        changed = ' , '.join([procedures[0], procedures[1].replace('2', '3')]) + main
+        compilation = spl.Compilation(changed, memo=memo)
+        compilation.run()
+        self.assertEqual((memo.hits, memo.misses), (1, 3))
+        fresh = spl.Compilation(changed)
+        fresh.run()
+        self.assertEqual([repr(variable) for variable in compilation.vtable.variable_list],
+                         [repr(variable) for variable in fresh.vtable.variable_list])
+        self.assertEqual([variable.var_token.start for variable in compilation.vtable.variable_list],
+                         [variable.var_token.start for variable in fresh.vtable.variable_list])
+        self.assertEqual([function.function_name for function in compilation.ftable.function_list],
+                         [function.function_name for function in fresh.ftable.function_list])
+        self.assertEqual(repr(compilation.scope_table), repr(fresh.scope_table))
+
+    def test_memo_skips_reused_procedures(self):
+        text = 'proc p { n := add(n, 1) ; output := n ; return ; } , main { call p ; halt ; num n ; }'
+        memo = spl.ProcedureMemo()
+        first = spl.Compilation(text, memo=memo)
+        first.run()
+        first.run_generator()
+        with unittest.mock.patch.object(spl.TypeChecker, 'leave_Var', autospec=True,
+                                        side_effect=spl.TypeChecker.leave_Var) as type_checks, \
+                unittest.mock.patch.object(spl.IRGenerator, 'leave_Var', autospec=True,
+                                           side_effect=spl.IRGenerator.leave_Var) as generated:
+            compilation = spl.Compilation(text, memo=memo)
+            compilation.run()
+            code = compilation.run_generator()
+        # p's three uses of n were neither checked nor generated again - only the p in main's call p was visited
+        self.assertEqual((type_checks.call_count, generated.call_count), (1, 0))
+        self.assertEqual(code, first.code)
+        pd_entry = compilation.scope_table.children[0].children[0]
+        self.assertIsInstance(pd_entry, spl.DeferredScopeTableEntry)
+        self.assertEqual(repr(compilation.scope_table), repr(first.scope_table))
+
+    def test_memo_checks_names_from_outside(self):
+        procedure = 'proc p { n := add(n, 1) ; x := y ; return ; num x ; } , '
+        memo = spl.ProcedureMemo()
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Compilation(procedure + 'main { call p ; halt ; num n ; }', memo=memo).run()
+        self.assertIn('not declared: y', str(context.exception.errors[0]))
+        # Reused errors point into the new text
+        text = '\n' + procedure + 'main { call p ; halt ; num n ; }'
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Compilation(text, memo=memo).run()
+        self.assertEqual(memo.hits, 1)
+        self.assertEqual(text[context.exception.errors[0].position], 'y')
+        # n is a boolean now, so the summary doesn't fit
+        with self.assertRaises(spl.CompilationErrors) as context:
+            spl.Compilation(procedure + 'main { call p ; halt ; bool n ; }', memo=memo).run()
+        self.assertEqual(memo.hits, 1)
+        self.assertIn('should be a number, not a boolean', str(context.exception))
+
+    def test_memo_is_bounded(self):
+        memo = spl.ProcedureMemo(max_entries=2)
+        for index in range(3):
+            spl.Compilation(f'proc p {{ n := {index} ; return ; }} , main {{ call p ; halt ; num n ; }}',
+                            memo=memo).run()
+        self.assertEqual(len(memo), 2)
+        spl.Compilation('proc p { n := 0 ; return ; } , main { call p ; halt ; num n ; }', memo=memo).run()
+        self.assertEqual(memo.hits, 0)
+
+    def test_batch_compiles_each_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sources = {'good.spl': 'main { n := input(n) ; n := add(n, n) ; halt ; num n ; }',
+                       'bad.spl': 'main {\n  n := m ;\n  halt ;\n  num n ;\n}'}
+            for name, text in sources.items():
+                with open(os.path.join(directory, name), 'w') as source_file:
+                    source_file.write(text)
+            filenames = spl.batch_sources([os.path.join(directory, '*.spl'), os.path.join(directory, 'good.spl')])
+            self.assertEqual([os.path.basename(filename) for filename in filenames], ['bad.spl', 'good.spl'])
+            output_directory = os.path.join(directory, 'out')
+            results = list(spl.compile_batch(filenames, output_directory, workers=2))
+            self.assertEqual([result.filename for result in results], filenames)
+            self.assertIsNone(results[0].output)
+            self.assertEqual(results[0].errors, [f'{filenames[0]}:2:8: Semantic Error! DECL-APPL error! '
+                                                 f'Variable used but not declared: m'])
+            self.assertEqual(results[1].errors, [])
+            with open(results[1].output) as output_file:
+                self.assertIn('LET V0 = V0 + V0', output_file.read())
+            self.assertEqual(os.listdir(output_directory), ['good.bas'])
+
+    def test_batch_worker_reuses_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = []
+            for index in range(3):
+                filenames.append(os.path.join(directory, f'p{index}.spl'))
+                with open(filenames[-1], 'w') as source_file:
+                    source_file.write(f'main {{ n := {index} ; halt ; num n ; }}')
+            cache_directory = os.path.join(directory, 'cache')
+            with unittest.mock.patch.object(spl.CompilationCache, '__init__', autospec=True,
+                                            side_effect=spl.CompilationCache.__init__) as make_cache:
+                results = list(spl.compile_batch(filenames, workers=1, cache_directory=cache_directory))
+                self.assertEqual(make_cache.call_count, 1)
+                self.assertEqual([result.cached for result in results], [False] * 3)
+                results = list(spl.compile_batch(filenames, workers=1, cache_directory=cache_directory))
+                self.assertEqual(make_cache.call_count, 2)
+                self.assertEqual([result.cached for result in results], [True] * 3)
+
+    def test_batch_rejects_clashing_outputs(self):
+        with self.assertRaises(spl.CompilerError):
+            list(spl.compile_batch([os.path.join('a', 'x.spl'), os.path.join('b', 'x.spl')], 'out'))
+
+    def test_parallel_matches_serial(self):
+        text = ' , '.join(f'proc p{index} {{ x := add(n, {index}) ; while (larger(x, 9)) do {{ x := sub(x, 1) ; }} ; '
+                          f'call p{(index + 1) % 4} ; return ; num x ; }}'
+                          for index in range(4)) + ' , main { call p0 ; halt ; num n ; }'
+        serial = spl.Compilation(text)
+        serial.run()
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            parallel = spl.Compilation(text)
+            parallel.run_parallel(executor)
+        self.assertIsNone(parallel.scope_table)
+        self.assertEqual(repr(parallel.program_node), repr(serial.program_node))
+        self.assertEqual([token.start for token in parallel.lexer.tokens],
+                         [token.start for token in serial.lexer.tokens])
+        self.assertEqual([repr(variable) for variable in parallel.vtable.variable_list],
+                         [repr(variable) for variable in serial.vtable.variable_list])
+        self.assertEqual([function.function_name for function in parallel.ftable.function_list],
+                         [function.function_name for function in serial.ftable.function_list])
+        # The procs' code was generated by the workers, and is only linked in here
+        self.assertEqual(len(parallel.analysis.procedures), 4)
+        self.assertTrue(all(instance.summary.fragment is not None
+                            for instance in parallel.analysis.procedures.values()))
+        code = serial.run_generator()
+        with unittest.mock.patch.object(spl.IRGenerator, 'leave_Var', autospec=True,
+                                        side_effect=spl.IRGenerator.leave_Var) as leave_var:
+            self.assertEqual(parallel.run_generator(), code)
+        self.assertEqual(leave_var.call_count, 0)
+
+    def test_parallel_reports_errors_like_serial(self):
+        for bad_procedure in ['proc q { x := y ; return ; num x ; }', 'proc q { x := ; return ; }',
+                              'proc q { x := "a ; return ; }']:
+            text = 'proc p { n := 1 ; return ; } , ' + bad_procedure + ' , main { call p ; call q ; halt ; num n ; }'
+            with self.assertRaises(spl.CompilerError) as serial:
+                spl.Compilation(text).run()
+            with concurrent.futures.ProcessPoolExecutor(2) as executor:
+                with self.assertRaises(spl.CompilerError) as parallel:
+                    spl.Compilation(text).run_parallel(executor)
+            self.assertEqual(spl.Compilation(text).error_messages(parallel.exception),
+                             spl.Compilation(text).error_messages(serial.exception))
+
+    def test_emitter_writes_in_chunks(self):
+        stream = io.StringIO()
+        emitter = spl.CodeEmitter(stream, chunk_size=4)
+        emitter.emit('LET')
+        self.assertEqual(stream.getvalue(), '')
+        emitter.emit(' x', ' = 1')
+        self.assertEqual(stream.getvalue(), 'LET x = 1')
+        emitter.emit('\n')
+        emitter.flush()
+        self.assertEqual(stream.getvalue(), 'LET x = 1\n')
+
+    def test_generate_code_writes_output_path(self):
+        compilation = spl.Compilation('main { n := 1 ; halt ; num n ; }')
+        compilation.run()
+        generator = spl.AstIntermediateGenerator(compilation.program_node, compilation.vtable, compilation.ftable)
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, 'out.bas')
+            generator.generate_code(output_path)
+            with open(output_path) as output_file:
+                self.assertEqual(output_file.read(), compilation.run_generator())
+        self.assertTrue(compilation.code.endswith(' END\n'))
+
+    def test_basic_backend_resolves_jumps(self):
+        compilation = spl.Compilation('proc p { while (larger(n, 0)) do { n := sub(n, 1) ; output := n ; } ; '
+                                      'return ; } , '
+                                      'main { n := input(n) ; call p ; if (eq(n, 0)) then { output := "DONE" ; } ; '
+                                      'halt ; num n ; }')
+        compilation.run()
+        self.assertEqual(compilation.run_generator().splitlines(),
+                         ['10 INPUT V0', '20 GOSUB 60', '30 IF NOT (V0 = 0) THEN 50', '40 PRINT "DONE"', '50 END',
+                          '60 IF NOT (V0 > 0) THEN 100', '70 LET V0 = V0 - 1', '80 PRINT V0', '90 GOTO 60',
+                          '100 RETURN'])
+
+    def test_basic_assembler_numbers_lines(self):
+        emitter = spl.CodeEmitter()
+        spl.assemble_basic([0, 'PRINT 1', ('GOTO {}', 1), ('GOTO {}', 0), 1, 'END'], emitter)
+        self.assertEqual(emitter.getvalue(), '10 PRINT 1\n20 GOTO 40\n30 GOTO 10\n40 END\n')
+        # Long programs are numbered in steps of one, so as to fit
+        emitter = spl.CodeEmitter()
+        spl.assemble_basic(['PRINT 1'] * 7000, emitter)
+        self.assertTrue(emitter.getvalue().endswith('\n7009 PRINT 1\n'))
+        with self.assertRaises(spl.CompilerError):
+            spl.assemble_basic(['PRINT 1'] * 70000, spl.CodeEmitter())
+
+    def test_vm_runs_program(self):
+        compilation = spl.Compilation('proc fact { r := mult(r, n) ; n := sub(n, 1) ; if (larger(n, 1)) then '
+                                      '{ call fact ; } ; return ; } , main { n := input(n) ; r := 1 ; call fact ; '
+                                      'output := r ; i := 0 ; do { a[i] := eq(i, 1) ; i := add(i, 1) ; } '
+                                      'until (larger(i, 2)) ; output := a[1] ; output := "END" ; halt ; num n ; '
+                                      'num r ; num i ; arr bool[3] a ; }')
+        compilation.run()
+        output = []
+        compilation.execute(read=lambda: '5', write=output.append)
+        self.assertEqual(output, ['120', 'true', 'END'])
+        self.assertEqual(compilation.bytecode.code[:6:2].tolist(), [spl.OP_INPUT, spl.OP_STORE, spl.OP_CONST])
+        self.assertEqual(compilation.bytecode.names[compilation.bytecode.code[1]], 'n')
+
+    def test_vm_reports_run_time_errors(self):
+        text = 'main { i := input(i) ; a[i] := 1 ; output := a[i] ; halt ; num i ; arr num[2] a ; }'
+        compilation = spl.Compilation(text)
+        compilation.run()
+        for line, message in [('2', 'Array index out of range: a[2]'), ('-1', 'Array index out of range: a[-1]'),
+                              ('x', "input should be a number, not 'x'")]:
+            with self.assertRaises(spl.ExecutionError) as context:
+                compilation.execute(read=lambda: line, write=None)
+            self.assertIn(message, str(context.exception))
+            self.assertEqual(text[context.exception.position], 'a' if line != 'x' else 'i')
+        output = []
+        compilation.execute(read=lambda: '1.0', write=output.append)
+        self.assertEqual(output, ['1'])
+
+    def test_python_tier_matches_vm(self):
+        compilation = spl.Compilation('proc p { proc q { s := add(s, 1) ; return ; } , call q ; return ; } , '
+                                      'main { i := 0 ; while (larger(3, i)) do { a[i] := i ; i := add(i, 1) ; call p ; '
+                                      '} ; do { i := sub(i, 1) ; output := a[i] ; } until (not(larger(i, 0))) ; '
+                                      'if (and(eq(s, 3), true)) then { output := "OK" ; } else { output := s ; } ; '
+                                      'halt ; num i ; num s ; arr num[3] a ; }')
+        compilation.run()
+        outputs = []
+        for python in (False, True):
+            output = []
+            compilation.execute(write=output.append, python=python)
+            outputs.append(output)
+        self.assertEqual(outputs[1], ['2', '1', '0', 'OK'])
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(compilation.python_program.code.co_filename, spl.PYTHON_FILENAME)
+        # Variables and procs named like the names each other are given in Python
+        compilation = spl.Compilation('proc p { procedure := add(procedure, 1) ; return ; } , '
+                                      'main { call p ; output := procedure ; halt ; num procedure ; }')
+        compilation.run()
+        outputs = []
+        for python in (False, True):
+            output = []
+            compilation.execute(write=output.append, python=python)
+            outputs.append(output)
+        self.assertEqual(outputs, [['1'], ['1']])
+
+    def test_python_tier_reports_run_time_errors(self):
+        text = 'main { i := input(i) ; a[i] := 1 ; output := a[i] ; halt ; num i ; arr num[2] a ; }'
+        compilation = spl.Compilation(text)
+        compilation.run()
+        for line, message in [('2', 'Array index out of range: a[2]'), ('-1', 'Array index out of range: a[-1]'),
+                              ('x', "input should be a number, not 'x'")]:
+            with self.assertRaises(spl.ExecutionError) as context:
+                compilation.execute(read=lambda: line, write=None, python=True)
+            self.assertIn(message, str(context.exception))
+            self.assertEqual(text[context.exception.position], 'a' if line != 'x' else 'i')
+
+    def test_tiers_allow_the_same_call_depth(self):
+        # r calls itself depth times, the last time calling the leaf l, which makes no calls
+        limit = sys.getrecursionlimit()
+        too_deep = f'More than {spl.MAX_CALL_DEPTH} calls in progress'
+        for depth, expected in [(limit * 3, '0'), (spl.MAX_CALL_DEPTH - 1, '0'), (spl.MAX_CALL_DEPTH, too_deep),
+                                (spl.MAX_CALL_DEPTH + 1000, too_deep)]:
+            compilation = spl.Compilation('proc l { output := n ; return ; } , proc r { n := sub(n, 1) ; '
+                                          'if (larger(n, 0)) then { call r ; } else { call l ; } ; return ; } , '
+                                          f'main {{ n := {depth} ; call r ; halt ; num n ; }}')
+            compilation.run()
+            for python in (False, True):
+                output = []
+                try:
+                    compilation.execute(write=lambda text: output.append((text, sys.getrecursionlimit())),
+                                        python=python)
+                except spl.ExecutionError as error:
+                    output.append((str(error), limit))
+                self.assertIn(expected, output[-1][0])
+                self.assertEqual(output[-1][1], limit)
+
+    def test_optimiser_folds_constants(self):
+        compilation = spl.Compilation('main { n := add(3, mult(2, 2)) ; b := not(eq(n, sub(8, 1))) ; '
+                                      'n := add(mult(n, 1), 0) ; b := or(b, false) ; output := 2.5 ; halt ; num n ; '
+                                      'bool b ; }')
+        compilation.run()
+        self.assertEqual(len(compilation.ftable.function_list), 8)
+        self.assertEqual(compilation.run_optimiser(), 6)
+        self.assertEqual([function.function_type for function in compilation.ftable.function_list],
+                         [spl.AstIntermediateGenerator.FT_UNOP_NOT, spl.AstIntermediateGenerator.FT_BINOP_EQ])
+        self.assertEqual(compilation.run_generator().splitlines(),
+                         ['10 LET V0 = 7', '20 LET V1 = NOT (V0 = 7)', '30 PRINT 2.5', '40 END'])
+
+    def test_optimiser_keeps_input(self):
+        compilation = spl.Compilation('proc p { b := and(false, larger(input(n), 1)) ; b := or(true, b) ; return ; } , '
+                                      'main { call p ; halt ; num n ; bool b ; }')
+        compilation.run()
+        self.assertEqual(compilation.run_optimiser(), 1)
+        self.assertEqual([function.function_type for function in compilation.ftable.function_list][:1], ['proc'])
+        self.assertEqual(compilation.run_generator().splitlines()[2:], ['30 INPUT V1', '40 LET V0 = 0 AND (V1 > 1)',
+                                                                        '50 LET V0 = -1', '60 RETURN'])
+
+    def test_optimiser_removes_dead_code(self):
+        compilation = spl.Compilation('proc p { proc q { output := n ; return ; } , call q ; return ; } , '
+                                      'proc r { output := m ; call p ; return ; } , '
+                                      'main { n := 1 ; if (eq(1, 1)) then { output := n ; } else { call r ; } ; '
+                                      'while (false) do { m := 2 ; a[0] := 1 ; } ; call p ; '
+                                      'do { output := 3 ; } until (true) ; if (eq(n, 1)) then { output := 5 ; } ; '
+                                      'halt ; num n ; num m ; arr num[4] a ; }')
+        compilation.run()
+        self.assertEqual(compilation.run_optimiser(), 7)
+        self.assertEqual([function.function_name for function in compilation.ftable.function_list][:2], ['p', 'q'])
+        self.assertEqual(len(compilation.vtable.variable_list), 1)
+        self.assertEqual(compilation.run_generator().splitlines(),
+                         ['10 LET V0 = 1', '20 PRINT V0', '30 GOSUB 80', '40 PRINT 3', '50 IF NOT (V0 = 1) THEN 70',
+                          '60 PRINT 5', '70 END', '80 GOSUB 100', '90 RETURN', '100 PRINT V0', '110 RETURN'])
+
+    def test_optimiser_removes_code_after_endless_loop(self):
+        compilation = spl.Compilation('main { n := input(n) ; while (true) do { output := n ; } ; n := 1 ; '
+                                      'output := s ; halt ; num n ; string s ; }')
+        compilation.run()
+        self.assertEqual(compilation.run_optimiser(), 3)
+        self.assertEqual(compilation.run_generator().splitlines(),
+                         ['10 INPUT V0', '20 IF NOT -1 THEN 50', '30 PRINT V0', '40 GOTO 20', '50 END'])
+
+    def test_ir_is_three_address_code(self):
+        compilation = spl.Compilation('main { n := add(n, input(n)) ; a[n] := not(eq(s, "A")) ; output := a[0] ; '
+                                      'halt ; num n ; arr bool[2] a ; string s ; }')
+        compilation.run()
+        program = compilation.run_ir()
+        self.assertEqual(repr(program).splitlines(),
+                         ['    t0 := n', '    input n', '    n := t0 add n', '    t1 := s eq "A"', '    t2 := not t1',
+                          '    a[n] := t2', '    t3 := a[0]', '    output t3', '    end'])
+        self.assertEqual(program.temporary_count, 4)
+        self.assertEqual(compilation.run_generator().splitlines(),
+                         ['10 DIM V1(2)', '20 LET T0 = V0', '30 INPUT V0', '40 LET V0 = T0 + V0',
+                          '50 LET V1(V0) = NOT (V2$ = "A")', '60 PRINT V1(0)', '70 END'])
+
+    def test_control_flow_graph(self):
+        compilation = spl.Compilation('proc p { output := 1 ; return ; } , '
+                                      'main { while (larger(n, 0)) do { n := sub(n, 1) ; call p ; } ; halt ; num n ; }')
+        compilation.run()
+        graph = compilation.run_ir().control_flow_graph()
+        self.assertEqual([(block.start, block.end) for block in graph.blocks], [(0, 3), (3, 5), (5, 6), (6, 8),
+                                                                               (8, 11)])
+        self.assertEqual([block.successors for block in graph.blocks], [[1, 3], [2], [0], [], []])
+        self.assertEqual([block.predecessors for block in graph.blocks], [[2], [0], [1], [0], []])
+        self.assertEqual(graph.blocks[1].callee, 4)
+        self.assertEqual([instruction.opcode for instruction in graph.instructions(graph.blocks[4])],
+                         [spl.IR_LABEL, spl.IR_OUTPUT, spl.IR_RETURN])
 
 
 if __name__ == '__main__':